@@ -0,0 +1,47 @@
+# Usage:
+#   python bench/bench_call.py [n]
+#
+# Time call._call_function() with the call adapter compiled by config()
+# and with inspect.signature() on each call, as was done before adapters.
+
+import sys
+import timeit
+import inspect
+
+import hapiserver
+from hapiserver.call import _call_function
+
+
+def data(dataset, parameters, start, stop, config=None):
+  return dataset
+
+
+def _call_function_inspect(endpoint, args, config):
+  # Per-call dispatch used before call adapters.
+  func = config['functions'][endpoint]
+  func_params = inspect.signature(func).parameters
+  args = [str(args[x]) for x in args.keys()]
+  config_kwarg = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in func_params.values())
+  if 'config' in func_params or config_kwarg:
+    return func(*args, config=config), None
+  return func(*args), None
+
+
+def main(n=100000):
+  functions = {"catalog": data, "info": data, "data": data}
+  config = hapiserver.config({"about": {}, "functions": functions})
+  args = {
+    'dataset': 'demo1',
+    'parameters': '',
+    'start': '1970-01-01T00:00:00.000000000Z',
+    'stop': '1970-01-02T00:00:00.000000000Z'
+  }
+  assert _call_function('data', args, config) == _call_function_inspect('data', args, config)
+
+  for name, func in [('inspect', _call_function_inspect), ('adapter', _call_function)]:
+    t = min(timeit.repeat(lambda: func('data', args, config), number=n, repeat=5))
+    print(f"{name:>8}: {1e6 * t / n:.2f} µs/call")
+
+
+if __name__ == "__main__":
+  main(*[int(arg) for arg in sys.argv[1:]])
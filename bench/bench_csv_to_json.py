@@ -0,0 +1,43 @@
+# Usage:
+#   python bench/bench_csv_to_json.py [rows] [rows per block]
+#
+# Time conversion of HAPI CSV to JSON rows for a parameter with size [3]
+# with convert_line() on each line and with convert_lines() and
+# convert_block() on blocks of lines (as done by transcode.transcode()).
+
+import sys
+import json
+import time
+
+from hapiserver.csv_to_json import convert_block, convert_line, convert_lines
+
+
+def main(n=200000, block_rows=10000):
+  lines = [f"2010-01-01T00:00:{i % 60:02d}.000Z,{i}.5,{-i}.25,1e-3" for i in range(n)]
+  blocks = ["".join(line + "\n" for line in lines[i:i + block_rows]) for i in range(0, n, block_rows)]
+  size = [3]
+
+  def per_line():
+    return ", ".join(json.dumps(convert_line(line, size=size)) for line in lines)
+
+  def batched():
+    return ", ".join(json.dumps(convert_lines(block.splitlines(), [size], ["double"]))[1:-1] for block in blocks)
+
+  def vectorized():
+    return ", ".join(convert_block(block, [size], ["double"]) for block in blocks)
+
+  assert json.loads(f"[{per_line()}]") == json.loads(f"[{batched()}]") == json.loads(f"[{vectorized()}]")
+
+  for name, func in [("convert_line", per_line), ("convert_lines", batched), ("convert_block", vectorized)]:
+    elapsed = min(_time(func) for _ in range(3))
+    print(f"{name:>14}: {elapsed:.3f} s ({n / elapsed:,.0f} rows/s)")
+
+
+def _time(func):
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+  main(*[int(arg) for arg in sys.argv[1:]])
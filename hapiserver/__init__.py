@@ -1,21 +1,33 @@
 __version__ = "0.0.1"
 
 __all__ = [
+  "admission",
   "app",
+  "cache",
   "call",
   "cli",
+  "coalesce",
   "config",
   "endpoints",
   "error",
   "exec",
   "get",
   "openapi",
-  "util"
+  "process",
+  "transcode",
+  "util",
+  "worker"
 ]
 
+from hapiserver import admission
+from hapiserver import cache
+from hapiserver import coalesce
 from hapiserver import endpoints
 from hapiserver import openapi
+from hapiserver import process
+from hapiserver import transcode
 from hapiserver import util
+from hapiserver import worker
 from hapiserver.app import app
 from hapiserver.call import call
 from hapiserver.cli import cli
@@ -0,0 +1,315 @@
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+# Limits for /data requests, set in the "admission" object of the server
+# config (e.g., "admission": {"max_concurrent": 8, "max_per_dataset": 2}).
+# A max_concurrent or max_per_dataset of 0 means no limit. If /data runs in
+# a worker or process pool, max_concurrent is at most the number of workers.
+_DEFAULTS = {
+  "max_concurrent": 32,   # /data requests executing at once
+  "max_per_dataset": 0,   # /data requests executing at once per dataset
+  "max_queue": 64,        # requests waiting for a slot
+  "queue_timeout": 30,    # seconds a request may wait for a slot
+  "retry_after": 10,      # value of Retry-After header when rejected
+  "bulk_cost": 1e7,       # cost at and above which a request is bulk
+  "bulk_share": 0.5,      # fraction of max_concurrent slots bulk requests may use
+  "aging": 10,            # seconds of waiting that offset a 10x higher cost
+  "default_cadence": 60   # cadence (seconds) for cost if info has none
+}
+
+# Seconds between checks for a disconnected client while a request waits
+# (see Admission.acquire()).
+_POLL_INTERVAL = 1
+
+_lock = threading.Lock()
+
+
+class Admission:
+  """Limits the number of concurrent executions, globally and per key.
+
+  Requests that cannot start immediately wait in a bounded queue. A
+  waiting request starts as soon as both a global slot and a slot for its
+  key are free; requests for keys at their limit do not block requests
+  for other keys.
+
+  Each request has a cost (e.g., the estimated number of values in a /data
+  response; see endpoints._data_cost()). Waiting requests start in order
+  of log10(cost) minus the time they have waited divided by aging, so
+  small requests go first and large ones are not starved. Requests with
+  cost >= bulk_cost may use at most bulk_share of the max_concurrent
+  slots (and at least one), so that slots remain for small requests.
+  """
+
+  def __init__(self, max_concurrent=32, max_per_dataset=0, max_queue=64, queue_timeout=30, retry_after=10,
+               bulk_cost=1e7, bulk_share=0.5, aging=10, default_cadence=60):
+    self.max_concurrent = max_concurrent
+    self.max_per_dataset = max_per_dataset
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self.retry_after = retry_after
+    self.bulk_cost = bulk_cost
+    self.max_bulk = max(1, int(max_concurrent * bulk_share)) if max_concurrent else 0
+    self.aging = aging
+    self.default_cadence = default_cadence
+    self.admitted = 0
+    self.rejected = 0
+    self.timeouts = 0
+    self.abandoned = 0
+    self._running = 0
+    self._running_bulk = 0
+    self._running_per_key = collections.Counter()
+    self._waiting = []
+    self._lock = threading.Lock()
+
+  async def acquire(self, key, cost=0, disconnected=None):
+    """Wait for a slot for key and return a Slot or None if rejected.
+
+    A request is rejected if the queue is full or if no slot becomes free
+    within queue_timeout seconds. disconnected, if given, is an async
+    function that returns True if the client is gone (e.g.,
+    starlette.requests.Request.is_disconnected); it is called every
+    _POLL_INTERVAL seconds while the request waits, and the request is
+    abandoned (None is returned) when it returns True.
+    """
+    import asyncio
+
+    bulk = cost >= self.bulk_cost
+    with self._lock:
+      if self._available(key, bulk):
+        return self._start(key, bulk)
+      if len(self._waiting) >= self.max_queue:
+        self.rejected += 1
+        logger.warning(f"Rejected request for '{key}': {len(self._waiting)} request(s) waiting")
+        return None
+      waiter = _Waiter(key, cost, bulk, asyncio.get_running_loop())
+      self._waiting.append(waiter)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + self.queue_timeout
+    try:
+      while True:
+        timeout = max(0, deadline - loop.time())
+        if disconnected is not None:
+          timeout = min(timeout, _POLL_INTERVAL)
+        try:
+          return await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+          pass
+        if loop.time() >= deadline:
+          break
+        if await disconnected():
+          if not self._abandon(waiter):
+            waiter.cancel()
+          with self._lock:
+            self.abandoned += 1
+          logger.info(f"Abandoned request for '{key}': client disconnected while waiting")
+          return None
+    except BaseException:
+      # Cancelled while waiting (e.g., the server is shutting down).
+      if not self._abandon(waiter):
+        waiter.cancel()
+      raise
+
+    if not self._abandon(waiter):
+      # Granted as the timeout expired.
+      return await waiter.future
+
+    with self._lock:
+      self.timeouts += 1
+      self.rejected += 1
+    logger.warning(f"Rejected request for '{key}': no slot free after {self.queue_timeout} s")
+    return None
+
+  def stats(self):
+    with self._lock:
+      return {
+        "running": self._running,
+        "running_bulk": self._running_bulk,
+        "running_per_dataset": {k: v for k, v in self._running_per_key.items() if v > 0},
+        "queue_depth": len(self._waiting),
+        "admitted": self.admitted,
+        "rejected": self.rejected,
+        "timeouts": self.timeouts,
+        "abandoned": self.abandoned,
+        "max_concurrent": self.max_concurrent,
+        "max_per_dataset": self.max_per_dataset,
+        "max_bulk": self.max_bulk,
+        "max_queue": self.max_queue
+      }
+
+  def _available(self, key, bulk=False):
+    if self.max_concurrent and self._running >= self.max_concurrent:
+      return False
+    if self.max_per_dataset and self._running_per_key[key] >= self.max_per_dataset:
+      return False
+    if bulk and self.max_bulk and self._running_bulk >= self.max_bulk:
+      return False
+    return True
+
+  def _start(self, key, bulk):
+    self._running += 1
+    self._running_bulk += bulk
+    self._running_per_key[key] += 1
+    self.admitted += 1
+    return Slot(self, key, bulk)
+
+  def _release(self, key, bulk):
+    with self._lock:
+      self._running -= 1
+      self._running_bulk -= bulk
+      self._running_per_key[key] -= 1
+      if self._running_per_key[key] <= 0:
+        del self._running_per_key[key]
+      granted = self._grant()
+    for waiter, slot in granted:
+      waiter.grant(slot)
+
+  def _grant(self):
+    # Start waiting requests in priority order, skipping those whose key
+    # or class (bulk) is at its limit.
+    import time
+
+    now = time.monotonic()
+    def priority(waiter):
+      return waiter.priority - (now - waiter.enqueued) / self.aging if self.aging else waiter.priority
+
+    granted = []
+    for waiter in sorted(self._waiting, key=priority):
+      if not self._available(waiter.key, waiter.bulk):
+        if self.max_concurrent and self._running >= self.max_concurrent:
+          break
+        continue
+      self._waiting.remove(waiter)
+      granted.append((waiter, self._start(waiter.key, waiter.bulk)))
+    return granted
+
+  def _abandon(self, waiter):
+    """Remove waiter from the queue. Returns False if it was granted a slot."""
+    with self._lock:
+      if waiter in self._waiting:
+        self._waiting.remove(waiter)
+        return True
+      return False
+
+
+class Slot:
+  """A granted execution slot. Release it with release() or wrap()."""
+
+  def __init__(self, admission, key, bulk=False):
+    self._admission = admission
+    self._key = key
+    self._bulk = bulk
+    self._released = False
+    self._lock = threading.Lock()
+
+  def release(self):
+    """Release the slot. Calls after the first have no effect."""
+    with self._lock:
+      if self._released:
+        return
+      self._released = True
+    self._admission._release(self._key, self._bulk)
+
+  def wrap(self, stream):
+    """Return a generator that yields from stream and releases the slot when done.
+
+    stream may be an iterable or an async iterable. The slot is also
+    released if the generator is closed or garbage collected before it
+    is exhausted.
+    """
+    import weakref
+
+    slot = self
+    if hasattr(stream, '__aiter__'):
+      async def wrapper():
+        try:
+          async for chunk in stream:
+            yield chunk
+        finally:
+          slot.release()
+          if hasattr(stream, 'aclose'):
+            await stream.aclose()
+    else:
+      def wrapper():
+        try:
+          yield from stream
+        finally:
+          slot.release()
+          if hasattr(stream, 'close'):
+            stream.close()
+
+    generator = wrapper()
+    weakref.finalize(generator, slot.release)
+    return generator
+
+
+class _Waiter:
+
+  def __init__(self, key, cost, bulk, loop):
+    import math
+    import time
+
+    self.key = key
+    self.bulk = bulk
+    self.priority = math.log10(cost + 1)
+    self.enqueued = time.monotonic()
+    self.loop = loop
+    self.future = loop.create_future()
+    self.cancelled = False
+
+  def cancel(self):
+    """Release the granted slot now or when it is granted."""
+    self.cancelled = True
+    if self.future.done():
+      self.future.result().release()
+
+  def grant(self, slot):
+    # May be called from any thread (slots are released by the threads
+    # that iterate synchronous streams).
+    def set_result():
+      if self.cancelled:
+        slot.release()
+      else:
+        self.future.set_result(slot)
+    try:
+      self.loop.call_soon_threadsafe(set_result)
+    except RuntimeError:
+      # Event loop closed.
+      slot.release()
+
+
+def get(config):
+  """Return the Admission shared by all /data requests for config, creating it on first use."""
+  if '_admission' not in config:
+    with _lock:
+      if '_admission' not in config:
+        options = {**_DEFAULTS, **config.get('admission', {})}
+        workers = _workers(config)
+        if workers and not 0 < options['max_concurrent'] <= workers:
+          # Requests beyond the number of workers would wait for one in a
+          # thread (see worker.Pool and process.Pool); make them wait here
+          # instead.
+          options['max_concurrent'] = workers
+        logger.debug(f"Creating admission control with {options}")
+        config['_admission'] = Admission(**options)
+  return config['_admission']
+
+
+def _workers(config):
+  """Return the number of workers that run /data requests, or None if not limited."""
+  options = config.get('exec', {}).get('data', {})
+  if options.get('mode') == 'worker' and 'data' in config.get('scripts', {}):
+    return options.get('workers', 1)
+  if options.get('mode') == 'process' and 'data' in config.get('functions', {}):
+    return options.get('workers', 1)
+  return None
+
+
+def stats(config):
+  """Return running, queue depth, and rejection counts for /data requests."""
+  if '_admission' not in config:
+    return None
+  return config['_admission'].stats()
@@ -1,4 +1,5 @@
 import logging
+import functools
 
 import hapiserver
 
@@ -36,7 +37,7 @@ def app(config):
   # See https://blog.stackademic.com/customizing-documentation-in-fastapi-24ee9f048e31
   # for customizing FastAPI docs.
   # TODO: Use css to hide redirect and head sections.
-  app = fastapi.FastAPI(**app_kwargs)
+  app = fastapi.FastAPI(**app_kwargs, on_shutdown=[_stop_workers, functools.partial(_log_stats, config)])
 
   # Get the base path for the HAPI server.
   patho = config.get("path", "/hapi").rstrip("/")
@@ -46,9 +47,12 @@ def app(config):
     logger.error(emsg)
     exit(1)
 
-  _init_head(app, patho)
+  static = _static_responses(config)
+  _start_workers(config)
+
+  _init_head(app, patho, config, static)
   _init_redirects(app, patho)
-  _init_get(app, patho, config)
+  _init_get(app, patho, config, static)
 
   return app
 
@@ -57,7 +61,109 @@ def _log_request(endpoint_name, request):
   logger.info(f"{endpoint_name} called with {request.query_params}")
 
 
-def _init_get(app, patho, config):
+def _static_responses(config):
+  # Responses for /hapi, /about, and /capabilities depend only on config,
+  # so they are serialized once and served as-is for requests without
+  # query parameters.
+  responses = {}
+  for name in ['hapi', 'about', 'capabilities']:
+    endpoint = getattr(hapiserver.endpoints, name)
+    responses[name] = hapiserver.endpoints._prepare(endpoint({}, config))
+  return responses
+
+
+def _start_workers(config):
+  # Start workers and fork servers now so that the first requests do not
+  # wait for interpreter startup and imports.
+  from hapiserver.config import _split_script
+
+  for endpoint, options in config.get('exec', {}).items():
+    mode = options.get('mode')
+    if mode in ['worker', 'fork'] and endpoint in config.get('scripts', {}):
+      script, _ = _split_script(config['scripts'][endpoint])
+      logger.info(f"Starting {mode} server(s) for /{endpoint} script {script}")
+      hapiserver.worker.pool(script, options).start()
+    if mode == 'process' and endpoint in config.get('functions', {}):
+      logger.info(f"Starting worker process(es) for /{endpoint} function")
+      hapiserver.process.pool(config, endpoint).start()
+
+
+def _stop_workers():
+  # Stop the workers, fork servers, and worker processes started by
+  # _start_workers() or on first use.
+  logger.info("Stopping worker processes")
+  hapiserver.worker.close()
+  hapiserver.process.close()
+
+
+def _log_stats(config):
+  # Summary of cache and admission control activity for tuning their
+  # options (see hapiserver.cache and hapiserver.admission).
+  logger.info(f"Cache stats: {hapiserver.cache.stats(config)}")
+  logger.info(f"Admission stats: {hapiserver.admission.stats(config)}")
+
+
+def _not_modified(request, response):
+  """True if the request's validators match response's ETag/Last-Modified."""
+  import email.utils
+
+  headers = response.get('headers', {})
+  etag = headers.get('ETag')
+  if etag is None:
+    return False
+
+  if_none_match = request.headers.get('if-none-match')
+  if if_none_match is not None:
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.1.3)
+    # and uses weak comparison.
+    etags = [tag.strip() for tag in if_none_match.split(',')]
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in etags]
+    return '*' in etags or etag in etags
+
+  if_modified_since = request.headers.get('if-modified-since')
+  last_modified = headers.get('Last-Modified')
+  if if_modified_since is not None and last_modified is not None:
+    try:
+      since = email.utils.parsedate_to_datetime(if_modified_since)
+      modified = email.utils.parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+      return False
+    return modified <= since
+
+  return False
+
+
+def _response(request, response, head=False):
+  """Create a Response from an endpoint response dict.
+
+  Returns 304 Not Modified if the request has matching conditional headers.
+  For HEAD requests, the headers (including Content-Length) of the GET
+  response are returned without a body.
+  """
+  import fastapi
+
+  if response.get('status_code', 200) == 200 and _not_modified(request, response):
+    headers = {
+      k: v for k, v in response['headers'].items()
+      if k in ['ETag', 'Last-Modified', 'Server']
+    }
+    return fastapi.responses.Response(status_code=304, headers=headers)
+
+  if head:
+    content = response.get('content', '')
+    if isinstance(content, str):
+      content = content.encode('utf-8')
+    headers = {**response.get('headers', {}), "Content-Length": str(len(content))}
+    return fastapi.responses.Response(
+      status_code=response.get('status_code', 200),
+      headers=headers,
+      media_type=response.get('media_type')
+    )
+
+  return fastapi.responses.Response(**response)
+
+
+def _init_get(app, patho, config, static):
   import fastapi
 
   path = patho
@@ -68,8 +174,11 @@ def _init_get(app, patho, config):
   def indexhtml(request: fastapi.Request):
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.hapi(query, config)
-    return fastapi.responses.Response(**response)
+    if query:
+      response = hapiserver.endpoints.hapi(query, config)
+    else:
+      response = static['hapi']
+    return _response(request, response)
 
 
   path = f"{patho}/about"
@@ -79,8 +188,11 @@ def _init_get(app, patho, config):
   def about(request: fastapi.Request):
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.about(query, config)
-    return fastapi.responses.Response(**response)
+    if query:
+      response = hapiserver.endpoints.about(query, config)
+    else:
+      response = static['about']
+    return _response(request, response)
 
 
   path = f"{patho}/capabilities"
@@ -90,52 +202,217 @@ def _init_get(app, patho, config):
   def capabilities(request: fastapi.Request):
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.capabilities(query, config)
-    return fastapi.responses.Response(**response)
+    if query:
+      response = hapiserver.endpoints.capabilities(query, config)
+    else:
+      response = static['capabilities']
+    return _response(request, response)
 
 
   path = f"{patho}/catalog"
   logger.info(f"Initalizing endpoint {path}/")
   catalog_kwargs = hapiserver.openapi.kwargs(['paths', "/hapi/catalog", 'get'])
   @app.get(path, response_class=fastapi.responses.JSONResponse, **catalog_kwargs)
-  def catalog(request: fastapi.Request):
+  async def catalog(request: fastapi.Request):
+    from starlette.concurrency import run_in_threadpool
+
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.catalog(query, config)
-    return fastapi.responses.Response(**response)
+    # An async catalog function is awaited here; a synchronous one is
+    # called by endpoints.catalog() in a thread.
+    error = await hapiserver.endpoints._aprefetch('catalog', query, config)
+    if error:
+      return _response(request, hapiserver.error(error, config))
+    response = await run_in_threadpool(hapiserver.endpoints.catalog, query, config)
+    return _response(request, response)
 
 
   path = f"{patho}/info"
   logger.info(f"Initalizing endpoint {path}/")
   info_kwargs = hapiserver.openapi.kwargs(['paths', "/hapi/info", 'get'])
   @app.get(path, response_class=fastapi.responses.JSONResponse, **info_kwargs)
-  def info(request: fastapi.Request):
+  async def info(request: fastapi.Request):
+    from starlette.concurrency import run_in_threadpool
+
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.info(query, config)
-    return fastapi.responses.Response(**response)
+    # As for /catalog.
+    error = await hapiserver.endpoints._aprefetch('info', query, config)
+    if error:
+      return _response(request, hapiserver.error(error, config))
+    response = await run_in_threadpool(hapiserver.endpoints.info, query, config)
+    return _response(request, response)
 
 
   path = f"{patho}/data"
   logger.info(f"Initalizing endpoint {path}/")
   data_kwargs = hapiserver.openapi.kwargs(['paths', "/hapi/data", 'get'])
   @app.get(path, **data_kwargs)
-  def data(request: fastapi.Request):
+  async def data(request: fastapi.Request):
+    from starlette.concurrency import run_in_threadpool
+    from hapiserver.call import _astart
+
     _log_request(path, request)
     query = request.query_params.__dict__['_dict']
-    response = hapiserver.endpoints.data(query, config)
-    if response.get('status_code', 200) != 200:
-      return fastapi.responses.Response(**response)
 
-    if isinstance(response['content'], str):
+    # Validation and metadata calls may block, so they run in a thread
+    # (async catalog and info functions are awaited here).
+    error = await hapiserver.endpoints._aprefetch('data', query, config)
+    if error:
+      return fastapi.responses.Response(**hapiserver.error(error, config))
+    query, info, response = await run_in_threadpool(
+      hapiserver.endpoints._data_request, query, config
+    )
+    if response is not None:
       return fastapi.responses.Response(**response)
+
+    # Limit the number of data scripts and functions executing at once and
+    # start small requests first when busy (see hapiserver.admission). The
+    # slot is held until the response has been streamed.
+    admission = hapiserver.admission.get(config)
+    cost = hapiserver.endpoints._data_cost(query, info, admission.default_cadence)
+    slot = await admission.acquire(query['dataset'], cost, disconnected=request.is_disconnected)
+    if slot is None:
+      if await request.is_disconnected():
+        # Abandoned while waiting; there is no one to send an error to.
+        return fastapi.responses.Response(status_code=503)
+      return fastapi.responses.Response(**_busy(admission, config))
+
+    # The returned stream may be an async generator (see exec._astream()),
+    # which StreamingResponse iterates on the event loop.
+    try:
+      response = await run_in_threadpool(hapiserver.endpoints._data_response, query, config, info)
+      if response.get('status_code', 200) != 200:
+        slot.release()
+        return fastapi.responses.Response(**response)
+      content = response.pop('content')
+      if hasattr(content, '__aiter__') and hasattr(content, 'start'):
+        # Wait briefly for the first output of an async data script
+        # before committing to HTTP 200 (see call._call_script()).
+        error = await _astart(content)
+        if error:
+          slot.release()
+          return fastapi.responses.Response(**hapiserver.error(error, config))
+      if isinstance(content, (str, bytes)):
+        # Complete content is transcoded at once, which may take a while.
+        stream = await run_in_threadpool(hapiserver.endpoints._data_stream, content, query, info, config)
+      else:
+        stream = hapiserver.endpoints._data_stream(content, query, info, config)
+    except BaseException:
+      slot.release()
+      raise
+
+    if isinstance(stream, (str, bytes)):
+      slot.release()
+      return fastapi.responses.Response(content=stream, **response)
     else:
-      stream = response['content']
-      del response['content']
-      return fastapi.responses.StreamingResponse(stream, **response)
+      response_class = _data_streaming_response_class()
+      return response_class(slot.wrap(stream), source=content, slot=slot, **response)
+
 
+@functools.lru_cache(maxsize=None)
+def _data_streaming_response_class():
+  """Return _DataStreamingResponse, a StreamingResponse for /data.
 
-def _init_head(app, patho):
+  The class is created on first use so that starlette is imported lazily.
+  """
+  from starlette.responses import StreamingResponse
+
+  class _DataStreamingResponse(StreamingResponse):
+    """StreamingResponse that stops the data script or function on disconnect.
+
+    With ASGI spec >= 2.4, Starlette only notices a disconnect when
+    sending a chunk fails, which may be much later if the script is slow
+    to write, and it leaves the body iterator to the garbage collector.
+    Here, the client is watched until the last body message has been
+    passed to the server. On disconnect, source.kill() is called if it
+    exists (e.g., to kill the data script), iteration is cancelled, the
+    iterator is closed, and the background task is not run. An async
+    iterator is cancelled at its current await; a synchronous one is
+    closed when its current next() call returns. A disconnect after the
+    response is complete (which servers report when the client closes the
+    connection) is ignored.
+
+    slot, if given, is released when the response ends, even if content
+    was closed before it was started.
+    """
+
+    def __init__(self, content, source=None, slot=None, **kwargs):
+      super().__init__(content, **kwargs)
+      self._content = content
+      self._stop = getattr(source, 'kill', None)
+      self._slot = slot
+
+    async def __call__(self, scope, receive, send):
+      import anyio
+
+      completed = False
+      disconnected = False
+
+      def stop():
+        nonlocal disconnected
+        disconnected = True
+        logger.info("Client disconnected; stopping /data response")
+        if self._stop is not None:
+          self._stop()
+
+      async def listen():
+        await self.listen_for_disconnect(receive)
+        if completed:
+          return
+        stop()
+        task_group.cancel_scope.cancel()
+
+      async def send_message(message):
+        nonlocal completed
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+          completed = True
+        await send(message)
+
+      try:
+        async with anyio.create_task_group() as task_group:
+          task_group.start_soon(listen)
+          try:
+            await self.stream_response(send_message)
+          except OSError:
+            stop()
+          completed = True
+          task_group.cancel_scope.cancel()
+      finally:
+        with anyio.CancelScope(shield=True):
+          await self._close()
+
+      if not disconnected and self.background is not None:
+        await self.background()
+
+    async def _close(self):
+      import anyio
+
+      try:
+        if hasattr(self._content, 'aclose'):
+          await self._content.aclose()
+        elif hasattr(self._content, 'close'):
+          await anyio.to_thread.run_sync(self._content.close)
+      finally:
+        if self._slot is not None:
+          self._slot.release()
+
+  return _DataStreamingResponse
+
+
+def _busy(admission, config):
+  stats = admission.stats()
+  error = {
+    "code": 1500,
+    "message": "Internal server error - too many concurrent data requests; retry later",
+    "message_console": f"Rejected /data request. Admission stats: {stats}",
+    "status_code": 503,
+    "headers": {"Retry-After": str(admission.retry_after)}
+  }
+  return hapiserver.error(error, config)
+
+
+def _init_head(app, patho, config, static):
   import fastapi
 
   def head_kwargs(path):
@@ -153,33 +430,44 @@ def _init_head(app, patho):
 
   response = fastapi.responses.Response(status_code=200, content='')
 
+  # HEAD responses for all endpoints except /data have the same headers as
+  # the GET response, including ETag, Last-Modified, and Content-Length.
+
   # Initialize landing page at {patho}/hapi
   path = patho
   @app.head(path, **head_kwargs(path))
   def indexhtml_head(request: fastapi.Request):
     _log_request(path, request)
-    return response
+    query = request.query_params.__dict__['_dict']
+    if query:
+      return _response(request, hapiserver.endpoints.hapi(query, config), head=True)
+    return _response(request, static['hapi'], head=True)
 
   # Initialize {patho}/about
   path = f"{patho}/about"
   @app.head(path, **head_kwargs(path))
   def about_head(request: fastapi.Request):
     _log_request(path, request)
-    return response
+    query = request.query_params.__dict__['_dict']
+    if query:
+      return _response(request, hapiserver.endpoints.about(query, config), head=True)
+    return _response(request, static['about'], head=True)
 
   # Initialize {patho}/catalog
   path = f"{patho}/catalog"
   @app.head(path, **head_kwargs(path))
   def catalog_head(request: fastapi.Request):
     _log_request(path, request)
-    return response
+    query = request.query_params.__dict__['_dict']
+    return _response(request, hapiserver.endpoints.catalog(query, config), head=True)
 
   # Initialize {patho}/info
   path = f"{patho}/info"
   @app.head(path, **head_kwargs(path))
   def info_head(request: fastapi.Request):
     _log_request(path, request)
-    return response
+    query = request.query_params.__dict__['_dict']
+    return _response(request, hapiserver.endpoints.info(query, config), head=True)
 
   # Initialize {patho}/data
   path = f"{patho}/data"
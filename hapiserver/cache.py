@@ -0,0 +1,214 @@
+import time
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+# ttl is the number of seconds an entry is served without checking its
+# source and max_entries the number of entries kept (least recently used
+# are dropped). A ttl of 0 disables the cache. Set per endpoint with, e.g.,
+#   "cache": {"catalog": {"ttl": 600, "max_entries": 4}}
+_DEFAULTS = {
+  'catalog': {"ttl": 3600, "max_entries": 8},
+  'info': {"ttl": 3600, "max_entries": 1024},
+}
+
+# Maximum number of values kept per name for derived values that depend on
+# request arguments (see derived()).
+_MAX_DERIVED = 32
+
+_lock = threading.Lock()
+_derived_lock = threading.Lock()
+
+
+class CachedDict(dict):
+  """dict that can carry values derived from it (see derived())."""
+  __slots__ = ('derived',)
+
+
+class CachedList(list):
+  """list that can carry values derived from it (see derived())."""
+  __slots__ = ('derived',)
+
+
+def wrap(value):
+  """Return value as a CachedDict or CachedList (shallow copy) if possible."""
+  if isinstance(value, (CachedDict, CachedList)):
+    return value
+  if isinstance(value, dict):
+    return CachedDict(value)
+  if isinstance(value, list):
+    return CachedList(value)
+  return value
+
+
+def derived(obj, name, func, key=None):
+  """Return func(obj), computed once per object returned by wrap().
+
+  Derived values (e.g., lookup tables built from a cached catalog or info)
+  are stored on the object itself, so they are dropped when the object is
+  evicted from its cache. For other objects, func(obj) is computed on each
+  call.
+
+  If func also depends on a request argument (e.g., the requested
+  parameters), pass it (or a value that identifies it) as key. Values are
+  then computed once per key, and only those for the _MAX_DERIVED most
+  recently used keys are kept, so that requests cannot grow the store
+  without limit.
+  """
+  if not isinstance(obj, (CachedDict, CachedList)):
+    return func(obj)
+  store = getattr(obj, 'derived', None)
+  if store is None:
+    store = obj.derived = {}
+  if key is None:
+    if name not in store:
+      store[name] = func(obj)
+    return store[name]
+
+  with _derived_lock:
+    values = store.setdefault(name, collections.OrderedDict())
+    if key in values:
+      values.move_to_end(key)
+      return values[key]
+  value = func(obj)
+  with _derived_lock:
+    values[key] = value
+    while len(values) > _MAX_DERIVED:
+      values.popitem(last=False)
+  return value
+
+
+class Cache:
+  """Thread-safe LRU cache with a per-entry time-to-live (in seconds)."""
+
+  def __init__(self, name, ttl=3600, max_entries=8):
+    self.name = name
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None, stamp=None):
+    """Return the value for key or default if missing or expired.
+
+    If stamp is given and differs from the stamp the entry was stored
+    with (see set()), the entry is treated as expired.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        value, expires, entry_stamp = entry
+        if time.monotonic() < expires and entry_stamp == stamp:
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return value
+        del self._entries[key]
+      self.misses += 1
+      return default
+
+  def peek(self, key, stamp=None):
+    """Like get(), but do not count a hit or miss or mark key as used."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        value, expires, entry_stamp = entry
+        if time.monotonic() < expires and entry_stamp == stamp:
+          return value
+      return None
+
+  def set(self, key, value, stamp=None):
+    if self.ttl <= 0 or self.max_entries <= 0:
+      return
+    with self._lock:
+      self._entries[key] = (value, time.monotonic() + self.ttl, stamp)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        evicted, _ = self._entries.popitem(last=False)
+        logger.debug(f"{self.name} cache: evicted '{evicted}'")
+
+  def invalidate(self, key=None):
+    """Remove key or, if key is None, all entries."""
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
+
+  def stats(self):
+    with self._lock:
+      return {
+        "name": self.name,
+        "hits": self.hits,
+        "misses": self.misses,
+        "entries": len(self._entries),
+        "ttl": self.ttl,
+        "max_entries": self.max_entries
+      }
+
+
+def get(config, name):
+  """Return the cache named name for config, creating it on first use.
+
+  Options are those in _DEFAULTS for name updated with config['cache'][name].
+  """
+  caches = config.get('_caches')
+  if caches is None or name not in caches:
+    with _lock:
+      caches = config.setdefault('_caches', {})
+      if name not in caches:
+        options = {**_DEFAULTS.get(name, {}), **config.get('cache', {}).get(name, {})}
+        logger.debug(f"Creating {name} cache with {options}")
+        caches[name] = Cache(name, **options)
+  return caches[name]
+
+
+def stamp(endpoint, config):
+  """Return a value that changes when the source of endpoint changes.
+
+  The source is the configured script file (config['scripts'][endpoint])
+  or the file of the module that defines config['functions'][endpoint].
+  The value is (path, mtime, size) or None if there is no source file.
+  """
+  import os
+  import sys
+
+  path = None
+  if endpoint in config.get('scripts', {}):
+    from hapiserver.config import _split_script
+    path, _ = _split_script(config['scripts'][endpoint])
+  elif endpoint in config.get('functions', {}):
+    func = config['functions'][endpoint]
+    module = sys.modules.get(getattr(func, '__module__', None))
+    path = getattr(module, '__file__', None)
+
+  if not path:
+    return None
+
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+
+  return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def invalidate(config, name=None, key=None):
+  """Invalidate entries in one (name given) or all caches for config.
+
+  Use, e.g., hapiserver.cache.invalidate(config, 'catalog') after the
+  catalog changes to force the next request to call the catalog script
+  or function.
+  """
+  for cache_name, cache in list(config.get('_caches', {}).items()):
+    if name is None or cache_name == name:
+      logger.info(f"Invalidating {cache_name} cache (key = {key})")
+      cache.invalidate(key)
+
+
+def stats(config):
+  """Return a dict of hit/miss/size statistics keyed by cache name."""
+  return {name: cache.stats() for name, cache in config.get('_caches', {}).items()}
@@ -1,4 +1,6 @@
+import os
 import json
+import inspect
 import logging
 
 import hapiserver
@@ -8,6 +10,22 @@ logger = logging.getLogger(__name__)
 
 def call(endpoint, query, config):
 
+  args = _args(endpoint, query)
+
+  if 'scripts' in config and endpoint in config['scripts']:
+    return _call_script(endpoint, query, args, config)
+
+  if 'functions' in config and endpoint in config['functions']:
+    return _call_function(endpoint, args, config)
+
+  return None, {
+    "code": 1500,
+    "message": f"No script or function configured for endpoint '{endpoint}'"
+  }
+
+
+def _args(endpoint, query):
+  """Arguments for the endpoint script or function from a request query."""
   args = {}
   if endpoint == 'catalog' and 'depth' in query:
     args = {"depth": query['depth']}
@@ -25,26 +43,52 @@ def call(endpoint, query, config):
     if 'format' in query:
       args['format'] = query['format']
 
-  if 'scripts' in config and endpoint in config['scripts']:
-    return _call_script(endpoint, query, args, config)
-
-  if 'functions' in config and endpoint in config['functions']:
-    return _call_function(endpoint, args, config)
-
-  return None, {
-    "code": 1500,
-    "message": f"No script or function configured for endpoint '{endpoint}'"
-  }
+  return args
 
 
 def _call_script(endpoint, query, args, config):
   script_vals = {**query, **args}
   script, script_args = _script_command(config['scripts'][endpoint], script_vals)
+  options = config.get('exec', {}).get(endpoint)
+
+  if endpoint == 'data':
+    # Stream /data output so that the first bytes reach the client as soon
+    # as the script writes them and memory use is bounded by the stream
+    # options (see exec._stream()). Set config['stream'] = False to read
+    # all output before responding.
+    stream = config.get('stream', {})
+    if stream is True:
+      stream = {}
+    if stream is not False:
+      # Pass bytes through unchanged unless configured otherwise. This
+      # avoids decoding and re-encoding each chunk and is required for
+      # binary output.
+      stream = {"bytes": True, **stream}
+      if os.name != 'nt':
+        # Run the script with asyncio so that the response does not hold a
+        # thread while waiting for output. Not used by default on Windows,
+        # where the event loop used by the server may not support
+        # subprocesses.
+        stream = {"async": True, **stream}
+      data, error = hapiserver.exec(script, args=script_args, stream=stream, options=options)
+      if error:
+        return None, error
+      data = data()
+      if not hasattr(data, '__aiter__'):
+        # Wait briefly for the first output so that a script that fails
+        # without writing anything gets an error response instead of HTTP
+        # 200 (see start_timeout in exec._stream()). Async streams are
+        # started by the server on the event loop that iterates them (see
+        # app.py).
+        error = _start(data)
+        if error:
+          return None, error
+      return data, None
 
   if len(script_args) > 0:
-    data, error = hapiserver.exec(script, args=script_args)
+    data, error = hapiserver.exec(script, args=script_args, options=options)
   else:
-    data, error = hapiserver.exec(script)
+    data, error = hapiserver.exec(script, options=options)
   if error:
     message = "Endpoint script returned error"
     error = {
@@ -74,6 +118,38 @@ def _call_script(endpoint, query, args, config):
   return data, None
 
 
+def _start(stream):
+  """Call stream.start() for a stream from exec._stream().
+
+  Returns None or, if the script failed without writing any output
+  within the start_timeout stream option, an error dict.
+  """
+  try:
+    stream.start()
+  except Exception as e:
+    return _start_error(e)
+  return None
+
+
+async def _astart(stream):
+  """Like _start(), for a stream from exec._astream()."""
+  try:
+    await stream.start()
+  except Exception as e:
+    return _start_error(e)
+  return None
+
+
+def _start_error(e):
+  message = "Execution of script failed"
+  return {
+    "code": 1500,
+    "message": message,
+    "message_console": f"{message}: {e}",
+    "exception": e
+  }
+
+
 def _script_command(script, query):
   from hapiserver.config import _split_script
 
@@ -95,29 +171,114 @@ def _call_function(endpoint, args, config):
   func = config['functions'][endpoint]
   logger.debug(f"Calling {func}({args})")
   try:
-    import inspect
-
-    func_params = inspect.signature(func).parameters
-    args = [str(args[x]) for x in args.keys()]
-    config_kwarg = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in func_params.values())
-    if len(args) > 0:
-      if 'config' in func_params or config_kwarg:
-        data = func(*args, config=config)
-      else:
-        data = func(*args)
-    else:
-      if 'config' in func_params or config_kwarg:
-        data = func(config=config)
-      else:
-        data = func()
+    if config.get('exec', {}).get(endpoint, {}).get('mode') == 'process':
+      # Run in a worker process (see hapiserver.process).
+      return hapiserver.process.pool(config, endpoint).run(args), None
+    data = _function_adapter(endpoint, config)(args, config)
+    if inspect.isawaitable(data):
+      # async def function. An async generator is returned as is and
+      # iterated by the server on its event loop.
+      data = _await(data)
   except Exception as e:
-    message = f"Error executing {endpoint} function"
-    error = {
-      "code": 1500,
-      "message": message,
-      "message_console": message,
-      "exception": e
-    }
-    return None, error
+    return None, _function_error(endpoint, e)
 
   return data, None
+
+
+def _async_function(endpoint, config):
+  """True if endpoint is served by a function defined with async def that runs in the server process."""
+  if endpoint in config.get('scripts', {}) or endpoint not in config.get('functions', {}):
+    return False
+  if config.get('exec', {}).get(endpoint, {}).get('mode') == 'process':
+    return False
+  return inspect.iscoroutinefunction(config['functions'][endpoint])
+
+
+async def _acall(endpoint, query, config):
+  """Like call(), for an endpoint for which _async_function() is True.
+
+  Must be awaited on the server's event loop. The function is awaited
+  directly, instead of by _await() from a threadpool thread, so that no
+  thread is held while it runs.
+  """
+  args = _args(endpoint, query)
+  logger.debug(f"Calling {config['functions'][endpoint]}({args})")
+  try:
+    return await _function_adapter(endpoint, config)(args, config), None
+  except Exception as e:
+    return None, _function_error(endpoint, e)
+
+
+def _function_adapter(endpoint, config):
+  func = config['functions'][endpoint]
+  adapter = config.get('_adapters', {}).get(endpoint)
+  if adapter is None or adapter.func is not func:
+    # Function added or replaced after config() resolved it.
+    adapter = _adapter(func)
+    config.setdefault('_adapters', {})[endpoint] = adapter
+  return adapter
+
+
+def _function_error(endpoint, e):
+  message = f"Error executing {endpoint} function"
+  error = {
+    "code": 1500,
+    "message": message,
+    "message_console": message,
+    "exception": e
+  }
+  if isinstance(e, TimeoutError):
+    # No worker process was free (see process.Pool); the client may retry.
+    error['status_code'] = 503
+  return error
+
+
+def _adapter(func):
+  """Return adapter(args, config) that calls func for a request.
+
+  args is the dict of request arguments built by call(); their values are
+  passed as positional strings, in order. config is passed as a keyword
+  argument if func accepts it. The signature of func is inspected once
+  here instead of on each request. Raises ValueError or TypeError if it
+  cannot be inspected.
+  """
+
+  params = inspect.signature(func).parameters.values()
+  pass_config = any(p.name == 'config' or p.kind == inspect.Parameter.VAR_KEYWORD for p in params)
+
+  if pass_config:
+    def adapter(args, config):
+      return func(*map(str, args.values()), config=config)
+  else:
+    def adapter(args, config):
+      return func(*map(str, args.values()))
+
+  adapter.func = func
+  return adapter
+
+
+def _await(awaitable):
+  """Run awaitable to completion from a synchronous caller and return its result.
+
+  Endpoint functions are called from threadpool threads (see app.py), so
+  awaitable is run on the server's event loop, where it can share
+  connections and clients with other requests. Elsewhere (e.g., when
+  called from a script or test without a running server), it is run with
+  asyncio.run().
+  """
+  import asyncio
+  import anyio.from_thread
+
+  started = False
+  async def run():
+    nonlocal started
+    started = True
+    return await awaitable
+
+  try:
+    return anyio.from_thread.run(run)
+  except RuntimeError:
+    # Not called from a threadpool thread of a running event loop.
+    if started:
+      raise
+  return asyncio.run(run())
@@ -0,0 +1,127 @@
+"""Coalescing of small chunks yielded by data functions.
+
+A data function that yields one record at a time would otherwise have
+each record sent as its own ASGI message and socket write. coalesce()
+joins chunks into larger ones before they reach the server. Configure
+with, e.g.,
+  "coalesce": {"chunk_size": 65536, "flush_interval": 0.25}
+or disable with "coalesce": false in the server config.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DEFAULTS = {
+  "chunk_size": 65536,     # bytes at which a chunk is yielded
+  "flush_interval": 0.25   # seconds data may wait for more to be joined to it
+}
+
+
+def coalesce(stream, chunk_size=65536, flush_interval=0.25):
+  """Return a generator that yields the chunks of stream joined as bytes.
+
+  A chunk is yielded when it reaches chunk_size bytes or when
+  flush_interval seconds have passed since its first byte was received,
+  whichever comes first; the rest is yielded when stream ends. Chunks of
+  stream may be str (encoded as UTF-8) or bytes.
+
+  stream may be an iterable or an async iterable. For an async iterable,
+  data is yielded at the deadline even if stream is waiting for its next
+  chunk. A synchronous iterable cannot be interrupted, so its deadline is
+  checked each time it yields a chunk.
+
+  If chunk_size is 0, chunks are passed through unchanged.
+  """
+  if chunk_size <= 0:
+    return stream
+  if hasattr(stream, '__aiter__'):
+    return _acoalesce(stream, chunk_size, flush_interval)
+  return _coalesce(stream, chunk_size, flush_interval)
+
+
+def options(config):
+  """Return the coalesce options in config or None if coalescing is disabled."""
+  options = config.get('coalesce', {})
+  if options is False:
+    return None
+  if options is True:
+    options = {}
+  return {**_DEFAULTS, **options}
+
+
+def _coalesce(stream, chunk_size, flush_interval):
+  import time
+
+  buffer = []
+  size = 0
+  first = 0
+  try:
+    for chunk in stream:
+      if isinstance(chunk, str):
+        chunk = chunk.encode('utf-8')
+      if not chunk:
+        continue
+      if not buffer:
+        first = time.monotonic()
+      buffer.append(chunk)
+      size += len(chunk)
+      if size >= chunk_size or (flush_interval and time.monotonic() - first >= flush_interval):
+        yield b''.join(buffer)
+        buffer = []
+        size = 0
+    if buffer:
+      yield b''.join(buffer)
+  finally:
+    if hasattr(stream, 'close'):
+      stream.close()
+
+
+async def _acoalesce(stream, chunk_size, flush_interval):
+  import asyncio
+
+  loop = asyncio.get_running_loop()
+  iterator = stream.__aiter__()
+  buffer = []
+  size = 0
+  deadline = 0
+  pending = None
+  try:
+    while True:
+      if pending is None:
+        pending = asyncio.ensure_future(iterator.__anext__())
+      if buffer and flush_interval:
+        # Wait for the next chunk only until the deadline of the buffer.
+        done, _ = await asyncio.wait([pending], timeout=max(0, deadline - loop.time()))
+        if not done:
+          yield b''.join(buffer)
+          buffer = []
+          size = 0
+          continue
+      try:
+        chunk = await pending
+      except StopAsyncIteration:
+        break
+      finally:
+        pending = None
+      if isinstance(chunk, str):
+        chunk = chunk.encode('utf-8')
+      if not chunk:
+        continue
+      if not buffer:
+        deadline = loop.time() + flush_interval
+      buffer.append(chunk)
+      size += len(chunk)
+      if size >= chunk_size:
+        yield b''.join(buffer)
+        buffer = []
+        size = 0
+    if buffer:
+      yield b''.join(buffer)
+  finally:
+    if pending is not None:
+      # The stream cannot be closed while it is running.
+      pending.cancel()
+      await asyncio.wait([pending])
+    if hasattr(stream, 'aclose'):
+      await stream.aclose()
@@ -15,6 +15,13 @@ def config(config_input=None, config_dir=None, resolve_functions=True):
 
   ENV variables defined in the config are set as OS environment variables
   and all $VAR references throughout the config are expanded before returning.
+
+  Keys that start with '_' hold state built for the resolved config:
+  function adapters ('_adapters'), endpoint caches ('_caches'), /data
+  admission control ('_admission'), and process pools ('_process'). Each
+  is created on first use by the module that owns it and is discarded
+  with the config, so a server started with a new config starts fresh.
+  These keys are not passed to endpoint functions run in processes.
   """
 
   logger.debug(f"Called with: {config_input!r}")
@@ -157,17 +164,26 @@ def _resolve_functions(cfg):
   String format: 'module.path.function_name' (standard Python dotted path).
   Skips values that are already callable.
   Raises ValueError listing all entries that cannot be resolved.
+
+  A call adapter is compiled for each function and stored in
+  cfg['_adapters'] (see call._adapter()).
   """
+  from hapiserver.call import _adapter
+
   errors = []
   for key, value in cfg.get('functions', {}).items():
-    if callable(value):
-      continue
-    attr, error = _import_function(key, value)
-    if error:
-      errors.append(error)
-      continue
-    cfg['functions'][key] = attr
-    logger.debug(f"Resolved functions.{key} -> {value}")
+    if not callable(value):
+      attr, error = _import_function(key, value)
+      if error:
+        errors.append(error)
+        continue
+      cfg['functions'][key] = attr
+      logger.debug(f"Resolved functions.{key} -> {value}")
+    try:
+      cfg.setdefault('_adapters', {})[key] = _adapter(cfg['functions'][key])
+    except (ValueError, TypeError) as e:
+      # Reported when the function is called.
+      logger.debug(f"Could not compile call adapter for functions.{key}: {e}")
 
   if errors:
     raise ValueError("Unresolvable function references:\n" + "\n".join(errors))
@@ -236,3 +252,67 @@ def _check_config(config):
     if 'functions' in config and endpoint in config['functions']:
       _exit_error(f"Both script and function defined for /{endpoint} in config.")
 
+  if not isinstance(config.get("stream", {}), (dict, bool)):
+    _exit_error("stream must be true, false, or a dict of stream options.")
+
+  for name, options in config.get("cache", {}).items():
+    if not isinstance(options, dict):
+      _exit_error(f"cache.{name} must be a dict with keys 'ttl' and/or 'max_entries'.")
+    for key, value in options.items():
+      if key not in ['ttl', 'max_entries']:
+        _exit_error(f"Unknown option cache.{name}.{key}. Allowed: ttl, max_entries.")
+      if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        _exit_error(f"cache.{name}.{key} must be a non-negative number. Got: {value!r}")
+
+  if not isinstance(config.get("transcode", True), bool):
+    _exit_error("transcode must be true or false.")
+
+  coalesce = config.get("coalesce", {})
+  if not isinstance(coalesce, (dict, bool)):
+    _exit_error("coalesce must be true, false, or a dict of coalesce options.")
+  for key, value in (coalesce if isinstance(coalesce, dict) else {}).items():
+    if key not in ['chunk_size', 'flush_interval']:
+      _exit_error(f"Unknown option coalesce.{key}. Allowed: chunk_size, flush_interval.")
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+      _exit_error(f"coalesce.{key} must be a non-negative number. Got: {value!r}")
+
+  _check_exec(config)
+
+  admission = config.get("admission", {})
+  if not isinstance(admission, dict):
+    _exit_error("admission must be a dict of admission control options.")
+  allowed = [
+    'max_concurrent', 'max_per_dataset', 'max_queue', 'queue_timeout', 'retry_after',
+    'bulk_cost', 'bulk_share', 'aging', 'default_cadence'
+  ]
+  for key, value in admission.items():
+    if key not in allowed:
+      _exit_error(f"Unknown option admission.{key}. Allowed: {', '.join(allowed)}.")
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+      _exit_error(f"admission.{key} must be a non-negative number. Got: {value!r}")
+
+
+def _check_exec(config):
+  import multiprocessing
+
+  modes = ['python', 'direct', 'worker', 'fork', 'process']
+  for endpoint, options in config.get("exec", {}).items():
+    if endpoint not in ['catalog', 'info', 'data']:
+      _exit_error(f"Unknown endpoint in exec section: '{endpoint}'. Allowed: catalog, info, data.")
+    if not isinstance(options, dict):
+      _exit_error(f"exec.{endpoint} must be a dict of execution options.")
+    mode = options.get('mode', 'python')
+    if mode not in modes:
+      _exit_error(f"exec.{endpoint}.mode must be one of {', '.join(modes)}. Got: {mode!r}")
+    if mode in ['worker', 'fork'] and os.name == 'nt':
+      _exit_error(f"exec.{endpoint}.mode = '{mode}' is not supported on Windows.")
+    if mode == 'process' and endpoint in config.get('scripts', {}):
+      _exit_error(f"exec.{endpoint}.mode = 'process' applies to functions, not scripts.")
+    for key in ['workers', 'max_requests', 'buffers', 'buffer_size']:
+      value = options.get(key, 1)
+      if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        _exit_error(f"exec.{endpoint}.{key} must be a positive integer. Got: {value!r}")
+    start_methods = multiprocessing.get_all_start_methods()
+    if options.get('start_method', 'spawn') not in start_methods:
+      _exit_error(f"exec.{endpoint}.start_method must be one of {', '.join(start_methods)}.")
+
@@ -5,7 +5,7 @@ import csv
 import json
 import math
 import sys
-from typing import List, Optional, Sequence
+from typing import Iterable, List, Optional, Sequence
 
 
 class CsvToJsonError(ValueError):
@@ -111,6 +111,128 @@ def convert_line(csv_line: str, size: Optional[Sequence[int]] = None):
   return convert_row(parsed, size=size)
 
 
+def convert_lines(
+  csv_lines: Iterable[str],
+  sizes: Sequence[Optional[Sequence[int]]],
+  types: Optional[Sequence[Optional[str]]] = None,
+):
+  """Convert CSV lines with time + one or more parameters to HAPI JSON rows.
+
+  sizes has the info.size of each parameter after time (None for a
+  scalar). types has the info.type of each parameter after time; a value
+  of a parameter of type 'double' or 'integer' is converted with float()
+  or int(), one of type 'string' or 'isotime' is kept as a string, and
+  one with no type is converted as in convert_row(). All lines are parsed
+  by one csv.reader.
+  """
+  if types is None:
+    types = [None] * len(sizes)
+  converters = {"double": float, "integer": int, "string": str, "isotime": str}
+  parameters = []
+  start = 1
+  for size, kind in zip(sizes, types):
+    count = 1 if size is None else _product(size)
+    parameters.append((start, start + count, size, converters.get(kind, _coerce_token)))
+    start += count
+
+  rows = []
+  for csv_row in csv.reader(csv_lines, skipinitialspace=True):
+    if not csv_row:
+      continue
+    if len(csv_row) != start:
+      raise CsvToJsonError(f"Expected {start} column(s), got {len(csv_row)}: {csv_row}")
+    row = [csv_row[0].strip()]
+    for first, stop, size, convert in parameters:
+      try:
+        values = [convert(token) for token in csv_row[first:stop]]
+      except ValueError as exc:
+        raise CsvToJsonError(f"Invalid value in CSV row: {csv_row}") from exc
+      row.append(values[0] if size is None else _reshape(values, size))
+    rows.append(row)
+
+  return rows
+
+
+def convert_block(
+  block,
+  sizes: Sequence[Optional[Sequence[int]]],
+  types: Sequence[Optional[str]],
+) -> str:
+  """Convert a block of CSV lines to HAPI JSON rows joined by ", ".
+
+  block is str or bytes of complete lines. See convert_lines() for sizes
+  and types. If every type is known and the block has no quoted fields,
+  all values of a parameter are parsed at once into a NumPy array that is
+  reshaped (without copying) to (rows, *size) and converted with
+  tolist(). Otherwise, convert_lines() is used. All rows are serialized
+  by one json.dumps() call.
+  """
+  if isinstance(block, str):
+    block = block.encode("utf-8")
+
+  if b'"' in block or any(kind not in _NUMPY_TYPES for kind in types):
+    rows = convert_lines(block.decode("utf-8").splitlines(), sizes, types)
+  else:
+    rows = _convert_block(block, sizes, types)
+
+  return json.dumps(rows)[1:-1]
+
+
+# NumPy dtype used to parse values of each type in convert_block()
+# (strings are decoded).
+_NUMPY_TYPES = {"double": "<f8", "integer": "<i8", "string": "U", "isotime": "U"}
+
+
+def _convert_block(block: bytes, sizes, types):
+  import numpy
+
+  if b"\r" in block:
+    block = block.replace(b"\r", b"")
+  lines = [line for line in block.split(b"\n") if line]
+  if not lines:
+    return []
+
+  counts = [1 if size is None else _product(size) for size in sizes]
+  ncolumns = 1 + sum(counts)
+  tokens = b",".join(lines).split(b",")
+  if len(tokens) != len(lines) * ncolumns:
+    raise CsvToJsonError(f"Expected {ncolumns} column(s) in each of {len(lines)} line(s); got {len(tokens)} value(s).")
+
+  try:
+    # bytes.isascii() requires Python 3.7.
+    block.decode("ascii")
+    is_ascii = True
+  except UnicodeDecodeError:
+    is_ascii = False
+
+  def strings(values):
+    values = numpy.char.strip(values)
+    if is_ascii:
+      return values.astype("U")
+    return numpy.char.decode(values, "utf-8")
+
+  table = numpy.array(tokens).reshape(len(lines), ncolumns)
+  columns = [strings(table[:, 0]).tolist()]
+  start = 1
+  for size, count, kind in zip(sizes, counts, types):
+    values = table[:, start:start + count]
+    start += count
+    try:
+      if kind in ["string", "isotime"]:
+        values = strings(values)
+      else:
+        values = values.astype(_NUMPY_TYPES[kind])
+    except ValueError as exc:
+      raise CsvToJsonError(f"Invalid {kind} value in CSV block: {exc}") from exc
+    if size is None:
+      columns.append(values[:, 0].tolist())
+    else:
+      columns.append(values.reshape(len(lines), *size).tolist())
+
+  # Tuples are serialized as JSON arrays.
+  return list(zip(*columns))
+
+
 def _warn_if_discouraged_size(size: Optional[Sequence[int]]):
   if size is None:
     return
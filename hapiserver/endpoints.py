@@ -81,7 +81,8 @@ def capabilities(query, config):
       "code": 1200,
       "message": "OK"
     },
-    **config.get('capabilities', {"outputFormats": ["csv"]})
+    **config.get('capabilities', {}),
+    "outputFormats": _output_formats(config)
   }
   return {
     "content": json.dumps(content, indent=2),
@@ -94,7 +95,10 @@ def _get_json(endpoint, query, config):
   content, error = call(endpoint, query, config)
   if error:
     return None, error
+  return _parse_json(endpoint, content)
 
+
+def _parse_json(endpoint, content):
   if isinstance(content, str):
     try:
       content = json.loads(content)
@@ -111,8 +115,95 @@ def _get_json(endpoint, query, config):
   return content, None
 
 
+def _get_cached_json(endpoint, key, query, config):
+  # Cache entries are dropped when their TTL expires or when the script or
+  # module file that produced them changes on disk.
+  cache = hapiserver.cache.get(config, endpoint)
+  stamp = hapiserver.cache.stamp(endpoint, config)
+  content = cache.get(key, stamp=stamp)
+  if content is not None:
+    logger.debug(f"Using cached {endpoint} for '{key}'")
+    return content, None
+
+  content, error = _get_json(endpoint, query, config)
+  if error:
+    return None, error
+
+  content = hapiserver.cache.wrap(content)
+  _last_modified(content)
+  cache.set(key, content, stamp=stamp)
+  return content, None
+
+
+async def _aget_cached_json(endpoint, key, query, config):
+  # Like _get_cached_json(), for a function defined with async def, which
+  # is awaited on the event loop. Returns (None, None) if the content is
+  # not cached and cannot be fetched this way; the endpoint then gets it.
+  from hapiserver.call import _acall, _async_function
+
+  cache = hapiserver.cache.get(config, endpoint)
+  stamp = hapiserver.cache.stamp(endpoint, config)
+  content = cache.peek(key, stamp=stamp)
+  if content is not None or not _async_function(endpoint, config):
+    return content, None
+  if cache.ttl <= 0 or cache.max_entries <= 0:
+    # Would not be kept for the endpoint.
+    return None, None
+
+  content, error = await _acall(endpoint, query, config)
+  if error:
+    return None, error
+  content, error = _parse_json(endpoint, content)
+  if error:
+    return None, error
+
+  content = hapiserver.cache.wrap(content)
+  _last_modified(content)
+  cache.set(key, content, stamp=stamp)
+  return content, None
+
+
+async def _aprefetch(endpoint, query, config):
+  """Fetch the catalog and info for a request from async functions on the event loop.
+
+  For a /catalog, /info, or /data request, the catalog and (for /info and
+  /data) the info of the requested dataset are fetched and cached if they
+  are produced by functions defined with async def. The endpoint then
+  finds them in the cache instead of running the functions with
+  call._await(), which holds a threadpool thread while they run.
+
+  Returns an error dict if a function failed (so that it is not called
+  again by the endpoint) or None. Query errors are left to the endpoint.
+  """
+  from hapiserver.call import _async_function
+
+  if not (_async_function('catalog', config) or _async_function('info', config)):
+    return None
+  if _query_error(endpoint, query, config):
+    return None
+  query = _normalize_query(endpoint, dict(query))
+
+  catalog, error = await _aget_cached_json('catalog', query.get('depth'), query, config)
+  if error or catalog is None or endpoint == 'catalog':
+    return error
+  if _dataset_error(query['dataset'], catalog):
+    return None
+  dataset = query['dataset']
+  _, error = await _aget_cached_json('info', dataset, {"dataset": dataset}, config)
+  return error
+
+
+def _last_modified(content):
+  """Time (seconds since epoch) content was first seen by the server."""
+  import time
+  return hapiserver.cache.derived(content, 'last_modified', lambda _: int(time.time()))
+
+
 def _get_catalog(query, config):
-  return _get_json('catalog', query, config)
+  # The catalog is used to validate the dataset id on every /info and /data
+  # request, so results are cached (keyed by depth) to avoid calling the
+  # catalog script or function each time.
+  return _get_cached_json('catalog', query.get('depth'), query, config)
 
 
 def catalog(query, config):
@@ -126,26 +217,34 @@ def catalog(query, config):
   if error:
     return hapiserver.error(error, config)
 
-  content = {
-    "HAPI": hapiserver.HAPI_VERSION,
-    "status": {
-      "code": 1200,
-      "message": "OK"
-    },
-    "catalog": catalog
-  }
+  def response(catalog):
+    content = {
+      "HAPI": hapiserver.HAPI_VERSION,
+      "status": {
+        "code": 1200,
+        "message": "OK"
+      },
+      "catalog": catalog
+    }
 
-  response = {
-    "content": json.dumps(content, indent=2),
-    "media_type": "application/json",
-    "headers": _headers(config),
-  }
+    response = {
+      "content": json.dumps(content, indent=2),
+      "media_type": "application/json",
+      "headers": _headers(config),
+    }
+    return _prepare(response, last_modified=_last_modified(catalog))
 
-  return response
+  # Serialized once per cached catalog.
+  return hapiserver.cache.derived(catalog, 'response', response)
 
 
 def _get_info(query, config):
-  return _get_json('info', query, config)
+  # /data requests need /info to validate parameters and the time range, so
+  # info is cached per dataset. The info script or function gets only the
+  # dataset, the cache key; the server selects requested parameters (see
+  # _info_header()).
+  dataset = query['dataset']
+  return _get_cached_json('info', dataset, {"dataset": dataset}, config)
 
 
 def info(query, config):
@@ -168,66 +267,102 @@ def info(query, config):
   info, error = _get_info(query, config)
   if error:
     return hapiserver.error(error, config)
-  info = info.copy()
 
   if 'parameters' in query:
     error = _parameters_error(query['parameters'], info)
     if error:
       return hapiserver.error(error, config)
 
-    parameters_list = query['parameters'].split(',')
-    if info['parameters']:
-      if info['parameters'][0]['name'] not in parameters_list:
-        parameters_list = [info['parameters'][0]['name']] + parameters_list
-    info['parameters'] = [p for p in info['parameters'] if p['name'] in parameters_list]
+  def response(info):
+    last_modified = _last_modified(info)
+    content = _info_header(info, query.get('parameters', ''))
 
-  content = {
-    "HAPI": hapiserver.HAPI_VERSION,
-    "status": {
-      "code": 1200,
-      "message": "OK"
-    },
-    **info
-  }
+    response = {
+      "content": json.dumps(content, indent=2),
+      "media_type": "application/json",
+      "headers": _headers(config),
+    }
+    return _prepare(response, last_modified=last_modified)
 
-  return {
-    "content": json.dumps(content, indent=2),
-    "media_type": "application/json",
-    "headers": _headers(config),
-  }
+  if 'parameters' in query:
+    return response(info)
+
+  # Serialized once per cached info.
+  return hapiserver.cache.derived(info, 'response', response)
 
 
 def data(query, config):
   """Response for /data endpoint"""
 
+  query, info, response = _data_request(query, config)
+  if response is not None:
+    return response
+
+  response = _data_response(query, config, info)
+  if 'content' in response and response.get('status_code', 200) == 200:
+    response['content'] = _data_stream(response['content'], query, info, config)
+  return response
+
+
+def _data_request(query, config):
+  """Validate a /data query.
+
+  Returns (normalized query, info, None) or (None, None, error response).
+  """
+
   error = _query_error('data', query, config)
   if error:
     logger.debug(f"_query_error() returned error: {error}")
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
 
   catalog, error = _get_catalog(query, config)
   if error:
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
 
   query = _normalize_query('data', query)
 
   error = _dataset_error(query['dataset'], catalog)
   if error:
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
 
   info, error = _get_info(query, config)
   if error:
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
 
   error = _parameters_error(query.get('parameters', ''), info)
   if error:
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
 
   error = _start_stop_error('data', query, config, info)
   if error:
-    return hapiserver.error(error, config)
+    return None, None, hapiserver.error(error, config)
+
+  return query, info, None
 
-  data, error = call('data', query, config)
+
+def _data_response(query, config, info):
+  """Call the data script or function for a query from _data_request().
+
+  The content of the response is as returned by the script or function;
+  pass it through _data_stream() before sending it.
+
+  The server adds the header for include=header (see _data_header()), so
+  include is not passed to the script or function, which must not write a
+  header (e.g., a script argument template with {include} gets '').
+  """
+
+  backend_query = {k: v for k, v in query.items() if k != 'include'}
+  if _transcode_format(query, config) is not None:
+    # Request CSV and transcode it in _data_stream().
+    try:
+      _transcoder(query, info, config)
+    except ValueError as e:
+      message = f"Cannot produce format={query['format']} for this dataset: {e}"
+      error = {"code": 1500, "message": message, "message_console": message}
+      return hapiserver.error(error, config)
+    backend_query = {k: v for k, v in backend_query.items() if k != 'format'}
+
+  data, error = call('data', backend_query, config)
   if error:
     return hapiserver.error(error, config)
 
@@ -240,6 +375,210 @@ def data(query, config):
   return response
 
 
+def _data_stream(content, query, info, config):
+  """Return the content of a /data response as it is to be sent.
+
+  Chunks from data functions are coalesced (see hapiserver.coalesce), if
+  the requested format is not produced by the script or function, CSV is
+  transcoded (see hapiserver.transcode), and, for include=header, the
+  header is prepended as the first chunk. str or bytes content is
+  returned as str or bytes.
+  """
+  stream = content
+  coalesce = hapiserver.coalesce.options(config)
+  complete = isinstance(content, (str, bytes))
+  if coalesce is not None and 'data' in config.get('functions', {}) and not complete:
+    # Join small chunks (e.g., one CSV line per yield) so that each is not
+    # sent in its own message. Script output is already chunked (see
+    # exec._stream()).
+    stream = hapiserver.coalesce.coalesce(stream, **coalesce)
+
+  transcoder = _transcoder(query, info, config)
+  if transcoder is not None:
+    if complete:
+      stream = b''.join(transcoder([content]))
+    else:
+      stream = transcoder(stream)
+
+  header = _data_header(query, info)
+  if header is not None:
+    if isinstance(stream, str):
+      stream = stream.encode('utf-8')
+    if isinstance(stream, bytes):
+      return header + stream
+    stream = _prepend(header, stream)
+
+  return stream
+
+
+def _data_header(query, info):
+  """The '#'-prefixed header for include=header as bytes, or None.
+
+  Serialized once per cached info, format, and parameters. None if
+  include=header is not requested or for format=json, which always has
+  the header.
+  """
+  import json
+
+  format = query.get('format', 'csv')
+  if query.get('include') != 'header' or format == 'json':
+    return None
+
+  parameters = query.get('parameters', '')
+  def compile(info):
+    content = json.dumps({**_info_header(info, parameters), "format": format}, indent=2)
+    return ''.join(f"#{line}\n" for line in content.split('\n')).encode('utf-8')
+
+  return hapiserver.cache.derived(info, 'header', compile, key=(format, parameters))
+
+
+def _prepend(chunk, stream):
+  """Return a generator that yields chunk and then the chunks of stream."""
+  if hasattr(stream, '__aiter__'):
+    async def prepend():
+      try:
+        yield chunk
+        async for item in stream:
+          yield item
+      finally:
+        if hasattr(stream, 'aclose'):
+          await stream.aclose()
+  else:
+    def prepend():
+      try:
+        yield chunk
+        yield from stream
+      finally:
+        if hasattr(stream, 'close'):
+          stream.close()
+  return prepend()
+
+
+def _info_header(info, parameters):
+  """/info response content for the comma-separated parameters."""
+  return {
+    "HAPI": hapiserver.HAPI_VERSION,
+    "status": {
+      "code": 1200,
+      "message": "OK"
+    },
+    **info,
+    "parameters": _info_parameters(info, parameters)
+  }
+
+
+def _output_formats(config):
+  """Formats advertised in /capabilities.
+
+  These are the formats produced by the data script or function, given by
+  capabilities.outputFormats in the config (default ['csv']), and, if it
+  produces CSV, the formats that CSV is transcoded to.
+  """
+  formats = config.get('capabilities', {}).get('outputFormats', ['csv'])
+  if 'csv' in formats and config.get('transcode', True):
+    formats = formats + [f for f in hapiserver.transcode.FORMATS if f not in formats]
+  return formats
+
+
+def _transcode_format(query, config):
+  """Format that CSV from the data script or function is transcoded to, or None."""
+  format = query.get('format', 'csv')
+  if format in config.get('capabilities', {}).get('outputFormats', ['csv']):
+    return None
+  return format
+
+
+def _transcoder(query, info, config):
+  """Return a function that transcodes a CSV stream for query, or None.
+
+  The record layout is computed once per cached info and recently
+  requested parameters.
+  Raises ValueError if the parameters cannot be transcoded.
+  """
+  format = _transcode_format(query, config)
+  if format is None:
+    return None
+
+  parameters = query.get('parameters', '')
+  def compile(info):
+    return hapiserver.transcode.layout(format, _info_header(info, parameters))
+  layout = hapiserver.cache.derived(info, 'layout', compile, key=(format, parameters))
+
+  return lambda stream: hapiserver.transcode.transcode(stream, format, layout)
+
+
+def _data_cost(query, info, default_cadence=60):
+  """Estimated number of values in the /data response for query.
+
+  The estimate is (stop - start) / cadence times the number of values per
+  record for the requested parameters (all parameters if none are
+  requested). If info has no valid cadence, default_cadence (seconds) is
+  used. Used to schedule requests (see hapiserver.admission).
+  """
+
+  def compile(info):
+    from utilrsw.time import isoduration_to_timedelta
+
+    widths = {}
+    for parameter in info.get('parameters', []):
+      width = 1
+      for n in parameter.get('size', [1]):
+        width *= n
+      widths[parameter['name']] = width
+
+    cadence = None
+    if 'cadence' in info:
+      try:
+        cadence = isoduration_to_timedelta(info['cadence']).total_seconds()
+      except Exception as e:
+        logger.warning(f"Invalid cadence in info: {info['cadence']}. Error: {e}")
+
+    return {"widths": widths, "cadence": cadence}
+
+  compiled = hapiserver.cache.derived(info, 'cost', compile)
+  widths = compiled['widths']
+  cadence = compiled['cadence'] or default_cadence
+
+  if query.get('parameters'):
+    names = query['parameters'].split(',')
+    # The time parameter is always included.
+    names = [*_info_index(info)['names'][:1], *names]
+  else:
+    names = widths.keys()
+  width = sum(widths.get(name, 1) for name in set(names))
+
+  duration = (query['stop_datetime'] - query['start_datetime']).total_seconds()
+  return max(duration / cadence, 1) * width
+
+
+def _prepare(response, last_modified=None):
+  """Return response with content encoded as bytes and validator headers.
+
+  A strong ETag is computed from the content. Last-Modified is set to
+  last_modified (seconds since epoch) or the current time. Used for
+  responses that are built once and served many times and for which
+  clients may send conditional requests (see app._response()).
+  """
+  import time
+  import hashlib
+  import email.utils
+
+  content = response['content']
+  if isinstance(content, str):
+    content = content.encode('utf-8')
+
+  if last_modified is None:
+    last_modified = time.time()
+
+  headers = {
+    **response.get('headers', {}),
+    "ETag": f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"',
+    "Last-Modified": email.utils.formatdate(last_modified, usegmt=True)
+  }
+
+  return {**response, "content": content, "headers": headers}
+
+
 def _data_media_type(format):
   if format == 'csv':
     return 'text/csv'
@@ -262,13 +601,90 @@ def _headers(config, cors=True):
   return headers
 
 
+def _catalog_index(catalog):
+  """Set of dataset ids in catalog (computed once per cached catalog)."""
+  return hapiserver.cache.derived(
+    catalog, 'ids', lambda catalog: frozenset(dataset['id'] for dataset in catalog)
+  )
+
+
+def _info_index(info):
+  """Parameter lookup tables for info (computed once per cached info).
+
+  Returns a dict with keys 'names' (list of parameter names in /info order)
+  and 'positions' (dict mapping parameter name to position in 'names').
+  """
+  def compile(info):
+    names = [p['name'] for p in info.get('parameters', [])]
+    positions = {}
+    for position, name in enumerate(names):
+      positions.setdefault(name, position)
+    return {"names": names, "positions": positions}
+
+  return hapiserver.cache.derived(info, 'index', compile)
+
+
+def _info_parameters(info, parameters):
+  """Parameters of info in a response for the comma-separated parameters.
+
+  The first (time) parameter is always included. Computed once per cached
+  info and recently requested value of parameters.
+  """
+  if not parameters:
+    return info['parameters']
+
+  def compile(info):
+    names = set(parameters.split(','))
+    if info['parameters']:
+      names.add(info['parameters'][0]['name'])
+    return [p for p in info['parameters'] if p['name'] in names]
+
+  return hapiserver.cache.derived(info, 'parameters', compile, key=parameters)
+
+
+def _info_dates(info):
+  """Parsed info startDate and stopDate (computed once per cached info).
+
+  Returns a dict with keys 'start' and 'stop' and values (datetime, None)
+  or (None, error) if the value is missing or invalid.
+  """
+  def compile(info):
+    import hapiclient
+
+    dates = {}
+    for name in ['start', 'stop']:
+      key = f'{name}Date'
+      if key not in info:
+        msg = f"Missing {key} in info"
+        dates[name] = (None, {"code": 1500, "message": msg, "message_console": msg})
+        continue
+
+      try:
+        dt = hapiclient.hapitime2datetime(info[key], allow_missing_Z=True)[0]
+        dates[name] = (dt, None)
+      except Exception as e:
+        msg = f"Invalid value for {key} in info: {info[key]}"
+        error = {
+          "code": 1500,
+          "message": msg,
+          "message_console": f"{msg}. Error: {e}"
+        }
+        dates[name] = (None, error)
+
+    return dates
+
+  return hapiserver.cache.derived(info, 'dates', compile)
+
+
 def _parameters_error(parameters, info):
   if not parameters:
     return None
 
-  info_parameters = [p['name'] for p in info['parameters']]
+  index = _info_index(info)
+  info_parameters = index['names']
+  positions = index['positions']
   query_parameters = parameters.split(',')
-  invalid_parameters = [p for p in query_parameters if p not in info_parameters]
+  invalid_parameters = [p for p in query_parameters if p not in positions]
   if invalid_parameters:
     error = {
       "code": 1407,
@@ -277,10 +693,12 @@ def _parameters_error(parameters, info):
     }
     return error
 
-  duplicate_parameters = [
-    p for p in dict.fromkeys(query_parameters)
-    if query_parameters.count(p) > 1
-  ]
+  seen = set()
+  duplicate_parameters = {}
+  for p in query_parameters:
+    if p in seen:
+      duplicate_parameters[p] = None
+    seen.add(p)
   if duplicate_parameters:
     error = {
       "code": 1411,
@@ -289,29 +707,30 @@ def _parameters_error(parameters, info):
     }
     return error
 
-  ordered_parameters = query_parameters
-  if info_parameters and info_parameters[0] not in ordered_parameters:
-    ordered_parameters = [info_parameters[0]] + ordered_parameters
-
-  parameter_indices = [info_parameters.index(p) for p in ordered_parameters]
-  if parameter_indices != sorted(parameter_indices):
-    error = {
-      "code": 1411,
-      "message": (
-        "Parameters out of order. Must follow the order defined in /info: "
-        f"{', '.join(info_parameters)}"
-      ),
-      "message_console": f"Parameters out of order: {', '.join(query_parameters)}"
-    }
-    return error
+  # The first (time) parameter is always included, so it is implicitly
+  # first in the requested list.
+  last = 0
+  for p in query_parameters:
+    position = positions[p]
+    if position < last:
+      error = {
+        "code": 1411,
+        "message": (
+          "Parameters out of order. Must follow the order defined in /info: "
+          f"{', '.join(info_parameters)}"
+        ),
+        "message_console": f"Parameters out of order: {', '.join(query_parameters)}"
+      }
+      return error
+    last = position
 
   return None
 
 
 def _dataset_error(dataset_id, catalog):
 
-  dataset_ids = [dataset['id'] for dataset in catalog]
-  if dataset_id not in dataset_ids:
+  if dataset_id not in _catalog_index(catalog):
+    dataset_ids = [dataset['id'] for dataset in catalog]
     error = {
       "code": 1406,
       "message": f"Invalid dataset. Allowed datasets: {', '.join(dataset_ids)}",
@@ -348,27 +767,13 @@ def _start_stop_error(endpoint, query, config, info):
     }
     return error
 
+  dates = _info_dates(info)
   info_normalized_datetime = {}
   for name in ['start', 'stop']:
-    key = f'{name}Date'
-    if key not in info:
-      msg = f"Missing {key} in info"
-      return {
-        "code": 1500,
-        "message": msg,
-        "message_console": msg
-      }
-
-    try:
-      info_normalized_datetime[name] = hapiclient.hapitime2datetime(info[key], allow_missing_Z=True)[0]
-    except Exception as e:
-      msg = f"Invalid value for {key} in info: {info[key]}"
-      error = {
-        "code": 1500,
-        "message": msg,
-        "message_console": f"{msg}. Error: {e}"
-      }
+    dt, error = dates[name]
+    if error:
       return error
+    info_normalized_datetime[name] = dt
 
   a = query['start_datetime'] < info_normalized_datetime['start']
   b = query['stop_datetime'] > info_normalized_datetime['stop']
@@ -473,7 +878,7 @@ def _info_query_error(query, config):
 
 
 def _data_query_error(query, config):
-  output_formats = config.get('capabilities', {}).get('outputFormats', ['csv'])
+  output_formats = _output_formats(config)
   if 'format' in query and query['format'] not in output_formats:
     return {
       "code": 1409,
@@ -32,13 +32,14 @@ def error(error, config):
         facing message, defaults to the standard message for the code),
         'message_console' (message logged instead of 'message'), and
         'exception' (an exception whose str() is appended to the logged
-        message).
+        message). 'status_code' and 'headers' override the HTTP status
+        code for the HAPI code and add response headers.
       config (dict): The resolved server config (currently unused, reserved
         for future per-server error customization).
 
   Returns:
       dict: kwargs for fastapi.responses.Response (status_code, content,
-      media_type).
+      media_type, and headers if given).
   """
 
   if 'message' not in error:
@@ -82,11 +83,14 @@ def error(error, config):
     status_code = 500
 
   response = {
-    "status_code": status_code,
+    "status_code": error.get('status_code', status_code),
     "content": json.dumps(content, indent=2),
     "media_type": "application/json",
   }
 
+  if 'headers' in error:
+    response['headers'] = error['headers']
+
   return response
 
 
@@ -1,3 +1,4 @@
+import io
 import os
 import sys
 import logging
@@ -5,7 +6,29 @@ import subprocess
 
 logger = logging.getLogger(__name__)
 
-def exec(script, args="", stream=None):
+def exec(script, args="", stream=None, options=None):
+  """Execute an endpoint script.
+
+  Args:
+      script (str): Path to the script.
+      args (str or list): Command line arguments for the script.
+      stream (dict or None): If None, wait for the script to finish and
+        return its stdout. Otherwise, return a generator function that
+        yields stdout as it is written (see _stream() for options).
+      options (dict or None): How the script is executed (from
+        config['exec'][endpoint]). options['mode'] is one of
+          'python' (default): run `python script args` for each call.
+          'worker': run the script in a persistent worker process (see
+            hapiserver.worker).
+          'fork': run the script in a process forked from a server that
+            has imported the script's dependencies (see hapiserver.worker).
+          'direct': run the program without the Python interpreter (for
+            compiled or non-Python programs). The program must be
+            executable or start with a #! line.
+
+  Returns:
+      (str or generator function, None) or (None, error dict)
+  """
 
   if not os.path.exists(script):
     content = "Execution script not found"
@@ -16,111 +39,747 @@ def exec(script, args="", stream=None):
     }
     return None, error
 
+  if _command(script, [], options) is None:
+    content = "Execution script is not executable"
+    error = {
+      "code": 1500,
+      "message": content,
+      "message_console": f"{content} and has no #! line: {script}"
+    }
+    return None, error
+
   if stream is None:
     # Note that if stream_stdout=False, stderr will not be streamed either,
     # even if stream_stderr=True.
     logger.debug("Executing script in non-streaming mode")
-    return _read(script, args)
+    return _read(script, args, options=options)
+  elif stream.get('async', False):
+    logger.debug("Executing script in asyncio streaming mode")
+    return _astream(script, args, stream=stream, options=options)
   else:
     logger.debug("Executing script in streaming mode")
-    return _stream(script, args, stream=stream)
+    return _stream(script, args, stream=stream, options=options)
+
+
+def _mode(options):
+  return (options or {}).get('mode', 'python')
+
+
+def _command(script, args, options=None):
+  """Return the command line that runs script with args in a subprocess.
+
+  Returns None if the script cannot be run in direct mode.
+  """
+  if _mode(options) != 'direct':
+    return [sys.executable, script, *args]
+
+  if os.access(script, os.X_OK):
+    # The operating system handles any #! line.
+    return [os.path.abspath(script), *args]
+
+  try:
+    with open(script, 'rb') as f:
+      line = f.readline(256)
+  except OSError:
+    return None
+  if not line.startswith(b'#!'):
+    return None
+  # As on Linux, the #! line is the interpreter and at most one argument.
+  interpreter = line[2:].decode(errors='replace').strip().split(None, 1)
+  if not interpreter:
+    return None
+  return [*interpreter, script, *args]
+
+
+def _popen(script, args, options=None, **kwargs):
+  """Start script and return a Popen-like object with stdout/stderr pipes."""
+  if _mode(options) in ['worker', 'fork']:
+    from hapiserver import worker
+    return worker.pool(script, options).run(args, **kwargs)
+
+  call = _command(script, args, options)
+  logger.info(f"Executing: {' '.join(call)}")
+  return subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+
+def _communicate(stdout, stderr):
+  """Read two pipes until EOF without blocking on either one."""
+  import selectors
+
+  chunks = {stdout: [], stderr: []}
+  selector = selectors.DefaultSelector()
+  for pipe in chunks:
+    selector.register(pipe, selectors.EVENT_READ)
+  try:
+    while selector.get_map():
+      for key, _ in selector.select():
+        data = os.read(key.fileobj.fileno(), 65536)
+        if data:
+          chunks[key.fileobj].append(data)
+        else:
+          selector.unregister(key.fileobj)
+          key.fileobj.close()
+  finally:
+    selector.close()
 
+  output = []
+  for pipe in [stdout, stderr]:
+    data = b''.join(chunks[pipe])
+    if isinstance(pipe, io.TextIOBase):
+      data = ''.join(_decode_chunks([data]))
+    output.append(data)
+  return output
 
-def _read(script, args=""):
+
+def _read(script, args="", options=None):
 
   if isinstance(args, str):
     args = args.split()
-  call = [sys.executable, script, *args]
-  logger.info(f"Executing: {' '.join(call)}")
   try:
-    kwargs = {
-        "stdout": subprocess.PIPE,
-        "stderr": subprocess.PIPE,
-        "text": True,
-        "check": True,
-    }
-    result = subprocess.run(call, **kwargs)
-    if result.stderr:
-      logger.debug(f"Script stderr (ignored): \n{result.stderr}")
-    return result.stdout, None
+    proc = _popen(script, args, options=options, text=True)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode, proc.args, output=stdout, stderr=stderr)
+    if stderr:
+      logger.debug(f"Script stderr (ignored): \n{stderr}")
+    return stdout, None
   except Exception as e:
-    message = "Execution of script failed"
-    error = {
-      "code": 1500,
-      "message": message,
-      "message_console": str(getattr(e, "stderr", None)),
-      "exception": e
-    }
-    return None, error
+    return None, _error(e)
+
+
+def _error(e):
+  message = "Execution of script failed"
+  error = {
+    "code": 1500,
+    "message": message,
+    "message_console": str(getattr(e, "stderr", None)),
+    "exception": e
+  }
+  if isinstance(e, TimeoutError):
+    # No worker was free (see worker.Pool); the client may retry.
+    error['message_console'] = message
+    error['status_code'] = 503
+  return error
 
 
-def _stream(script, args="", stream=None):
+def _stream(script, args="", stream=None, options=None):
+  """Execute script and return a generator function that yields its stdout.
 
-  stream_stderr = stream.get('stderr', False)
-  chunk_size = stream.get('chunk_size', 1000000)
+  Options in the stream dict:
+    chunk_size: Yield output in chunks of up to this many characters. If
+      0, yield one line at a time. Default 1000000.
+    max_buffer: Maximum number of characters held in memory at once; caps
+      chunk_size and, in line mode, the length of a yielded line (longer
+      lines are yielded in pieces). Default 16777216.
+    stderr: If True, log stderr lines as they are written, at most
+      stderr_rate lines per second (excess lines are counted and the
+      count is logged). Otherwise, keep the last stderr_lines lines and
+      log them after the script exits. Default False.
+    stderr_rate: See stderr. Default 10.
+    stderr_lines: See stderr. Default 100.
+    bytes: If True, read stdout as bytes and yield it unchanged (no
+      decoding or newline translation); sizes above are then in bytes.
+      Use for binary output or when the consumer sends bytes to a socket.
+      Default False.
+    flush_interval: If chunk_size > 0, yield buffered output when it
+      reaches chunk_size or when this many seconds have passed since the
+      first unyielded byte was read, whichever comes first. This bounds
+      the time to first byte for slow scripts. Set to 0 to always wait for
+      a full chunk (or EOF). Default 0.25.
+    start_timeout: Maximum number of seconds the start() method of the
+      stream waits for the first output (see below). Set to 0 to wait
+      until the script writes to stdout or exits. Default 1.
+
+  Call the start() method of the stream before responding. If the script
+  exits with a non-zero code without writing to stdout within
+  start_timeout, start() raises subprocess.CalledProcessError, in time to
+  return an error response (see call._call_script()). If the script fails
+  later, the response status has already been sent, so the error is
+  logged and "Script exited with code N" is yielded as the last chunk,
+  after any partial output.
+
+  stdout and stderr are read concurrently by one selector loop in the
+  thread that iterates the generator (see _pump()), so a script that
+  writes a lot to stderr cannot fill the stderr pipe and stall. On
+  Windows, where pipes cannot be polled, stderr is read after stdout is
+  closed and flush_interval is not used.
+  """
+
+  text = not stream.get('bytes', False)
+  eof = '' if text else b''
+  max_buffer = stream.get('max_buffer', 16777216)
+  chunk_size = min(stream.get('chunk_size', 1000000), max_buffer)
+  flush_interval = stream.get('flush_interval', 0.25)
+  pump = os.name != 'nt'
 
   if isinstance(args, str):
     args = args.split()
 
-  call = [sys.executable, script, *args]
-  logger.info(f"Executing: {' '.join(call)}")
-
   try:
     kwargs = {
-        "stdout": subprocess.PIPE,
-        "stderr": subprocess.PIPE,
-        "bufsize": -1 if chunk_size > 0 else 1,
-        "text": True,
+        "bufsize": -1 if chunk_size > 0 or not text else 1,
+        "text": text,
     }
-    proc = subprocess.Popen(call, **kwargs)
+    if pump:
+      # _pump() reads the file descriptors directly, so the pipes must not
+      # be wrapped in a buffer or decoder.
+      kwargs['bufsize'] = 0
+      kwargs['text'] = False
+    proc = _popen(script, args, options=options, **kwargs)
   except Exception as e:
-    message = "Execution of script failed"
-    error = {
-      "code": 1500,
-      "message": message,
-      "message_console": str(getattr(e, "stderr", None)),
-      "exception": e
-    }
-    return None, error
+    return None, _error(e)
 
   def stream_output():
 
-    if stream_stderr:
-      import threading
-      def _drain_stderr():
-        for line in proc.stderr:
-          logger.error(f"Script stderr: {line.rstrip()}")
-        proc.stderr.close()
-      stderr_thread = threading.Thread(target=_drain_stderr, daemon=True)
-      stderr_thread.start()
-
+    log = _StderrLog(stream)
+    written = False
     try:
-      if chunk_size > 0:
-        # stream stdout lines or chunks as they arrive
-        for chunk in iter(lambda: proc.stdout.read(chunk_size), ''):
+      if pump:
+        chunks = _pump(
+          proc.stdout.fileno(),
+          proc.stderr.fileno(),
+          log,
+          chunk_size,
+          flush_interval,
+          max_buffer
+        )
+        if text:
+          chunks = _decode_chunks(chunks)
+        for chunk in chunks:
+          written = True
           yield chunk
       else:
-        for line in proc.stdout:
-          yield line
+        if chunk_size > 0:
+          # stream stdout lines or chunks as they arrive
+          chunks = iter(lambda: proc.stdout.read(chunk_size), eof)
+        else:
+          chunks = iter(lambda: proc.stdout.readline(max_buffer), eof)
+        for chunk in chunks:
+          written = True
+          yield chunk
+        for data in iter(lambda: proc.stderr.read(65536), eof):
+          log.write(data)
       proc.stdout.close()
-
-      if stream_stderr:
-        # Print stderr lines as stdout is streamed
-        stderr_thread.join()
-      else:
-        # Print stderr lines after stdout has been streamed
-        for line in proc.stderr:
-          print(f"Script stderr: {line.rstrip()}")
-        proc.stderr.close()
+      proc.stderr.close()
 
       returncode = proc.wait()
+      log.close()
       if returncode != 0:
-        emsg = f"Script exited with code {returncode}"
-        logger.error(emsg)
-        yield emsg
+        if not written:
+          raise subprocess.CalledProcessError(returncode, proc.args)
+        yield _exit_message(returncode, text)
 
     finally:
       if proc.poll() is None:
         proc.kill()
 
-  return stream_output, None
+  return lambda: _ProcessStream(stream_output(), proc, stream), None
+
+
+class _ProcessStream:
+  """Iterator over chunks of process output that can be stopped from any thread.
+
+  kill() makes a read that is blocked waiting for output return, so a
+  thread iterating the stream is released promptly (e.g., when the HTTP
+  client disconnects).
+
+  stream is the dict of stream options (see _stream()).
+  """
+
+  def __init__(self, chunks, proc, stream=None):
+    stream = stream or {}
+    self._chunks = chunks
+    self._proc = proc
+    self._text = not stream.get('bytes', False)
+    self._start_timeout = stream.get('start_timeout', 1)
+    self._first = []
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._first:
+      return self._first.pop()
+    try:
+      return next(self._chunks)
+    except subprocess.CalledProcessError as e:
+      # Failed without output after start() stopped waiting, so the
+      # response has started.
+      return _exit_message(e.returncode, self._text)
+
+  def start(self):
+    """Wait until the script writes to stdout or exits, for at most start_timeout.
+
+    The chunk read, if any, is returned by the next call to next(). Raises
+    subprocess.CalledProcessError if the script exited with a non-zero
+    code without writing to stdout. On Windows, where pipes cannot be
+    polled, waits without a time limit.
+    """
+    import select
+
+    if self._start_timeout > 0 and os.name != 'nt':
+      readable, _, _ = select.select([self._proc.stdout], [], [], self._start_timeout)
+      if not readable:
+        logger.info(f"No output from process {self._proc.pid} after {self._start_timeout} s")
+        return
+    for chunk in self._chunks:
+      self._first.append(chunk)
+      break
+
+  def kill(self):
+    if self._proc.poll() is None:
+      logger.info(f"Killing process {self._proc.pid}")
+      self._proc.kill()
+
+  def close(self):
+    self.kill()
+    try:
+      self._chunks.close()
+    except ValueError:
+      # Being iterated in another thread; it ends when the read returns.
+      pass
+
+
+def _exit_message(returncode, text):
+  emsg = f"Script exited with code {returncode}"
+  logger.error(emsg)
+  return emsg if text else emsg.encode()
+
+
+def _decode(line):
+  if isinstance(line, bytes):
+    return line.decode(errors='replace')
+  return line
+
+
+def _astream(script, args="", stream=None, options=None):
+  """Like _stream(), but return an async generator function.
+
+  The script is started before returning, so that a failure to start it
+  is returned as an error, as for _stream(). Its stdout and stderr are
+  read on the event loop that iterates the generator, so a streaming
+  response does not occupy a thread while it waits for output. Accepts
+  the same stream options as _stream(); stderr is read by a task on the
+  same event loop.
+  """
+
+  text = not stream.get('bytes', False)
+  max_buffer = stream.get('max_buffer', 16777216)
+  chunk_size = min(stream.get('chunk_size', 1000000), max_buffer)
+  flush_interval = stream.get('flush_interval', 0.25)
+
+  if isinstance(args, str):
+    args = args.split()
+
+  try:
+    # The pipes are read directly by the event loop, so they must not be
+    # wrapped in a buffer or decoder.
+    proc = _AsyncProcess(_popen(script, args, options=options, bufsize=0))
+  except Exception as e:
+    return None, _error(e)
+
+  async def stream_output():
+    import asyncio
+
+    # Allow lines up to max_buffer bytes in line mode.
+    limit = max_buffer if chunk_size == 0 else 2 ** 16
+    stderr_task = None
+    try:
+      await proc.connect(limit)
+      stderr_task = asyncio.ensure_future(_alog_stderr(proc.stderr, _StderrLog(stream)))
+
+      if chunk_size > 0:
+        chunks = _apump(proc.stdout, chunk_size, flush_interval)
+      else:
+        chunks = _alines(proc.stdout, max_buffer)
+      decoder = _decoder() if text else None
+      written = False
+      async for chunk in chunks:
+        if decoder:
+          chunk = decoder.decode(chunk)
+          if not chunk:
+            continue
+        written = True
+        yield chunk
+      if decoder:
+        chunk = decoder.decode(b'', final=True)
+        if chunk:
+          written = True
+          yield chunk
+
+      await stderr_task
+      returncode = await proc.wait()
+      if returncode != 0:
+        if not written:
+          raise subprocess.CalledProcessError(returncode, proc.args)
+        yield _exit_message(returncode, text)
+
+    finally:
+      if stderr_task is not None:
+        stderr_task.cancel()
+      await proc.close()
+
+  return lambda: _AsyncProcessStream(stream_output(), proc, stream), None
+
+
+class _AsyncProcessStream:
+  """Async iterator over chunks of process output; see _ProcessStream.
+
+  kill() may be called from any thread. aclose() also stops and reaps the
+  process if iteration never started.
+  """
+
+  def __init__(self, chunks, proc, stream=None):
+    stream = stream or {}
+    self._chunks = chunks
+    self._proc = proc
+    self._text = not stream.get('bytes', False)
+    self._start_timeout = stream.get('start_timeout', 1)
+    self._first = []
+    # Read of the first chunk, if start() stopped waiting for it.
+    self._read = None
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if self._first:
+      return self._first.pop()
+    try:
+      if self._read is not None:
+        read, self._read = self._read, None
+        return await read
+      return await self._chunks.__anext__()
+    except subprocess.CalledProcessError as e:
+      return _exit_message(e.returncode, self._text)
+
+  async def start(self):
+    """Like _ProcessStream.start(); must be awaited on the event loop that iterates the stream."""
+    import asyncio
+
+    async def first():
+      return await self._chunks.__anext__()
+
+    self._read = asyncio.ensure_future(first())
+    done, _ = await asyncio.wait({self._read}, timeout=self._start_timeout or None)
+    if not done:
+      # The read continues; its chunk is returned by __anext__().
+      logger.info(f"No output from process {self._proc.pid} after {self._start_timeout} s")
+      return
+    read, self._read = self._read, None
+    try:
+      self._first.append(read.result())
+    except StopAsyncIteration:
+      pass
+
+  def kill(self):
+    self._proc.kill()
+
+  async def aclose(self):
+    import asyncio
+
+    if self._read is not None:
+      self._read.cancel()
+      try:
+        await self._read
+      except (Exception, asyncio.CancelledError):
+        pass
+      self._read = None
+    await self._chunks.aclose()
+    await self._proc.close()
+
+
+class _AsyncProcess:
+  """asyncio.subprocess.Process-like wrapper of a _popen() object.
+
+  The process is started by _popen() in the calling thread (for workers,
+  it is a run in a worker; see hapiserver.worker). Its pipes are read on
+  the event loop after connect(), and only waiting for the exit code uses
+  the default thread pool executor.
+  """
+
+  def __init__(self, proc):
+    self._proc = proc
+    self.args = proc.args
+    self.pid = proc.pid
+    self.stdout = None
+    self.stderr = None
+
+  async def connect(self, limit):
+    self.stdout = await self._reader(self._proc.stdout, limit)
+    self.stderr = await self._reader(self._proc.stderr, limit)
+
+  @staticmethod
+  async def _reader(pipe, limit):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=limit)
+    protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: protocol, pipe)
+    return reader
+
+  @property
+  def returncode(self):
+    return self._proc.returncode
+
+  async def wait(self):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, self._proc.wait)
+
+  def kill(self):
+    if self._proc.poll() is None:
+      logger.info(f"Killing process {self.pid}")
+      try:
+        self._proc.kill()
+      except ProcessLookupError:
+        pass
+
+  async def close(self):
+    """Kill the process if it is running and reap it."""
+    import asyncio
+
+    self.kill()
+    if self.stdout is None:
+      # Not connected to the event loop, which would close the pipes.
+      self._proc.stdout.close()
+      self._proc.stderr.close()
+    if self._proc.returncode is None:
+      try:
+        await self.wait()
+      except (Exception, asyncio.CancelledError):
+        pass
+
+
+async def _apump(reader, chunk_size, flush_interval):
+  """Async version of _pump() that reads from an asyncio.StreamReader."""
+  import asyncio
+
+  loop = asyncio.get_running_loop()
+  buffer = bytearray()
+  deadline = None
+  read = None
+  try:
+    while True:
+      if read is None:
+        read = asyncio.ensure_future(reader.read(min(65536, chunk_size - len(buffer))))
+      timeout = None
+      if buffer and flush_interval > 0:
+        timeout = max(0, deadline - loop.time())
+      done, _ = await asyncio.wait({read}, timeout=timeout)
+      if done:
+        data = read.result()
+        read = None
+        if not data:
+          break
+        if not buffer:
+          deadline = loop.time() + flush_interval
+        buffer += data
+      full = len(buffer) >= chunk_size
+      if buffer and (full or (flush_interval > 0 and loop.time() >= deadline)):
+        yield bytes(buffer)
+        buffer.clear()
+    if buffer:
+      yield bytes(buffer)
+  finally:
+    if read is not None:
+      read.cancel()
+
+
+async def _alines(reader, max_buffer):
+  """Yield lines (of at most max_buffer bytes) from an asyncio.StreamReader."""
+  import asyncio
+
+  while True:
+    try:
+      line = await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as e:
+      # EOF
+      if e.partial:
+        yield e.partial
+      return
+    except asyncio.LimitOverrunError:
+      line = await reader.read(max_buffer)
+    while len(line) > max_buffer:
+      yield line[:max_buffer]
+      line = line[max_buffer:]
+    if line:
+      yield line
+
+
+async def _alog_stderr(reader, log):
+  while True:
+    data = await reader.read(65536)
+    if not data:
+      break
+    log.write(data)
+  log.close()
+
+
+class _StderrLog:
+  """Bounded, rate-limited logging of a script's stderr.
+
+  Lines are logged as they are written (stream['stderr'] True) or the
+  last stream['stderr_lines'] lines are kept and logged on close(). Lines
+  longer than max_line characters are truncated.
+  """
+
+  max_line = 4096
+
+  def __init__(self, stream):
+    import collections
+
+    self.live = stream.get('stderr', False)
+    self.rate = stream.get('stderr_rate', 10)
+    self._lines = collections.deque(maxlen=stream.get('stderr_lines', 100))
+    self._count = 0
+    self._suppressed = 0
+    self._partial = bytearray()
+    self._truncated = False
+    self._tokens = self.rate
+    self._last = None
+
+  def write(self, data):
+    if isinstance(data, str):
+      data = data.encode()
+    while data:
+      i = data.find(b'\n')
+      if i < 0:
+        self._append(data)
+        break
+      self._append(data[:i])
+      self._line()
+      data = data[i + 1:]
+
+  def close(self):
+    if self._partial or self._truncated:
+      self._line()
+    if self._suppressed:
+      logger.error(f"Script stderr: {self._suppressed} line(s) not logged (limit is {self.rate} lines/s)")
+      self._suppressed = 0
+    if not self.live:
+      omitted = self._count - len(self._lines)
+      if omitted:
+        logger.error(f"Script stderr: first {omitted} line(s) omitted")
+      for line in self._lines:
+        logger.error(f"Script stderr: {line}")
+      self._lines.clear()
+      self._count = 0
+
+  def _append(self, data):
+    room = self.max_line - len(self._partial)
+    if len(data) > room:
+      data = data[:max(room, 0)]
+      self._truncated = True
+    self._partial += data
+
+  def _line(self):
+    import time
+
+    line = _decode(bytes(self._partial)).rstrip()
+    if self._truncated:
+      line += " [truncated]"
+    self._partial.clear()
+    self._truncated = False
+    self._count += 1
+
+    if not self.live:
+      self._lines.append(line)
+      return
+
+    now = time.monotonic()
+    if self._last is not None:
+      self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+    self._last = now
+    if self._tokens >= 1:
+      self._tokens -= 1
+      logger.error(f"Script stderr: {line}")
+    else:
+      self._suppressed += 1
+
+
+def _pump(stdout, stderr, log, chunk_size, flush_interval, max_buffer=16777216):
+  """Yield bytes read from the stdout fd and write stderr fd data to log.
+
+  Both file descriptors are read with one selector as data arrives, so
+  neither pipe can fill up while the other is being read. If chunk_size >
+  0, a chunk is yielded when chunk_size bytes are buffered or, if
+  flush_interval > 0, when flush_interval seconds have passed since the
+  first byte in the buffer was read. If chunk_size is 0, lines are yielded
+  (lines longer than max_buffer in pieces). Returns when both pipes are
+  closed.
+  """
+  import time
+  import selectors
+
+  limit = chunk_size if chunk_size > 0 else max_buffer
+  selector = selectors.DefaultSelector()
+  selector.register(stdout, selectors.EVENT_READ)
+  selector.register(stderr, selectors.EVENT_READ)
+  buffer = bytearray()
+  deadline = None
+  try:
+    while selector.get_map():
+      timeout = None
+      if deadline is not None:
+        timeout = max(0, deadline - time.monotonic())
+      for key, _ in selector.select(timeout):
+        if key.fd == stderr:
+          data = os.read(stderr, 65536)
+          if data:
+            log.write(data)
+          else:
+            selector.unregister(stderr)
+          continue
+
+        data = os.read(stdout, min(65536, limit - len(buffer)))
+        if not data:
+          selector.unregister(stdout)
+          if buffer:
+            yield bytes(buffer)
+            buffer.clear()
+          deadline = None
+          continue
+        if not buffer and chunk_size > 0 and flush_interval > 0:
+          deadline = time.monotonic() + flush_interval
+        buffer += data
+
+        if chunk_size == 0:
+          while buffer:
+            i = buffer.find(b'\n', 0, max_buffer)
+            if i < 0 and len(buffer) < max_buffer:
+              break
+            end = i + 1 if i >= 0 else max_buffer
+            yield bytes(buffer[:end])
+            del buffer[:end]
+
+      if buffer and chunk_size > 0:
+        if len(buffer) >= chunk_size or (deadline is not None and time.monotonic() >= deadline):
+          yield bytes(buffer)
+          buffer.clear()
+          deadline = None
+  finally:
+    selector.close()
+
+
+def _decoder():
+  """Incremental decoder equivalent to that of subprocess text mode."""
+  import io
+  import codecs
+  import locale
+
+  decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+  return io.IncrementalNewlineDecoder(decoder, translate=True)
+
+
+def _decode_chunks(chunks):
+  """Decode byte chunks as subprocess.Popen(..., text=True) would."""
+  decoder = _decoder()
+  for chunk in chunks:
+    text = decoder.decode(chunk)
+    if text:
+      yield text
+  text = decoder.decode(b'', final=True)
+  if text:
+    yield text
@@ -0,0 +1,341 @@
+"""Process pools for CPU-bound endpoint functions.
+
+A function configured with, e.g.,
+  "exec": {"data": {"mode": "process", "workers": 4}}
+is run in a pool of worker processes instead of in the server's threads,
+so that a CPU-bound function (e.g., a decompressor or unit converter)
+does not hold the GIL of the server process while other requests are
+being served.
+
+Each worker has a block of shared memory divided into `buffers` buffers
+of `buffer_size` bytes. A chunk yielded by the function is copied into a
+free buffer and only the buffer index and length are sent to the server
+process, which copies the chunk out and returns the buffer. When all of
+its buffers are in use, the worker waits, so a slow client slows the
+function instead of filling memory.
+
+The function must be importable by the worker (defined at module level
+in an importable module), and its return value must be picklable if it
+is not an iterator. Functions are called with a copy of the config that
+omits 'functions' and private keys (those starting with '_').
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pools = []
+
+
+def pool(config, endpoint):
+  """Return the Pool for the endpoint function in config, creating it on first use.
+
+  A pool closed at shutdown (see close()) is replaced by a new one.
+  """
+  if endpoint not in config.get('_process', {}) or config['_process'][endpoint]._closed:
+    with _lock:
+      if endpoint not in config.setdefault('_process', {}) or config['_process'][endpoint]._closed:
+        options = config.get('exec', {}).get(endpoint, {})
+        names = ['workers', 'max_requests', 'buffers', 'buffer_size', 'start_method', 'timeout']
+        kwargs = {k: options[k] for k in names if k in options}
+        func_config = {k: v for k, v in config.items() if not k.startswith('_') and k != 'functions'}
+        logger.debug(f"Creating process pool for /{endpoint} function with {kwargs}")
+        config['_process'][endpoint] = Pool(config['functions'][endpoint], config=func_config, **kwargs)
+        _pools.append(config['_process'][endpoint])
+  return config['_process'][endpoint]
+
+
+def close():
+  """Stop all workers in all pools."""
+  for pool in list(_pools):
+    pool.close()
+  _pools.clear()
+
+
+class Pool:
+  """Pool of worker processes for one function.
+
+  Args:
+    func (callable): The function.
+    config (dict): Passed to func if it accepts config.
+    workers (int): Maximum number of workers (and concurrent calls).
+      Default 1.
+    max_requests (int): Number of calls after which a worker is replaced.
+      Default 100.
+    buffers (int): Number of shared memory buffers per worker. Default 4.
+    buffer_size (int): Size of each buffer in bytes; larger chunks are
+      split. Default 1 MiB.
+    start_method (str): multiprocessing start method. Default 'spawn',
+      which, unlike 'fork', is safe in a server with running threads.
+    timeout (float): Seconds run() waits for a free worker before raising
+      TimeoutError. 0 means no limit. Default 30.
+  """
+
+  def __init__(self, func, config=None, workers=1, max_requests=100, buffers=4, buffer_size=2**20,
+               start_method='spawn', timeout=30):
+    import multiprocessing
+
+    self.func = func
+    self.config = config or {}
+    self.workers = workers
+    self.max_requests = max_requests
+    self.buffers = buffers
+    self.buffer_size = buffer_size
+    self.timeout = timeout
+    self._context = multiprocessing.get_context(start_method)
+    self._idle = []
+    self._count = 0
+    self._closed = False
+    self._cond = threading.Condition()
+
+  def start(self):
+    """Start workers until the pool is full (pre-warming)."""
+    while True:
+      with self._cond:
+        if self._closed or self._count >= self.workers:
+          return
+        self._count += 1
+      worker = self._spawn()
+      with self._cond:
+        self._idle.append(worker)
+        self._cond.notify()
+
+  def run(self, args):
+    """Call the function with args (a dict) in a worker.
+
+    Blocks until a worker is available (at most timeout seconds; then
+    raises TimeoutError) and the function has returned (for a generator,
+    until it has yielded its first chunk). Returns its return
+    value or, if it is an iterator, a Stream of its chunks as bytes.
+    Raises RuntimeError with the worker's traceback if the function
+    raises.
+    """
+    worker = self._acquire()
+    try:
+      worker.send(('run', args))
+      message = worker.recv()
+    except BaseException:
+      self._release(worker, dead=True)
+      raise
+
+    kind = message[0]
+    if kind == 'iter':
+      return Stream(self, worker)
+    self._release(worker)
+    if kind == 'value':
+      return message[1]
+    raise RuntimeError(f"Function failed in process {worker.pid}:\n{message[1]}")
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      idle, self._idle = self._idle, []
+      self._count -= len(idle)
+    for worker in idle:
+      worker.close()
+
+  def _spawn(self):
+    try:
+      return _Worker(self)
+    except Exception:
+      with self._cond:
+        self._count -= 1
+        self._cond.notify()
+      raise
+
+  def _acquire(self):
+    import time
+
+    deadline = time.monotonic() + self.timeout if self.timeout else None
+    with self._cond:
+      while True:
+        if self._closed:
+          raise RuntimeError(f"Process pool for {self.func} is closed")
+        while self._idle:
+          worker = self._idle.pop()
+          if worker.alive():
+            return worker
+          worker.close()
+          self._count -= 1
+        if self._count < self.workers:
+          self._count += 1
+          break
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise TimeoutError(f"No worker process for {self.func} free after {self.timeout} s")
+        self._cond.wait(remaining)
+    return self._spawn()
+
+  def _release(self, worker, dead=False):
+    worker.requests += 1
+    if dead or self._closed or worker.requests >= self.max_requests or not worker.alive():
+      logger.debug(f"Stopping process {worker.pid} after {worker.requests} request(s)")
+      worker.close()
+      with self._cond:
+        self._count -= 1
+        self._cond.notify()
+    else:
+      with self._cond:
+        self._idle.append(worker)
+        self._cond.notify()
+
+
+class Stream:
+  """Iterator over the chunks (bytes) yielded by a function in a worker.
+
+  Closing or killing the stream before it is exhausted stops the worker.
+  """
+
+  def __init__(self, pool, worker):
+    self._pool = pool
+    self._worker = worker
+    self._done = False
+    self._lock = threading.Lock()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._done:
+      raise StopIteration
+    try:
+      message = self._worker.recv()
+    except BaseException:
+      self._finish(dead=True)
+      raise
+
+    kind = message[0]
+    if kind == 'chunk':
+      _, index, size = message
+      start = index * self._pool.buffer_size
+      chunk = bytes(self._worker.buffer[start:start + size])
+      self._worker.send(('free', index))
+      return chunk
+    self._finish()
+    if kind == 'done':
+      raise StopIteration
+    raise RuntimeError(f"Function failed in process {self._worker.pid}:\n{message[1]}")
+
+  def kill(self):
+    """Stop the worker if the function has not finished. May be called from any thread."""
+    self._finish(dead=True)
+
+  def close(self):
+    self._finish(dead=True)
+
+  def _finish(self, dead=False):
+    with self._lock:
+      if self._done:
+        return
+      self._done = True
+    self._pool._release(self._worker, dead=dead)
+
+
+class _Worker:
+  """Server-side handle for a worker process."""
+
+  def __init__(self, pool):
+    context = pool._context
+    self.buffer = context.RawArray('B', pool.buffers * pool.buffer_size)
+    self._conn, child_conn = context.Pipe()
+    self._process = context.Process(
+      target=_serve,
+      args=(child_conn, self.buffer, pool.func, pool.config, pool.buffers, pool.buffer_size),
+      daemon=True
+    )
+    self._process.start()
+    child_conn.close()
+    self.buffer = memoryview(self.buffer).cast('B')
+    self.pid = self._process.pid
+    self.requests = 0
+    logger.info(f"Started process {self.pid} for function {pool.func.__module__}.{pool.func.__name__}")
+
+  def send(self, message):
+    self._conn.send(message)
+
+  def recv(self):
+    try:
+      return self._conn.recv()
+    except EOFError:
+      raise RuntimeError(f"Process {self.pid} exited with code {self._process.exitcode}") from None
+
+  def alive(self):
+    return self._process.is_alive()
+
+  def close(self):
+    if self._process.is_alive():
+      self._process.kill()
+    self._process.join()
+    self._conn.close()
+
+
+def _serve(conn, buffer, func, config, buffers, buffer_size):
+  # Worker main loop. Receives ('run', args) and ('free', index) messages
+  # and sends ('value', value), ('iter',), ('chunk', index, size),
+  # ('done',), or ('error', traceback) messages.
+  import inspect
+  import itertools
+  import traceback
+
+  from hapiserver.call import _adapter, _await
+
+  buffer = memoryview(buffer).cast('B')
+  free = list(range(buffers))
+  adapter = _adapter(func)
+
+  while True:
+    try:
+      message = conn.recv()
+    except EOFError:
+      return
+    if message[0] == 'free':
+      free.append(message[1])
+      continue
+
+    try:
+      data = adapter(message[1], config)
+      if inspect.isawaitable(data):
+        data = _await(data)
+      if hasattr(data, '__aiter__'):
+        data = _iterate(data)
+      if not hasattr(data, '__next__'):
+        conn.send(('value', data))
+        continue
+
+      # Get the first chunk before replying so that errors raised at the
+      # start of a generator (e.g., for invalid arguments) are reported
+      # as a failed call.
+      chunks = itertools.chain([next(data, b'')], data)
+      conn.send(('iter',))
+      for chunk in chunks:
+        if isinstance(chunk, str):
+          chunk = chunk.encode('utf-8')
+        for start in range(0, len(chunk), buffer_size):
+          piece = chunk[start:start + buffer_size]
+          while not free:
+            # All buffers in use; wait for the server to return one.
+            free.append(conn.recv()[1])
+          index = free.pop()
+          buffer[index * buffer_size:index * buffer_size + len(piece)] = piece
+          conn.send(('chunk', index, len(piece)))
+      conn.send(('done',))
+    except Exception:
+      conn.send(('error', traceback.format_exc()))
+
+
+def _iterate(agen):
+  # Iterate an async generator from synchronous code.
+  import asyncio
+
+  loop = asyncio.new_event_loop()
+  try:
+    while True:
+      try:
+        yield loop.run_until_complete(agen.__anext__())
+      except StopAsyncIteration:
+        return
+  finally:
+    loop.run_until_complete(agen.aclose())
+    loop.close()
@@ -0,0 +1,220 @@
+"""Transcoding of HAPI CSV /data output to other HAPI formats.
+
+A data script or function that only writes CSV can serve format=binary
+and format=json requests: the server requests CSV and converts it while
+streaming. The complete lines in each chunk are converted together
+(binary with NumPy, JSON with csv_to_json.convert_block()) using a layout
+computed from the /info response (see layout()), so memory use does not
+depend on the size of the response.
+
+Disable with "transcode": false in the server config.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['binary', 'json']
+
+
+def layout(format, header):
+  """Return the layout for converting CSV to format.
+
+  header is the /info response for the requested parameters (with keys
+  'HAPI', 'status', 'parameters', etc.). The layout depends only on the
+  dataset and the requested parameters, so callers should compute it once
+  (see endpoints._transcoder()). Raises ValueError if the parameters
+  cannot be represented in format.
+  """
+  if format == 'binary':
+    return _binary_layout(header['parameters'])
+  if format == 'json':
+    return _json_layout(header)
+  raise ValueError(f"Cannot transcode to format '{format}'")
+
+
+def transcode(stream, format, layout):
+  """Return a generator that yields stream (HAPI CSV) as bytes in format.
+
+  stream may be an iterable or an async iterable of str or bytes chunks;
+  lines may span chunks. For an async iterable, chunks are converted in a
+  worker thread (anyio.to_thread).
+
+  If a line does not match layout, the response status has already been
+  sent, so the error is logged and the output ends after the blocks
+  converted before it, without layout['tail'] (e.g., the end of the JSON
+  document), so that it does not look complete.
+  """
+  converters = {'binary': _binary_block, 'json': _json_block}
+  if format not in converters:
+    raise ValueError(f"Cannot transcode to format '{format}'")
+  convert = converters[format]
+
+  if hasattr(stream, '__aiter__'):
+    return _atranscode(stream, convert, layout)
+  return _transcode(stream, convert, layout)
+
+
+def _transcode(stream, convert, layout):
+  # Yields layout['head'], the converted blocks of complete lines
+  # separated by layout['separator'], and layout['tail'].
+  rest = b''
+  first = True
+  try:
+    if layout['head']:
+      yield layout['head']
+    for chunk in stream:
+      block, rest = _split(chunk, rest)
+      output = convert(block, layout) if block else b''
+      if output:
+        yield output if first else layout['separator'] + output
+        first = False
+    output = convert(rest + b'\n', layout) if rest.strip() else b''
+    if output:
+      yield output if first else layout['separator'] + output
+    if layout['tail']:
+      yield layout['tail']
+  except ValueError as e:
+    _log_error(e)
+  finally:
+    if hasattr(stream, 'close'):
+      stream.close()
+
+
+async def _atranscode(stream, convert, layout):
+  # See _transcode(). Blocks are converted in a worker thread so that the
+  # event loop is not blocked while a large chunk is converted.
+  import anyio.to_thread
+
+  rest = b''
+  first = True
+  try:
+    if layout['head']:
+      yield layout['head']
+    async for chunk in stream:
+      block, rest = _split(chunk, rest)
+      output = await anyio.to_thread.run_sync(convert, block, layout) if block else b''
+      if output:
+        yield output if first else layout['separator'] + output
+        first = False
+    output = await anyio.to_thread.run_sync(convert, rest + b'\n', layout) if rest.strip() else b''
+    if output:
+      yield output if first else layout['separator'] + output
+    if layout['tail']:
+      yield layout['tail']
+  except ValueError as e:
+    _log_error(e)
+  finally:
+    if hasattr(stream, 'aclose'):
+      await stream.aclose()
+
+
+def _log_error(e):
+  logger.error(f"Transcoding of data script or function output failed; ending response. Error: {e}")
+
+
+def _split(chunk, rest):
+  # Return (complete lines, rest) of rest + chunk.
+  if isinstance(chunk, str):
+    chunk = chunk.encode('utf-8')
+  end = chunk.rfind(b'\n')
+  if end == -1:
+    return b'', rest + chunk
+  return rest + chunk[:end + 1], chunk[end + 1:]
+
+
+def _binary_layout(parameters):
+  # 'dtype' is a NumPy structured dtype for one record and 'columns' is a
+  # list of (field, first CSV column, last CSV column + 1, is_string) for
+  # each parameter.
+  import numpy
+
+  from hapiserver.csv_to_json import _product
+
+  fields = []
+  columns = []
+  start = 0
+  for i, parameter in enumerate(parameters):
+    name = parameter['name']
+    kind = parameter.get('type')
+    if kind in ['isotime', 'string']:
+      if 'length' not in parameter:
+        raise ValueError(f"Parameter '{name}' of type '{kind}' has no length")
+      base = f"S{parameter['length']}"
+    elif kind == 'double':
+      base = '<f8'
+    elif kind == 'integer':
+      base = '<i4'
+    else:
+      raise ValueError(f"Parameter '{name}' has unsupported type '{kind}'")
+    shape = tuple(parameter.get('size', []))
+    count = _product(shape)
+    fields.append((f"f{i}", base, shape))
+    columns.append((f"f{i}", start, start + count, base[0] == 'S'))
+    start += count
+
+  return {
+    "head": b'',
+    "tail": b'',
+    "separator": b'',
+    "dtype": numpy.dtype(fields),
+    "columns": columns
+  }
+
+
+def _binary_block(block, layout):
+  # Convert complete CSV lines to HAPI binary records.
+  import numpy
+
+  dtype = layout['dtype']
+  columns = layout['columns']
+  ncolumns = columns[-1][2]
+
+  if b'\r' in block:
+    block = block.replace(b'\r', b'')
+  lines = [line for line in block.split(b'\n') if line]
+  if not lines:
+    return b''
+  if b'"' in block:
+    # Quoted strings may contain commas.
+    import csv
+    rows = csv.reader(line.decode('utf-8') for line in lines)
+    tokens = [token.encode('utf-8') for row in rows for token in row]
+  else:
+    tokens = b','.join(lines).split(b',')
+  if len(tokens) != len(lines) * ncolumns:
+    raise ValueError(f"Expected {ncolumns} columns in each CSV line; got {len(tokens)} values in {len(lines)} line(s)")
+
+  table = numpy.array(tokens).reshape(len(lines), ncolumns)
+  records = numpy.empty(len(lines), dtype)
+  for field, start, stop, is_string in columns:
+    values = table[:, start:stop]
+    if is_string:
+      values = numpy.char.strip(values)
+    base = dtype[field].base
+    records[field] = values.astype(base).reshape(records[field].shape)
+
+  return records.tobytes()
+
+
+def _json_layout(header):
+  # The response is the header with the rows in 'data'. 'head' is the
+  # header up to the opening bracket of 'data' and 'tail' closes it.
+  import json
+
+  content = json.dumps({**header, "format": "json"}, indent=2)
+  head = content.rstrip()[:-1].rstrip() + ',\n  "data": [\n'
+  return {
+    "head": head.encode('utf-8'),
+    "tail": b'\n  ]\n}\n',
+    "separator": b',\n',
+    "sizes": [parameter.get('size') for parameter in header['parameters'][1:]],
+    "types": [parameter.get('type') for parameter in header['parameters'][1:]]
+  }
+
+
+def _json_block(block, layout):
+  # Convert complete CSV lines to rows of the JSON data array.
+  from hapiserver.csv_to_json import convert_block
+
+  return convert_block(block, layout['sizes'], layout['types']).encode('utf-8')
@@ -0,0 +1,642 @@
+"""Persistent worker and fork server processes for Python endpoint scripts.
+
+A worker is a Python process that imports the dependencies of an endpoint
+script once and then runs the script (with runpy, as __main__) for each
+request it receives. Requests are sent over a Unix socket together with
+the write ends of fresh stdout and stderr pipes, so the output of each run
+is an ordinary pipe that is closed when the run ends.
+
+A fork server (zygote) also imports the dependencies once, but forks a
+child for each request that runs the script and exits. Scripts that keep
+state in module globals or are not safe to run twice in one process can
+use this mode.
+
+Enable with, e.g.,
+  "exec": {"data": {"mode": "worker", "workers": 2, "max_requests": 100}}
+or
+  "exec": {"data": {"mode": "fork"}}
+in the server config. See Pool and Zygote for the options.
+
+This file is also the worker program; it is executed by path (not with
+-m hapiserver.worker) so that the worker does not import hapiserver, and
+must only use the standard library at module level.
+"""
+
+import os
+import sys
+import json
+import struct
+import socket
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool(script, options=None):
+  """Return the Pool or, for options['mode'] = 'fork', the Zygote for script.
+
+  The pool is created on first use and shared by all calls with the same
+  script and options.
+  """
+  options = options or {}
+  mode = options.get('mode', 'worker')
+  if mode == 'fork':
+    cls, names = Zygote, ['preload']
+  else:
+    cls, names = Pool, ['workers', 'max_requests', 'preload', 'timeout']
+  kwargs = {k: options[k] for k in names if k in options}
+  key = (script, mode, json.dumps(kwargs, sort_keys=True))
+  if key not in _pools:
+    with _pools_lock:
+      if key not in _pools:
+        _pools[key] = cls(script, **kwargs)
+  return _pools[key]
+
+
+def close():
+  """Stop all workers in all pools."""
+  for pool in list(_pools.values()):
+    pool.close()
+  _pools.clear()
+
+
+class Pool:
+  """Pool of persistent workers for one script.
+
+  Args:
+    script (str): Path to the Python script.
+    workers (int): Maximum number of workers (and concurrent runs).
+      Default 1.
+    max_requests (int): Number of runs after which a worker is replaced.
+      Default 100.
+    preload (bool or list): Modules to import when a worker starts. If
+      True, the modules imported at the top level of the script. Default
+      True.
+    timeout (float): Seconds run() waits for a free worker before raising
+      TimeoutError. 0 means no limit. Default 30.
+  """
+
+  def __init__(self, script, workers=1, max_requests=100, preload=True, timeout=30):
+    self.script = script
+    self.workers = workers
+    self.max_requests = max_requests
+    self.preload = preload
+    self.timeout = timeout
+    self._idle = []
+    self._count = 0
+    self._closed = False
+    self._cond = threading.Condition()
+
+  def start(self):
+    """Start workers until the pool is full (pre-warming)."""
+    while True:
+      with self._cond:
+        if self._closed or self._count >= self.workers:
+          return
+        self._count += 1
+      worker = self._spawn()
+      if worker is not None:
+        with self._cond:
+          self._idle.append(worker)
+          self._cond.notify()
+
+  def run(self, args, text=False, bufsize=-1):
+    """Run the script with args in a worker and return a Job.
+
+    Blocks until a worker is available or, after timeout seconds, raises
+    TimeoutError.
+    """
+    worker = self._acquire()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    try:
+      worker.send([str(arg) for arg in args], [stdout_w, stderr_w])
+    except Exception:
+      os.close(stdout_r)
+      os.close(stderr_r)
+      self._release(worker, dead=True)
+      raise
+    finally:
+      os.close(stdout_w)
+      os.close(stderr_w)
+
+    logger.info(f"Executing in worker {worker.pid}: {self.script} {' '.join(args)}")
+    return Job(self, worker, args, _open(stdout_r, text, bufsize), _open(stderr_r, text, bufsize))
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      idle, self._idle = self._idle, []
+      self._count -= len(idle)
+    for worker in idle:
+      worker.close()
+
+  def _spawn(self):
+    try:
+      return _Worker(self.script, self.preload)
+    except Exception:
+      with self._cond:
+        self._count -= 1
+        self._cond.notify()
+      raise
+
+  def _acquire(self):
+    import time
+
+    deadline = time.monotonic() + self.timeout if self.timeout else None
+    with self._cond:
+      while True:
+        if self._closed:
+          raise RuntimeError(f"Worker pool for {self.script} is closed")
+        while self._idle:
+          worker = self._idle.pop()
+          if worker.alive():
+            return worker
+          worker.close()
+          self._count -= 1
+        if self._count < self.workers:
+          self._count += 1
+          break
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise TimeoutError(f"No worker for {self.script} free after {self.timeout} s")
+        self._cond.wait(remaining)
+    return self._spawn()
+
+  def _release(self, worker, dead=False):
+    worker.requests += 1
+    recycle = dead or self._closed or worker.requests >= self.max_requests
+    if recycle or not worker.alive():
+      logger.debug(f"Stopping worker {worker.pid} after {worker.requests} request(s)")
+      worker.close()
+      with self._cond:
+        self._count -= 1
+        self._cond.notify()
+      # Start a replacement now so the next request does not pay for it.
+      self.start()
+    else:
+      with self._cond:
+        self._idle.append(worker)
+        self._cond.notify()
+
+
+class Zygote:
+  """Fork server for one script.
+
+  Args:
+    script (str): Path to the Python script.
+    preload (bool or list): Modules to import when the server starts. If
+      True, the modules imported at the top level of the script. Default
+      True.
+  """
+
+  def __init__(self, script, preload=True):
+    self.script = script
+    self.preload = preload
+    self._server = None
+    self._closed = False
+    self._lock = threading.Lock()
+
+  def start(self):
+    """Start the server if it is not running."""
+    with self._lock:
+      self._start()
+
+  def run(self, args, text=False, bufsize=-1):
+    """Run the script with args in a forked child and return a ForkJob."""
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    status_r, status_w = os.pipe()
+    try:
+      with self._lock:
+        self._start()
+        try:
+          self._server.send([str(arg) for arg in args], [stdout_w, stderr_w, status_w])
+          pid = self._server.recv()['pid']
+        except Exception:
+          # Start a new server for the next request.
+          self._server.kill()
+          self._server.close()
+          self._server = None
+          raise
+    except Exception:
+      for fd in [stdout_r, stderr_r, status_r]:
+        os.close(fd)
+      raise
+    finally:
+      for fd in [stdout_w, stderr_w, status_w]:
+        os.close(fd)
+
+    logger.info(f"Executing in process {pid} forked from {self._server.pid}: {self.script} {' '.join(args)}")
+    stdout = _open(stdout_r, text, bufsize)
+    stderr = _open(stderr_r, text, bufsize)
+    return ForkJob(self, pid, args, stdout, stderr, status_r)
+
+  def close(self):
+    with self._lock:
+      self._closed = True
+      if self._server is not None:
+        self._server.close()
+        self._server = None
+
+  def _start(self):
+    if self._closed:
+      raise RuntimeError(f"Fork server for {self.script} is closed")
+    if self._server is not None and not self._server.alive():
+      logger.warning(f"Fork server {self._server.pid} for {self.script} exited; restarting")
+      self._server.close()
+      self._server = None
+    if self._server is None:
+      self._server = _Worker(self.script, self.preload, command='fork')
+
+
+class Job:
+  """Popen-like handle for one run of a script in a worker.
+
+  As for subprocess.Popen, poll() and kill() may be called from another
+  thread while a thread is in wait() (e.g., when a client disconnects
+  while the response is being streamed). The exit status is read and the
+  worker is released only once.
+  """
+
+  def __init__(self, pool, worker, args, stdout, stderr):
+    self.args = [pool.script, *args]
+    self.pid = worker.pid
+    self.stdout = stdout
+    self.stderr = stderr
+    self.returncode = None
+    self._pool = pool
+    self._worker = worker
+    # Held while the exit status is read.
+    self._wait_lock = threading.Lock()
+    self._lock = threading.Lock()
+
+  def poll(self):
+    if self.returncode is None and self._wait_lock.acquire(blocking=False):
+      # If another thread is in wait(), it sets returncode.
+      try:
+        if self.returncode is None and self._worker.status_ready():
+          self._wait()
+      finally:
+        self._wait_lock.release()
+    return self.returncode
+
+  def wait(self, timeout=None):
+    if self.returncode is None:
+      with self._wait_lock:
+        if self.returncode is None:
+          self._wait()
+    return self.returncode
+
+  def _wait(self):
+    try:
+      returncode = self._worker.recv_status()
+    except Exception as e:
+      if not self._finished():
+        logger.error(f"Worker {self._worker.pid} failed: {e}")
+      self._finish(self._worker.kill(), dead=True)
+    else:
+      self._finish(returncode)
+
+  def kill(self):
+    if not self._finished():
+      self._finish(self._worker.kill(), dead=True)
+
+  def _finished(self):
+    with self._lock:
+      return self.returncode is not None
+
+  def _finish(self, returncode, dead=False):
+    with self._lock:
+      if self.returncode is not None:
+        return
+      self.returncode = returncode
+    self._pool._release(self._worker, dead=dead)
+
+  def communicate(self):
+    """Read stdout and stderr until EOF, wait, and return their content."""
+    from hapiserver.exec import _communicate
+    stdout, stderr = _communicate(self.stdout, self.stderr)
+    self.wait()
+    return stdout, stderr
+
+
+class ForkJob(Job):
+  """Popen-like handle for one run of a script in a process forked by a Zygote.
+
+  The exit code of the child is written by the fork server to a status
+  pipe when it reaps the child.
+  """
+
+  def __init__(self, zygote, pid, args, stdout, stderr, status):
+    self.args = [zygote.script, *args]
+    self.pid = pid
+    self.stdout = stdout
+    self.stderr = stderr
+    self.returncode = None
+    self._status = status
+    self._wait_lock = threading.Lock()
+
+  def poll(self):
+    import select
+    if self.returncode is None and self._wait_lock.acquire(blocking=False):
+      try:
+        if self.returncode is None:
+          readable, _, _ = select.select([self._status], [], [], 0)
+          if readable:
+            self._wait()
+      finally:
+        self._wait_lock.release()
+    return self.returncode
+
+  def _wait(self):
+    line = b''
+    while not line.endswith(b'\n'):
+      data = os.read(self._status, 64)
+      if not data:
+        break
+      line += data
+    os.close(self._status)
+    if line.endswith(b'\n'):
+      self.returncode = int(line)
+    else:
+      logger.error(f"Fork server exited before process {self.pid}; exit code unknown")
+      self.returncode = 1
+
+  def kill(self):
+    import signal
+    if self.returncode is None:
+      try:
+        os.kill(self.pid, signal.SIGKILL)
+      except ProcessLookupError:
+        pass
+      self.wait()
+
+
+class _Worker:
+
+  def __init__(self, script, preload, command='serve'):
+    import subprocess
+
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    call = [sys.executable, os.path.abspath(__file__), command, str(child.fileno()), script]
+    if preload is not True:
+      call.append(json.dumps(preload or []))
+    logger.debug(f"Starting worker: {' '.join(call)}")
+    try:
+      self._proc = subprocess.Popen(
+        call,
+        pass_fds=[child.fileno()],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL
+      )
+    finally:
+      child.close()
+    self.pid = self._proc.pid
+    self.requests = 0
+    self._sock = parent
+    self._buffer = b''
+
+  def alive(self):
+    return self._proc.poll() is None
+
+  def send(self, args, fds):
+    _send(self._sock, json.dumps(args).encode(), fds)
+
+  def status_ready(self):
+    import select
+    if b'\n' in self._buffer:
+      return True
+    readable, _, _ = select.select([self._sock], [], [], 0)
+    return bool(readable)
+
+  def recv(self):
+    """Return the next newline-terminated JSON message from the process."""
+    while b'\n' not in self._buffer:
+      data = self._sock.recv(4096)
+      if not data:
+        raise RuntimeError(f"worker exited with code {self._proc.wait()}")
+      self._buffer += data
+    line, self._buffer = self._buffer.split(b'\n', 1)
+    return json.loads(line)
+
+  def recv_status(self):
+    return self.recv()['returncode']
+
+  def kill(self):
+    if self._proc.poll() is None:
+      self._proc.kill()
+    return self._proc.wait()
+
+  def close(self):
+    # Closing the socket makes the worker exit after its current run.
+    self._sock.close()
+    if self._proc.poll() is None:
+      try:
+        self._proc.wait(timeout=5)
+      except Exception:
+        self._proc.kill()
+        self._proc.wait()
+
+
+def _open(fd, text, bufsize):
+  import io
+  if text:
+    return io.TextIOWrapper(open(fd, 'rb'))
+  return open(fd, 'rb', buffering=bufsize)
+
+
+def _send(sock, payload, fds):
+  import array
+  header = struct.pack('!I', len(payload))
+  ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+  sock.sendmsg([header], ancillary)
+  sock.sendall(payload)
+
+
+def _recv(sock, maxfds=2):
+  """Receive a payload and file descriptors sent with _send()."""
+  import array
+  fds = array.array('i')
+  header, ancillary, _, _ = sock.recvmsg(4, socket.CMSG_SPACE(maxfds * fds.itemsize))
+  if not header:
+    return None, []
+  for level, type, data in ancillary:
+    if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+      fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+  while len(header) < 4:
+    header += sock.recv(4 - len(header))
+  size = struct.unpack('!I', header)[0]
+  payload = b''
+  while len(payload) < size:
+    data = sock.recv(size - len(payload))
+    if not data:
+      return None, list(fds)
+    payload += data
+  return payload, list(fds)
+
+
+def _preload(script, modules=True):
+  """Import modules (if True, those imported at the top level of script)."""
+  import ast
+  import importlib
+
+  if modules is True:
+    try:
+      with open(script) as f:
+        tree = ast.parse(f.read(), filename=script)
+    except Exception:
+      return
+    modules = []
+    for node in tree.body:
+      if isinstance(node, ast.Import):
+        modules.extend(alias.name for alias in node.names)
+      elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+        modules.append(node.module)
+
+  for module in modules:
+    try:
+      importlib.import_module(module)
+    except Exception:
+      pass
+
+
+def _run(script, args):
+  """Run script as __main__ with argv args and return its exit code."""
+  import runpy
+  import traceback
+
+  sys.argv = [script, *args]
+  try:
+    runpy.run_path(script, run_name='__main__')
+    returncode = 0
+  except SystemExit as e:
+    if e.code is None:
+      returncode = 0
+    elif isinstance(e.code, int):
+      returncode = e.code
+    else:
+      print(e.code, file=sys.stderr)
+      returncode = 1
+  except BaseException:
+    traceback.print_exc()
+    returncode = 1
+  finally:
+    for stream in [sys.stdout, sys.stderr]:
+      try:
+        stream.flush()
+      except Exception:
+        pass
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+  return returncode
+
+
+def _setup(fd, script, preload):
+  # Imports in the script resolve as they would for `python script`.
+  sys.path[0] = os.path.dirname(os.path.abspath(script))
+  _preload(script, preload)
+  return socket.socket(fileno=fd)
+
+
+def _serve(fd, script, preload):
+  sock = _setup(fd, script, preload)
+
+  devnull = os.open(os.devnull, os.O_RDWR)
+  stderr = os.dup(2)
+  while True:
+    payload, fds = _recv(sock)
+    if payload is None:
+      break
+    os.dup2(fds[0], 1)
+    os.dup2(fds[1], 2)
+    for fd in fds:
+      os.close(fd)
+
+    returncode = _run(script, json.loads(payload))
+
+    # Close this run's pipes so the reader sees EOF.
+    os.dup2(devnull, 1)
+    os.dup2(stderr, 2)
+    sock.sendall(json.dumps({"returncode": returncode}).encode() + b'\n')
+
+
+def _fork_server(fd, script, preload):
+  import signal
+  import selectors
+
+  sock = _setup(fd, script, preload)
+
+  # SIGCHLD wakes up the selector so that children are reaped promptly.
+  wakeup_r, wakeup_w = os.pipe()
+  os.set_blocking(wakeup_r, False)
+  os.set_blocking(wakeup_w, False)
+  signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+  signal.set_wakeup_fd(wakeup_w)
+
+  selector = selectors.DefaultSelector()
+  selector.register(sock, selectors.EVENT_READ)
+  selector.register(wakeup_r, selectors.EVENT_READ)
+
+  status = {}  # pid of running child => write end of its status pipe
+  while True:
+    for key, _ in selector.select():
+      if key.fileobj is sock:
+        payload, fds = _recv(sock, maxfds=3)
+        if payload is None:
+          return
+        pid = os.fork()
+        if pid == 0:
+          returncode = 1
+          try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            selector.close()
+            for fd in [sock.fileno(), wakeup_r, wakeup_w, fds[2], *status.values()]:
+              os.close(fd)
+            os.dup2(fds[0], 1)
+            os.dup2(fds[1], 2)
+            os.close(fds[0])
+            os.close(fds[1])
+            returncode = _run(script, json.loads(payload))
+          finally:
+            os._exit(returncode & 0xff)
+        os.close(fds[0])
+        os.close(fds[1])
+        status[pid] = fds[2]
+        sock.sendall(json.dumps({"pid": pid}).encode() + b'\n')
+      else:
+        try:
+          while os.read(wakeup_r, 512):
+            pass
+        except BlockingIOError:
+          pass
+
+    while status:
+      try:
+        pid, code = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        break
+      if pid == 0:
+        break
+      if os.WIFSIGNALED(code):
+        returncode = -os.WTERMSIG(code)
+      else:
+        returncode = os.WEXITSTATUS(code)
+      fd = status.pop(pid, None)
+      if fd is not None:
+        try:
+          os.write(fd, f"{returncode}\n".encode())
+        except OSError:
+          pass
+        os.close(fd)
+
+
+if __name__ == "__main__":
+  preload = json.loads(sys.argv[4]) if len(sys.argv) > 4 else True
+  server = _fork_server if sys.argv[1] == 'fork' else _serve
+  server(int(sys.argv[2]), sys.argv[3], preload)
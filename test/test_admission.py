@@ -0,0 +1,216 @@
+# Usage:
+#   python test_admission.py
+
+import asyncio
+
+
+def test_global_and_per_dataset_limits():
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=2, max_per_dataset=1, max_queue=2, queue_timeout=1)
+
+    a1 = await admission.acquire('a')
+    b1 = await admission.acquire('b')
+    assert a1 is not None and b1 is not None
+
+    # Both wait: 'a' for its dataset slot and 'c' for a global slot.
+    a2 = asyncio.ensure_future(admission.acquire('a'))
+    c1 = asyncio.ensure_future(admission.acquire('c'))
+    await asyncio.sleep(0)
+    assert admission.stats()['queue_depth'] == 2
+
+    # Queue is full.
+    assert await admission.acquire('d') is None
+    assert admission.stats()['rejected'] == 1
+
+    # Releasing 'b' frees a global slot, but 'a' is still at its limit, so
+    # 'c' starts first.
+    b1.release()
+    assert await asyncio.wait_for(c1, 1) is not None
+    assert not a2.done()
+
+    a1.release()
+    a1.release()
+    slot = await asyncio.wait_for(a2, 1)
+    stats = admission.stats()
+    assert stats['running'] == 2
+    assert stats['running_per_dataset'] == {'a': 1, 'c': 1}
+    assert stats['queue_depth'] == 0
+    assert stats['admitted'] == 4
+    slot.release()
+
+  asyncio.run(run())
+
+
+def test_queue_timeout():
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=1, queue_timeout=0.05)
+    slot = await admission.acquire('a')
+    assert await admission.acquire('a') is None
+    stats = admission.stats()
+    assert stats['timeouts'] == 1
+    assert stats['queue_depth'] == 0
+    slot.release()
+    assert admission.stats()['running'] == 0
+
+  asyncio.run(run())
+
+
+def test_disconnect_while_waiting():
+  import hapiserver.admission
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=1, queue_timeout=10)
+    slot = await admission.acquire('a')
+
+    checks = []
+    async def disconnected():
+      checks.append(1)
+      return len(checks) >= 2
+
+    assert await asyncio.wait_for(admission.acquire('a', disconnected=disconnected), 1) is None
+    stats = admission.stats()
+    assert stats['abandoned'] == 1
+    assert stats['queue_depth'] == 0
+    slot.release()
+    assert admission.stats()['running'] == 0
+
+  poll_interval = hapiserver.admission._POLL_INTERVAL
+  hapiserver.admission._POLL_INTERVAL = 0.01
+  try:
+    asyncio.run(run())
+  finally:
+    hapiserver.admission._POLL_INTERVAL = poll_interval
+
+
+def test_wrap_releases_slot():
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=1)
+
+    slot = await admission.acquire('a')
+    assert list(slot.wrap(iter(["x", "y"]))) == ["x", "y"]
+    assert admission.stats()['running'] == 0
+
+    async def chunks():
+      yield "x"
+      yield "y"
+
+    slot = await admission.acquire('a')
+    stream = slot.wrap(chunks())
+    assert await stream.__anext__() == "x"
+    await stream.aclose()
+    assert admission.stats()['running'] == 0
+
+    # Released if the stream is never iterated.
+    slot = await admission.acquire('a')
+    stream = slot.wrap(iter(["x"]))
+    del stream
+    assert admission.stats()['running'] == 0
+
+  asyncio.run(run())
+
+
+def test_cost_priority_and_bulk_share():
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=2, bulk_cost=1000, bulk_share=0.5, aging=0)
+
+    # Only one of the two slots can be used by bulk requests.
+    bulk1 = await admission.acquire('a', cost=10**6)
+    bulk2 = asyncio.ensure_future(admission.acquire('b', cost=10**6))
+    await asyncio.sleep(0)
+    assert not bulk2.done()
+    small1 = await admission.acquire('c', cost=10)
+    assert admission.stats()['running'] == 2
+
+    # With the global limit reached, a small request that arrives later
+    # starts before the waiting bulk request.
+    small2 = asyncio.ensure_future(admission.acquire('d', cost=10))
+    await asyncio.sleep(0)
+    small1.release()
+    slot = await asyncio.wait_for(small2, 1)
+    assert not bulk2.done()
+
+    bulk1.release()
+    await asyncio.wait_for(bulk2, 1)
+    slot.release()
+
+  asyncio.run(run())
+
+
+def test_aging():
+  from hapiserver.admission import Admission
+
+  async def run():
+    admission = Admission(max_concurrent=1, bulk_cost=float('inf'), aging=0.01)
+    slot = await admission.acquire('a')
+
+    # After waiting 0.1 s, the large request has priority 6 - 10.
+    large = asyncio.ensure_future(admission.acquire('b', cost=10**6))
+    await asyncio.sleep(0.1)
+    small = asyncio.ensure_future(admission.acquire('c', cost=10))
+    await asyncio.sleep(0)
+
+    slot.release()
+    slot = await asyncio.wait_for(large, 1)
+    assert not small.done()
+    slot.release()
+    (await asyncio.wait_for(small, 1)).release()
+
+  asyncio.run(run())
+
+
+def test_data_cost():
+  import datetime
+  from hapiserver.endpoints import _data_cost
+
+  info = {
+    "cadence": "PT60S",
+    "parameters": [
+      {"name": "Time"},
+      {"name": "scalar"},
+      {"name": "vector", "size": [3]}
+    ]
+  }
+  start = datetime.datetime(2000, 1, 1)
+  query = {"start_datetime": start, "stop_datetime": start + datetime.timedelta(days=1)}
+
+  # 1440 records with 1 + 1 + 3 values.
+  assert _data_cost(query, info) == 1440 * 5
+  assert _data_cost({**query, "parameters": "scalar"}, info) == 1440 * 2
+
+  del info['cadence']
+  assert _data_cost(query, info, default_cadence=1) == 86400 * 5
+
+
+def test_worker_limit():
+  import hapiserver
+
+  # Requests beyond the number of workers wait for a slot.
+  exec = {"data": {"mode": "worker", "workers": 2}}
+  config = {"scripts": {"data": "data.py"}, "exec": exec}
+  assert hapiserver.admission.get(config).max_concurrent == 2
+
+  config = {"scripts": {"data": "data.py"}, "exec": exec, "admission": {"max_concurrent": 1}}
+  assert hapiserver.admission.get(config).max_concurrent == 1
+
+  config = {"scripts": {"data": "data.py"}, "admission": {"max_concurrent": 0}}
+  assert hapiserver.admission.get(config).max_concurrent == 0
+
+
+if __name__ == "__main__":
+  test_global_and_per_dataset_limits()
+  test_queue_timeout()
+  test_disconnect_while_waiting()
+  test_wrap_releases_slot()
+  test_cost_priority_and_bulk_share()
+  test_aging()
+  test_data_cost()
+  test_worker_limit()
@@ -0,0 +1,565 @@
+# Usage:
+#   python test_app_client.py
+#
+# Tests of the FastAPI app using an in-process client and a config with
+# functions defined in this file (no server or demo repository needed).
+
+ABOUT = {"id": "Demo", "title": "Demo", "contact": ""}
+
+INFO = {
+  "startDate": "1970-01-01T00:00:00Z",
+  "stopDate": "1970-01-02T00:00:00Z",
+  "parameters": [
+    {"name": "Time", "type": "isotime", "units": "UTC", "length": 20, "fill": None},
+    {"name": "scalar", "type": "double", "units": None, "fill": None}
+  ]
+}
+
+
+def catalog():
+  return [{"id": "demo1"}]
+
+
+def info(dataset):
+  return INFO
+
+
+def data(dataset, parameters, start, stop):
+  yield "1970-01-01T00:00:00Z,0\n"
+
+
+def _data_script(tmp_dir, body):
+  import pathlib
+  import textwrap
+
+  script = pathlib.Path(tmp_dir) / "data.py"
+  script.write_text(textwrap.dedent(body))
+  return f"{script} {{dataset}} {{parameters}} {{start}} {{stop}}"
+
+
+def _client(**config):
+  from fastapi.testclient import TestClient
+
+  import hapiserver
+
+  config = {
+    "about": ABOUT,
+    "functions": {"catalog": catalog, "info": info, "data": data},
+    **config
+  }
+  return TestClient(hapiserver.app(config))
+
+
+def test_static_responses():
+  client = _client()
+
+  for endpoint in ['', '/about', '/capabilities']:
+    response = client.get(f"/hapi{endpoint}")
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.startswith('"') and etag.endswith('"')
+    assert int(response.headers['Content-Length']) == len(response.content)
+
+    # Same bytes and ETag on each request.
+    response_2 = client.get(f"/hapi{endpoint}")
+    assert response_2.content == response.content
+    assert response_2.headers['ETag'] == etag
+
+  response = client.get("/hapi/about")
+  assert response.json()['id'] == "Demo"
+
+  response = client.get("/hapi/about?x_custom=1")
+  assert response.status_code == 200
+  assert response.json()['id'] == "Demo"
+
+  response = client.get("/hapi/about?xxxabc=123")
+  assert response.status_code == 400
+  assert response.json()['status']['code'] == 1401
+
+
+def test_conditional_responses():
+  client = _client()
+
+  for url in ["/hapi", "/hapi/catalog", "/hapi/info?dataset=demo1", "/hapi/info?dataset=demo1&parameters=scalar"]:
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    response_304 = client.get(url, headers={"If-None-Match": etag})
+    assert response_304.status_code == 304
+    assert response_304.content == b''
+    assert response_304.headers['ETag'] == etag
+
+    response_304 = client.get(url, headers={"If-None-Match": f'"x", W/{etag}'})
+    assert response_304.status_code == 304
+
+    response_304 = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert response_304.status_code == 304
+
+    response_200 = client.get(url, headers={"If-None-Match": '"x"'})
+    assert response_200.status_code == 200
+    assert response_200.content == response.content
+
+    response_head = client.head(url)
+    assert response_head.status_code == 200
+    assert response_head.content == b''
+    assert response_head.headers['ETag'] == etag
+    assert int(response_head.headers['Content-Length']) == len(response.content)
+
+  response = client.head("/hapi/info?dataset=INVALID")
+  assert response.status_code == 404
+  assert response.content == b''
+
+
+def test_data_script_streaming():
+  import tempfile
+
+  body = """
+    import sys
+    for i in range(3):
+      print(f"1970-01-01T00:00:0{i}Z,{i}", flush=True)
+  """
+
+  url = "/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:03Z"
+  expected = "".join(f"1970-01-01T00:00:0{i}Z,{i}\n" for i in range(3))
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    script = _data_script(tmp_dir, body)
+    functions = {"catalog": catalog, "info": info}
+
+    streams = [
+      {},
+      {"chunk_size": 0},
+      {"chunk_size": 5, "max_buffer": 3},
+      {"async": False},
+      {"async": False, "chunk_size": 0},
+      False
+    ]
+    for stream in streams:
+      client = _client(functions=functions, scripts={"data": script}, stream=stream)
+      response = client.get(url)
+      assert response.status_code == 200
+      assert 'text/csv' in response.headers['Content-Type']
+      assert response.text == expected
+
+
+def test_data_script_errors():
+  import tempfile
+
+  url = "/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:03Z"
+  functions = {"catalog": catalog, "info": info}
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    # Cannot be started.
+    script = _data_script(tmp_dir, "#!/nonexistent/interpreter\n")
+    for stream in [{}, {"async": False}, False]:
+      client = _client(functions=functions, scripts={"data": script}, stream=stream, exec={"data": {"mode": "direct"}})
+      response = client.get(url)
+      assert response.status_code == 500
+      assert response.json()['status']['code'] == 1500
+
+    # Fails before writing anything.
+    script = _data_script(tmp_dir, """
+      import sys
+      print("error", file=sys.stderr)
+      sys.exit(1)
+    """)
+    for stream in [{}, {"async": False}, {"chunk_size": 0}, False]:
+      client = _client(functions=functions, scripts={"data": script}, stream=stream)
+      response = client.get(url)
+      assert response.status_code == 500
+      assert response.json()['status']['code'] == 1500
+
+    # Fails mid-stream: the status has been sent, so the error follows
+    # the output.
+    script = _data_script(tmp_dir, """
+      import sys
+      print("1970-01-01T00:00:00Z,0", flush=True)
+      sys.exit(1)
+    """)
+    for stream in [{}, {"async": False}]:
+      client = _client(functions=functions, scripts={"data": script}, stream=stream)
+      response = client.get(url)
+      assert response.status_code == 200
+      assert response.text == "1970-01-01T00:00:00Z,0\nScript exited with code 1"
+
+
+def test_data_admission():
+  import asyncio
+
+  import hapiserver
+  from fastapi.testclient import TestClient
+
+  config = {
+    "about": ABOUT,
+    "functions": {"catalog": catalog, "info": info, "data": data},
+    "admission": {"max_concurrent": 1, "max_queue": 0, "retry_after": 5}
+  }
+  client = TestClient(hapiserver.app(config))
+  url = "/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:01Z"
+
+  response = client.get(url)
+  assert response.status_code == 200
+
+  # Hold the only slot so that the next request is rejected.
+  admission = hapiserver.admission.get(config)
+  slot = asyncio.run(admission.acquire('demo1'))
+  response = client.get(url)
+  assert response.status_code == 503
+  assert response.headers['Retry-After'] == "5"
+  assert response.json()['status']['code'] == 1500
+
+  slot.release()
+  response = client.get(url)
+  assert response.status_code == 200
+
+  stats = hapiserver.admission.stats(config)
+  assert stats['running'] == 0
+  assert stats['admitted'] == 3
+  assert stats['rejected'] == 1
+
+
+def test_data_slot_release():
+  import asyncio
+
+  import hapiserver
+  from hapiserver.app import _data_streaming_response_class
+
+  def generator():
+    yield "1970-01-01T00:00:00Z,0\n"
+
+  async def respond(admission):
+    async def receive():
+      await asyncio.sleep(10)
+
+    async def send(message):
+      # Client gone before the body is started.
+      raise OSError("Connection reset")
+
+    slot = await admission.acquire('demo1')
+    response = _data_streaming_response_class()(slot.wrap(generator()), slot=slot)
+    await asyncio.wait_for(response(scope={"type": "http"}, receive=receive, send=send), 5)
+
+  config = {"admission": {"max_concurrent": 1}}
+  admission = hapiserver.admission.get(config)
+  asyncio.run(respond(admission))
+  assert admission.stats()['running'] == 0
+
+
+def test_data_complete():
+  import asyncio
+
+  from starlette.background import BackgroundTask
+
+  from hapiserver.app import _data_streaming_response_class
+
+  class Source:
+    def __init__(self):
+      self.killed = False
+      self.chunks = iter([b"1970-01-01T00:00:00Z,0\n"])
+    def __iter__(self):
+      return self
+    def __next__(self):
+      return next(self.chunks)
+    def kill(self):
+      self.killed = True
+
+  async def respond(source):
+    # Servers report a disconnect as soon as the last body message has
+    # been sent.
+    done = asyncio.Event()
+    messages = []
+
+    async def receive():
+      await done.wait()
+      return {"type": "http.disconnect"}
+
+    async def send(message):
+      messages.append(message)
+      if message['type'] == 'http.response.body' and not message.get('more_body'):
+        done.set()
+        await asyncio.sleep(0.1)
+
+    response = _data_streaming_response_class()(source, source=source, background=BackgroundTask(background.append, True))
+    await asyncio.wait_for(response(scope={"type": "http"}, receive=receive, send=send), 5)
+    return messages
+
+  background = []
+  source = Source()
+  messages = asyncio.run(respond(source))
+  assert messages[1]['body'] == b"1970-01-01T00:00:00Z,0\n"
+  assert not source.killed
+  assert background == [True]
+
+
+def test_data_disconnect():
+  import time
+  import asyncio
+  import tempfile
+
+  import hapiserver
+  from hapiserver.app import _data_streaming_response_class
+
+  async def respond(content, source=None):
+    # Client that disconnects after receiving the first chunk.
+    disconnect = asyncio.Event()
+    messages = []
+
+    async def receive():
+      await disconnect.wait()
+      return {"type": "http.disconnect"}
+
+    async def send(message):
+      messages.append(message)
+      if message.get('body'):
+        disconnect.set()
+
+    response = _data_streaming_response_class()(content, source=source)
+    start = time.monotonic()
+    await asyncio.wait_for(response(scope={"type": "http"}, receive=receive, send=send), 5)
+    return messages, time.monotonic() - start
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    script = _data_script(tmp_dir, """
+      import time
+      print("1970-01-01T00:00:00Z,0", flush=True)
+      time.sleep(30)
+    """).split()[0]
+
+    for stream in [{"bytes": True, "async": False}, {"bytes": True, "async": True}]:
+      data, error = hapiserver.exec(script, stream=stream)
+      content = data()
+      messages, elapsed = asyncio.run(respond(content, source=content))
+      assert messages[1]['body'] == b"1970-01-01T00:00:00Z,0\n"
+      assert elapsed < 2
+
+  closed = []
+  def generator():
+    try:
+      yield "1970-01-01T00:00:00Z,0\n"
+      time.sleep(0.2)
+      yield "1970-01-01T00:00:01Z,0\n"
+    finally:
+      closed.append(True)
+
+  messages, elapsed = asyncio.run(respond(generator()))
+  assert closed == [True]
+  assert not any(m.get('body', b'').startswith(b"1970-01-01T00:00:01Z") for m in messages)
+
+
+def test_info_script_arguments():
+  import json
+  import pathlib
+  import tempfile
+
+  # The info script gets only the dataset, which is the key info is
+  # cached by, even if its argument template uses other query parameters.
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    script = pathlib.Path(tmp_dir) / "info.py"
+    script.write_text(
+      "import sys, json\n"
+      f"info = json.loads({json.dumps(json.dumps(INFO))})\n"
+      "info['x_args'] = sys.argv[1:]\n"
+      "print(json.dumps(info))\n"
+    )
+    scripts = {"info": f"{script} {{dataset}} {{parameters}}"}
+    functions = {"catalog": catalog, "data": data}
+    with _client(scripts=scripts, functions=functions) as client:
+      for url in ["/hapi/info?dataset=demo1&parameters=scalar", "/hapi/info?dataset=demo1"]:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.json()['x_args'] == ["demo1"]
+
+
+def test_async_functions():
+  import sys
+  import asyncio
+
+  from hapiserver.endpoints import _get_info
+
+  loops = set()
+
+  async def catalog_async():
+    loops.add(asyncio.get_running_loop())
+    await asyncio.sleep(0)
+    return catalog()
+
+  async def info_async(dataset):
+    loops.add(asyncio.get_running_loop())
+    await asyncio.sleep(0)
+    return info(dataset)
+
+  async def data_async(dataset, parameters, start, stop):
+    loops.add(asyncio.get_running_loop())
+    for i in range(3):
+      await asyncio.sleep(0)
+      yield f"1970-01-01T00:00:0{i}Z,{i}\n"
+
+  def blocking_await(awaitable):
+    raise AssertionError("awaited from a threadpool thread")
+
+  functions = {"catalog": catalog_async, "info": info_async, "data": data_async}
+  # One event loop for all requests.
+  call_module = sys.modules['hapiserver.call']
+  _await = call_module._await
+  call_module._await = blocking_await
+  try:
+    with _client(functions=functions) as client:
+      response = client.get("/hapi/catalog")
+      assert response.json()['catalog'] == [{"id": "demo1"}]
+
+      response = client.get("/hapi/info?dataset=demo1")
+      assert response.json()['parameters'][0]['name'] == "Time"
+
+      response = client.get("/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:03Z")
+      assert response.status_code == 200
+      assert response.text == "".join(f"1970-01-01T00:00:0{i}Z,{i}\n" for i in range(3))
+  finally:
+    call_module._await = _await
+
+  # All ran on the app's event loop.
+  assert len(loops) == 1
+
+  # Without a running server.
+  config = {"functions": functions}
+  result, error = _get_info({"dataset": "demo1"}, config)
+  assert error is None
+  assert result['parameters'][0]['name'] == "Time"
+
+  async def fail(dataset):
+    raise RuntimeError("failed")
+
+  result, error = _get_info({"dataset": "demo1"}, {"functions": {"info": fail}})
+  assert result is None
+  assert isinstance(error['exception'], RuntimeError)
+
+  with _client(functions={**functions, "info": fail}) as client:
+    response = client.get("/hapi/info?dataset=demo1")
+    assert response.status_code == 500
+    assert response.json()['status']['code'] == 1500
+
+
+def test_function_adapters():
+  import hapiserver
+  from hapiserver.call import _call_function
+
+  def info_config(dataset, config=None):
+    return {"dataset": dataset, "config": config is not None}
+
+  def info_kwargs(dataset, **kwargs):
+    return {"dataset": dataset, "config": 'config' in kwargs}
+
+  config = hapiserver.config({
+    "about": ABOUT,
+    "functions": {"catalog": catalog, "info": info_config, "data": data}
+  })
+  assert set(config['_adapters']) == {"catalog", "info", "data"}
+
+  args = {"dataset": "demo1"}
+  assert _call_function('info', args, config) == ({"dataset": "demo1", "config": True}, None)
+
+  # Function replaced after config() was called.
+  config['functions']['info'] = info
+  assert _call_function('info', args, config) == (INFO, None)
+  assert config['_adapters']['info'].func is info
+
+  config = {"functions": {"info": info_kwargs}}
+  assert _call_function('info', args, config) == ({"dataset": "demo1", "config": True}, None)
+
+
+def test_data_transcode():
+  import numpy
+
+  client = _client()
+
+  response = client.get("/hapi/capabilities")
+  assert response.json()['outputFormats'] == ["csv", "binary", "json"]
+
+  response = client.get("/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:01Z&format=binary")
+  assert response.status_code == 200
+  assert response.headers['Content-Type'] == "application/octet-stream"
+  records = numpy.frombuffer(response.content, [("Time", "S20"), ("scalar", "<f8")])
+  assert records.tolist() == [(b"1970-01-01T00:00:00Z", 0.0)]
+
+  response = client.get("/hapi/data?dataset=demo1&parameters=scalar&start=1970-01-01Z&stop=1970-01-01T00:00:01Z&format=json")
+  assert response.status_code == 200
+  assert response.headers['Content-Type'] == "application/json"
+  content = response.json()
+  assert [p['name'] for p in content['parameters']] == ["Time", "scalar"]
+  assert content['data'] == [["1970-01-01T00:00:00Z", 0.0]]
+
+  client = _client(capabilities={"outputFormats": ["csv"]}, transcode=False)
+  response = client.get("/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:01Z&format=binary")
+  assert response.status_code == 400
+  assert response.json()['status']['code'] == 1409
+
+
+def test_data_include_header():
+  import json
+  import tempfile
+
+  import numpy
+
+  url = "/hapi/data?dataset=demo1&parameters=scalar&start=1970-01-01Z&stop=1970-01-01T00:00:01Z&include=header"
+
+  def header(text):
+    lines = text.splitlines()
+    assert lines[0] == "#{"
+    n = next(i for i, line in enumerate(lines) if line == "#}") + 1
+    return json.loads("\n".join(line[1:] for line in lines[:n])), "\n".join(lines[n:])
+
+  def data_str(dataset, parameters, start, stop):
+    return "1970-01-01T00:00:00Z,0\n"
+
+  for data_function in [data_str, data]:
+    client = _client(functions={"catalog": catalog, "info": info, "data": data_function})
+    response = client.get(url)
+    assert response.status_code == 200
+    content, rows = header(response.text)
+    assert content['format'] == "csv"
+    assert content['status']['code'] == 1200
+    assert [p['name'] for p in content['parameters']] == ["Time", "scalar"]
+    assert rows == "1970-01-01T00:00:00Z,0"
+
+  response = client.get(url + "&format=binary")
+  n = response.content.index(b"#}\n") + 3
+  content, _ = header(response.content[:n].decode())
+  assert content['format'] == "binary"
+  records = numpy.frombuffer(response.content[n:], [("Time", "S20"), ("scalar", "<f8")])
+  assert records.tolist() == [(b"1970-01-01T00:00:00Z", 0.0)]
+
+  # The header is always included in JSON responses.
+  response = client.get(url + "&format=json")
+  assert response.json()['data'] == [["1970-01-01T00:00:00Z", 0.0]]
+
+  # The server owns the header: include is not passed to scripts.
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    script = _data_script(tmp_dir, """
+      import sys
+      if "header" in sys.argv:
+        print("#{}")
+      print("1970-01-01T00:00:00Z,0")
+    """) + " {include}"
+    client = _client(functions={"catalog": catalog, "info": info}, scripts={"data": script})
+    response = client.get(url)
+    assert response.status_code == 200
+    content, rows = header(response.text)
+    assert content['format'] == "csv"
+    assert rows == "1970-01-01T00:00:00Z,0"
+
+
+if __name__ == "__main__":
+  test_static_responses()
+  test_conditional_responses()
+  test_data_script_streaming()
+  test_data_script_errors()
+  test_data_admission()
+  test_data_slot_release()
+  test_data_complete()
+  test_data_disconnect()
+  test_info_script_arguments()
+  test_async_functions()
+  test_function_adapters()
+  test_data_transcode()
+  test_data_include_header()
@@ -0,0 +1,166 @@
+# Usage:
+#   python test_cache.py
+
+def test_cache_ttl_and_eviction():
+  import time
+  from hapiserver.cache import Cache
+
+  cache = Cache('test', ttl=0.2, max_entries=2)
+  assert cache.get('a') is None
+  cache.set('a', 1)
+  cache.set('b', 2)
+  assert cache.get('a') == 1
+
+  # 'b' is least recently used, so it is evicted first.
+  cache.set('c', 3)
+  assert cache.get('b') is None
+  assert cache.get('a') == 1
+  assert cache.get('c') == 3
+
+  stats = cache.stats()
+  assert stats['hits'] == 3
+  assert stats['misses'] == 2
+  assert stats['entries'] == 2
+
+  time.sleep(0.25)
+  assert cache.get('a') is None
+
+  cache.set('a', 1)
+  cache.invalidate('a')
+  assert cache.get('a') is None
+
+  cache = Cache('disabled', ttl=0)
+  cache.set('a', 1)
+  assert cache.get('a') is None
+
+
+def test_derived():
+  from hapiserver.cache import wrap, derived
+
+  calls = []
+  def ids(catalog):
+    calls.append(1)
+    return {dataset['id'] for dataset in catalog}
+
+  catalog = [{"id": "demo1"}]
+  assert derived(catalog, 'ids', ids) == {"demo1"}
+  assert derived(catalog, 'ids', ids) == {"demo1"}
+  assert len(calls) == 2
+
+  catalog = wrap(catalog)
+  assert catalog == [{"id": "demo1"}]
+  assert derived(catalog, 'ids', ids) == {"demo1"}
+  assert derived(catalog, 'ids', ids) == {"demo1"}
+  assert len(calls) == 3
+
+  # Values that depend on a request argument are kept for a bounded
+  # number of keys.
+  from hapiserver.cache import _MAX_DERIVED
+  for i in range(2 * _MAX_DERIVED):
+    assert derived(catalog, 'keyed', ids, key=i) == {"demo1"}
+  assert len(catalog.derived['keyed']) == _MAX_DERIVED
+  derived(catalog, 'keyed', ids, key=2 * _MAX_DERIVED - 1)
+  assert len(calls) == 3 + 2 * _MAX_DERIVED
+
+
+def test_parameters_error_cached():
+  import hapiserver
+  from hapiserver.endpoints import _parameters_error
+
+  info = hapiserver.cache.wrap({
+    "parameters": [
+      {"name": "Time"},
+      {"name": "scalar"}
+    ]
+  })
+
+  # Cached info objects keep their parameter index between calls.
+  assert _parameters_error("Time,scalar", info) is None
+  assert 'index' in info.derived
+  index = info.derived['index']
+  assert _parameters_error("scalar", info) is None
+  assert info.derived['index'] is index
+
+  assert _parameters_error("INVALID", info)['code'] == 1407
+  assert _parameters_error("scalar,scalar", info)['code'] == 1411
+  assert 'Parameters out of order' in _parameters_error("scalar,Time", info)['message']
+
+  # Subsets of parameters are kept for a bounded number of requests.
+  from hapiserver.cache import _MAX_DERIVED
+  from hapiserver.endpoints import _info_parameters
+  for i in range(2 * _MAX_DERIVED):
+    assert _info_parameters(info, f"scalar,x{i}") == info['parameters']
+  assert len(info.derived['parameters']) == _MAX_DERIVED
+
+
+def test_catalog_cache():
+  import hapiserver
+  from hapiserver.endpoints import _get_catalog
+
+  calls = []
+  def catalog(depth=None):
+    calls.append(depth)
+    return [{"id": "demo1"}]
+
+  config = {"functions": {"catalog": catalog}}
+
+  for _ in range(3):
+    result, error = _get_catalog({}, config)
+    assert error is None
+    assert result == [{"id": "demo1"}]
+  assert len(calls) == 1
+
+  _get_catalog({"depth": "all"}, config)
+  assert len(calls) == 2
+
+  stats = hapiserver.cache.stats(config)['catalog']
+  assert stats['hits'] == 2
+  assert stats['misses'] == 2
+
+  hapiserver.cache.invalidate(config, 'catalog')
+  _get_catalog({}, config)
+  assert len(calls) == 3
+
+  config = {"functions": {"catalog": catalog}, "cache": {"catalog": {"ttl": 0}}}
+  _get_catalog({}, config)
+  _get_catalog({}, config)
+  assert len(calls) == 5
+
+
+def test_info_cache_change_detection():
+  import os
+  import pathlib
+  import tempfile
+
+  import hapiserver
+  from hapiserver.endpoints import _get_info
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    script = pathlib.Path(tmp_dir) / "info.py"
+    script.write_text('print(\'{"parameters": [{"name": "Time"}]}\')\n')
+    config = {"scripts": {"info": f"{script} {{dataset}}"}}
+
+    for dataset in ['demo1', 'demo1', 'demo2']:
+      info, error = _get_info({"dataset": dataset}, config)
+      assert error is None
+      assert info['parameters'][0]['name'] == "Time"
+
+    stats = hapiserver.cache.stats(config)['info']
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+
+    script.write_text('print(\'{"parameters": [{"name": "Epoch"}]}\')\n')
+    mtime = script.stat().st_mtime_ns + 10**9
+    os.utime(script, ns=(mtime, mtime))
+
+    info, error = _get_info({"dataset": "demo1"}, config)
+    assert info['parameters'][0]['name'] == "Epoch"
+    assert hapiserver.cache.stats(config)['info']['misses'] == 3
+
+
+if __name__ == "__main__":
+  test_cache_ttl_and_eviction()
+  test_derived()
+  test_parameters_error_cached()
+  test_catalog_cache()
+  test_info_cache_change_detection()
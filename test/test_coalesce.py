@@ -0,0 +1,95 @@
+# Usage:
+#   python test_coalesce.py
+
+import asyncio
+
+
+def test_coalesce():
+  from hapiserver.coalesce import coalesce
+
+  records = [f"1970-01-01T00:00:0{i}Z,{i}\n" for i in range(10)]
+  expected = "".join(records).encode()
+
+  chunks = list(coalesce(iter(records), chunk_size=50, flush_interval=0))
+  assert b"".join(chunks) == expected
+  assert all(len(chunk) >= 50 for chunk in chunks[:-1])
+  assert len(chunks) == 4
+
+  chunks = list(coalesce(iter([b"a", "", "b"]), chunk_size=10))
+  assert chunks == [b"ab"]
+
+  assert coalesce(records, chunk_size=0) is records
+
+  # Closing the coalesced stream closes the source.
+  closed = []
+  def source():
+    try:
+      yield from records
+    finally:
+      closed.append(True)
+  chunks = coalesce(source(), chunk_size=50)
+  next(chunks)
+  chunks.close()
+  assert closed == [True]
+
+
+def test_coalesce_deadline():
+  import time
+
+  from hapiserver.coalesce import coalesce
+
+  def source():
+    yield "a"
+    yield "b"
+    time.sleep(0.2)
+    yield "c"
+    yield "d"
+
+  # Synchronous sources: the deadline is checked when a chunk arrives.
+  chunks = list(coalesce(source(), chunk_size=100, flush_interval=0.1))
+  assert chunks == [b"abc", b"d"]
+
+  async def asource():
+    yield "a"
+    yield "b"
+    await asyncio.sleep(0.2)
+    yield "c"
+    yield "d"
+
+  async def run():
+    start = time.monotonic()
+    chunks = []
+    async for chunk in coalesce(asource(), chunk_size=100, flush_interval=0.05):
+      chunks.append((chunk, time.monotonic() - start))
+    return chunks
+
+  # Async sources: data is yielded at the deadline.
+  chunks = asyncio.run(run())
+  assert [chunk for chunk, _ in chunks] == [b"ab", b"cd"]
+  assert chunks[0][1] < 0.15
+
+
+def test_coalesce_async_close():
+  from hapiserver.coalesce import coalesce
+
+  closed = []
+  async def source():
+    try:
+      yield "a"
+      await asyncio.sleep(10)
+    finally:
+      closed.append(True)
+
+  async def run():
+    chunks = coalesce(source(), chunk_size=100, flush_interval=0.01)
+    assert await chunks.__anext__() == b"a"
+    await chunks.aclose()
+
+  asyncio.run(asyncio.wait_for(run(), 2))
+  assert closed == [True]
+
+
+if __name__ == "__main__":
+  test_coalesce()
+  test_coalesce_deadline()
+  test_coalesce_async_close()
@@ -60,6 +60,69 @@ def test_index_html_not_found():
   assert "index.html file not found" in output
 
 
+def test_invalid_cache_options():
+  from hapiserver.config import config
+
+  cases = {
+    "Unknown option cache.catalog.size": {"catalog": {"size": 1}},
+    "cache.catalog.ttl must be a non-negative number": {"catalog": {"ttl": -1}},
+    "cache.info must be a dict": {"info": 10},
+  }
+
+  for expected, cache in cases.items():
+    cfg = {"about": ABOUT, "cache": cache}
+    output = _stderr_of(config, cfg)
+    assert expected in output
+
+
+def test_invalid_coalesce_options():
+  from hapiserver.config import config
+
+  cases = {
+    "Unknown option coalesce.size": {"size": 1},
+    "coalesce.flush_interval must be a non-negative number": {"flush_interval": -1},
+    "coalesce must be true, false, or a dict": 10,
+  }
+
+  for expected, coalesce in cases.items():
+    cfg = {"about": ABOUT, "coalesce": coalesce}
+    output = _stderr_of(config, cfg)
+    assert expected in output
+
+
+def test_invalid_exec_options():
+  from hapiserver.config import config
+
+  cases = {
+    "Unknown endpoint in exec section": {"about": {}},
+    "exec.data must be a dict": {"data": "worker"},
+    "exec.data.mode must be one of": {"data": {"mode": "thread"}},
+    "exec.data.workers must be a positive integer": {"data": {"mode": "worker", "workers": 0}},
+    "exec.data.buffer_size must be a positive integer": {"data": {"mode": "process", "buffer_size": 0}},
+    "exec.data.start_method must be one of": {"data": {"mode": "process", "start_method": "thread"}},
+  }
+
+  for expected, exec in cases.items():
+    cfg = {"about": ABOUT, "exec": exec}
+    output = _stderr_of(config, cfg)
+    assert expected in output
+
+
+def test_invalid_admission_options():
+  from hapiserver.config import config
+
+  cases = {
+    "admission must be a dict": 10,
+    "Unknown option admission.limit": {"limit": 1},
+    "admission.max_queue must be a non-negative number": {"max_queue": -1},
+  }
+
+  for expected, admission in cases.items():
+    cfg = {"about": ABOUT, "admission": admission}
+    output = _stderr_of(config, cfg)
+    assert expected in output
+
+
 def test_default_index_html_is_packaged():
   from hapiserver.endpoints import hapi
 
@@ -88,4 +151,8 @@ if __name__ == "__main__":
   test_config_dict_with_app_key()
   test_script_and_function_both_defined()
   test_index_html_not_found()
+  test_invalid_cache_options()
+  test_invalid_coalesce_options()
+  test_invalid_exec_options()
+  test_invalid_admission_options()
   test_unresolvable_function_reference()
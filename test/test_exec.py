@@ -59,6 +59,38 @@ def setup_test_scripts():
           """
   chunked_script.write_text(f"{ENV}\n" + textwrap.dedent(script))
 
+  # Script that flushes each line and then pauses
+  slow_script = TEST_SCRIPTS_DIR / "slow.py"
+  script = """
+            import time
+            for i in range(5):
+              print(f"Chunk {i}", flush=True)
+              time.sleep(0.1)
+          """
+  slow_script.write_text(f"{ENV}\n" + textwrap.dedent(script))
+
+  # Script that prints its process id
+  pid_script = TEST_SCRIPTS_DIR / "pid.py"
+  script = """
+            import os
+            import sys
+            print(os.getpid(), os.getppid(), *sys.argv[1:])
+            if "fail" in sys.argv:
+              sys.exit(3)
+          """
+  pid_script.write_text(f"{ENV}\n" + textwrap.dedent(script))
+
+  # Script that writes more to stderr than a pipe buffer holds
+  chatty_script = TEST_SCRIPTS_DIR / "chatty.py"
+  script = """
+            import sys
+            print("first")
+            for i in range(2000):
+              print(f"warning {i}: " + "x" * 100, file=sys.stderr)
+            print("last")
+          """
+  chatty_script.write_text(f"{ENV}\n" + textwrap.dedent(script))
+
   # Large output script
   large_script = TEST_SCRIPTS_DIR / "large.py"
   script = """
@@ -174,6 +206,59 @@ class TestExecStreaming:
     assert "Line 0:" in full_output
     assert "Line 99:" in full_output
 
+  def test_streaming_max_buffer(self):
+    """Test that max_buffer caps chunk size and line length."""
+    script = str(TEST_SCRIPTS_DIR / "large.py")
+    for chunk_size in [0, 5000]:
+      stream_gen, error = exec(script, stream={"chunk_size": chunk_size, "max_buffer": 100})
+
+      assert error is None
+      chunks = list(stream_gen())
+      assert max(len(chunk) for chunk in chunks) <= 100
+      assert "".join(chunks).count("\n") == 100
+
+  def test_streaming_bytes(self):
+    """Test streaming in bytes mode."""
+    script = str(TEST_SCRIPTS_DIR / "large.py")
+    for chunk_size in [0, 1000]:
+      stream_gen, error = exec(script, stream={"chunk_size": chunk_size, "bytes": True})
+
+      assert error is None
+      chunks = list(stream_gen())
+      assert all(isinstance(chunk, bytes) for chunk in chunks)
+      output = b"".join(chunks)
+      assert output.startswith(b"Line 0: ")
+      assert output.count(b"\n") == 100
+
+    script = str(TEST_SCRIPTS_DIR / "fail.py")
+    stream_gen, error = exec(script, stream={"bytes": True})
+    chunks = list(stream_gen())
+    assert chunks[-1] == b"Script exited with code 1"
+
+  def test_streaming_flush_interval(self):
+    """Test that output is yielded before a full chunk is buffered."""
+    import time
+
+    script = str(TEST_SCRIPTS_DIR / "slow.py")
+    for mode in [{}, {"bytes": True}]:
+      stream = {"chunk_size": 1000000, "flush_interval": 0.05, **mode}
+      stream_gen, error = exec(script, stream=stream)
+
+      assert error is None
+      chunks = stream_gen()
+      first = next(chunks)
+      # Measured from the first chunk, not from the start of the script,
+      # so that interpreter startup time does not matter. The script
+      # writes for another 0.4 s after the first line.
+      received = time.monotonic()
+      chunks = [first, *chunks]
+      assert time.monotonic() - received > 0.2
+      assert "Chunk 0" in str(first)
+      assert "Chunk 4" not in str(first)
+      assert len(chunks) > 1
+      output = b"".join(chunks) if mode else "".join(chunks)
+      assert output.count(b"\n" if mode else "\n") == 5
+
   def test_streaming_line_mode(self):
     """Test streaming in line-by-line mode (chunk_size=0)."""
     script = str(TEST_SCRIPTS_DIR / "chunked.py")
@@ -207,6 +292,37 @@ class TestExecStreaming:
     assert "stdout output" in output
     # stderr is logged but not included in output
 
+  def test_streaming_stderr_bounded(self, caplog):
+    """Test that a full stderr pipe does not stall stdout and that logging is bounded."""
+    import logging
+
+    script = str(TEST_SCRIPTS_DIR / "chatty.py")
+    cases = [
+      ({"stderr": False, "stderr_lines": 5}, 6),
+      ({"stderr": True, "stderr_rate": 5}, 6),
+    ]
+    for stream, n_logged in cases:
+      for mode in [{}, {"chunk_size": 0}, {"async": True}]:
+        caplog.clear()
+        stream_gen, error = exec(script, stream={**stream, **mode})
+        assert error is None
+        with caplog.at_level(logging.ERROR, logger="hapiserver.exec"):
+          if mode.get('async'):
+            import asyncio
+            async def collect():
+              return [chunk async for chunk in stream_gen()]
+            output = "".join(asyncio.run(collect()))
+          else:
+            output = "".join(stream_gen())
+        assert output == "first\nlast\n"
+        messages = [r.getMessage() for r in caplog.records if "Script stderr" in r.getMessage()]
+        assert len(messages) == n_logged
+        if stream['stderr']:
+          assert "line(s) not logged" in messages[-1]
+        else:
+          assert "first 1995 line(s) omitted" in messages[0]
+          assert messages[-1].startswith("Script stderr: warning 1999: ")
+
   def test_streaming_script_failure(self):
     """Test streaming mode with failing script."""
     script = str(TEST_SCRIPTS_DIR / "fail.py")
@@ -223,6 +339,340 @@ class TestExecStreaming:
     assert any("exited with code" in chunk for chunk in output)
 
 
+  def test_streaming_start(self):
+    """Test that start() raises if the script fails without writing to stdout."""
+    import asyncio
+    import subprocess
+
+    async def astart(stream_gen):
+      stream = stream_gen()
+      await stream.start()
+      return [chunk async for chunk in stream]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      script = pathlib.Path(tmpdir) / "silent_fail.py"
+      script.write_text("import sys\nprint('error', file=sys.stderr)\nsys.exit(2)\n")
+
+      stream_gen, error = exec(str(script), stream={})
+      with pytest.raises(subprocess.CalledProcessError) as e:
+        stream_gen().start()
+      assert e.value.returncode == 2
+
+      stream_gen, error = exec(str(script), stream={"async": True})
+      with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(astart(stream_gen))
+
+    # The first chunk is kept for iteration.
+    script = str(TEST_SCRIPTS_DIR / "success.py")
+    stream_gen, error = exec(script, stream={})
+    stream = stream_gen()
+    stream.start()
+    assert "".join(stream) == "Success output\n"
+
+    stream_gen, error = exec(script, stream={"async": True})
+    assert "".join(asyncio.run(astart(stream_gen))) == "Success output\n"
+
+  def test_streaming_start_timeout(self):
+    """Test that start() returns after start_timeout and later failures are reported in-band."""
+    import time
+    import asyncio
+
+    async def astart(stream_gen):
+      stream = stream_gen()
+      started = time.monotonic()
+      await stream.start()
+      elapsed = time.monotonic() - started
+      return elapsed, [chunk async for chunk in stream]
+
+    def start(stream_gen):
+      stream = stream_gen()
+      started = time.monotonic()
+      stream.start()
+      return time.monotonic() - started, list(stream)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      script = pathlib.Path(tmpdir) / "slow_fail.py"
+      script.write_text("import sys, time\ntime.sleep(1.5)\nsys.exit(int(sys.argv[1]))\n")
+
+      for code, expected in [(2, "Script exited with code 2"), (0, "")]:
+        options = {"start_timeout": 0.2}
+        elapsed, chunks = start(exec(str(script), args=[str(code)], stream=options)[0])
+        assert elapsed < 1
+        assert "".join(chunks) == expected
+
+        options = {"start_timeout": 0.2, "async": True}
+        elapsed, chunks = asyncio.run(astart(exec(str(script), args=[str(code)], stream=options)[0]))
+        assert elapsed < 1
+        assert "".join(chunks) == expected
+
+
+class TestExecAsyncStreaming:
+  """Tests for asyncio streaming mode (_astream)."""
+
+  def _collect(self, stream_gen):
+    import asyncio
+
+    async def collect():
+      return [chunk async for chunk in stream_gen()]
+
+    return asyncio.run(collect())
+
+  def test_async_streaming(self):
+    """Test chunked, line, and bytes modes."""
+    script = str(TEST_SCRIPTS_DIR / "large.py")
+    for stream in [{}, {"chunk_size": 1000}, {"chunk_size": 0}, {"bytes": True}]:
+      stream_gen, error = exec(script, stream={"async": True, **stream})
+
+      assert error is None
+      chunks = self._collect(stream_gen)
+      if stream.get('bytes'):
+        output = b"".join(chunks).decode()
+      else:
+        output = "".join(chunks)
+      assert output.startswith("Line 0: ")
+      assert output.count("\n") == 100
+      if stream.get('chunk_size') == 0:
+        assert len(chunks) == 100
+
+  def test_async_streaming_flush_interval(self):
+    """Test that output is yielded before a full chunk is buffered."""
+    import asyncio
+    import time
+
+    script = str(TEST_SCRIPTS_DIR / "slow.py")
+    stream = {"async": True, "flush_interval": 0.05}
+    stream_gen, error = exec(script, stream=stream)
+
+    async def read():
+      # Time is measured from the first chunk, not from the start of the
+      # script, so that interpreter startup time does not matter. The
+      # script writes for another 0.4 s after the first line.
+      chunks = []
+      async for chunk in stream_gen():
+        if not chunks:
+          received = time.monotonic()
+        chunks.append(chunk)
+      return chunks, time.monotonic() - received
+
+    chunks, remaining = asyncio.run(read())
+    assert chunks[0] == "Chunk 0\n"
+    assert len(chunks) > 1
+    assert remaining > 0.2
+
+  def test_async_streaming_script_failure(self):
+    """Test asyncio streaming mode with failing script."""
+    script = str(TEST_SCRIPTS_DIR / "fail.py")
+    stream_gen, error = exec(script, stream={"async": True})
+
+    assert error is None
+    chunks = self._collect(stream_gen)
+    assert "Output before failure" in "".join(chunks)
+    assert chunks[-1] == "Script exited with code 1"
+
+
+  def test_async_streaming_start_failure(self):
+    """Test that a command that cannot be started is an error, as for _stream."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+      program = pathlib.Path(tmpdir) / "program"
+      program.write_text("#!/nonexistent/interpreter\n")
+      options = {"mode": "direct"}
+      for stream in [{"async": True}, {"async": False}]:
+        stream_gen, error = exec(str(program), stream=stream, options=options)
+        assert stream_gen is None
+        assert error["code"] == 1500
+        assert isinstance(error["exception"], FileNotFoundError)
+
+
+class TestExecWorker:
+  """Tests for worker mode (hapiserver.worker)."""
+
+  def test_worker_reuse_and_recycle(self):
+    """Test that a worker serves several runs and is replaced after max_requests."""
+    from hapiserver import worker
+
+    script = str(TEST_SCRIPTS_DIR / "pid.py")
+    options = {"mode": "worker", "max_requests": 2}
+    try:
+      pids = []
+      for i in range(4):
+        result, error = exec(script, args=f"run {i}", options=options)
+        assert error is None
+        pid, _, *args = result.split()
+        assert args == ["run", str(i)]
+        pids.append(pid)
+      assert pids[0] == pids[1]
+      assert pids[1] != pids[2]
+      assert pids[2] == pids[3]
+    finally:
+      worker.close()
+
+  def test_worker_failure(self):
+    """Test that a non-zero exit code is reported and the worker survives."""
+    from hapiserver import worker
+
+    script = str(TEST_SCRIPTS_DIR / "pid.py")
+    options = {"mode": "worker"}
+    try:
+      result, error = exec(script, args="fail", options=options)
+      assert result is None
+      assert error["code"] == 1500
+      assert error["exception"].returncode == 3
+
+      result, error = exec(script, options=options)
+      assert error is None
+    finally:
+      worker.close()
+
+  def test_worker_streaming(self):
+    """Test streaming output from a worker with threads and asyncio."""
+    import asyncio
+    from hapiserver import worker
+
+    script = str(TEST_SCRIPTS_DIR / "large.py")
+    options = {"mode": "worker"}
+
+    async def collect(stream_gen):
+      return [chunk async for chunk in stream_gen()]
+
+    try:
+      for stream in [{"bytes": True}, {"bytes": True, "chunk_size": 0}]:
+        stream_gen, error = exec(script, stream=stream, options=options)
+        assert error is None
+        assert b"".join(stream_gen()).count(b"\n") == 100
+
+        stream_gen, error = exec(script, stream={"async": True, **stream}, options=options)
+        assert error is None
+        assert b"".join(asyncio.run(collect(stream_gen))).count(b"\n") == 100
+
+      script = str(TEST_SCRIPTS_DIR / "fail.py")
+      stream_gen, error = exec(script, stream={"async": True}, options=options)
+      chunks = asyncio.run(collect(stream_gen))
+      assert chunks[-1] == "Script exited with code 1"
+    finally:
+      worker.close()
+
+
+  def test_worker_kill_during_wait(self):
+    """Test that a run killed while another thread waits releases its worker once."""
+    import threading
+    from hapiserver import worker
+
+    options = {"mode": "worker", "workers": 1}
+    try:
+      pool = worker.pool(str(TEST_SCRIPTS_DIR / "slow.py"), options)
+      job = pool.run([])
+      waiter = threading.Thread(target=job.wait)
+      waiter.start()
+      job.kill()
+      waiter.join(5)
+      assert not waiter.is_alive()
+      assert job.poll() is not None
+      assert pool._count == 1
+      assert len(pool._idle) == 1
+
+      stdout, _ = pool.run([]).communicate()
+      assert stdout.count(b"\n") == 5
+    finally:
+      worker.close()
+
+  def test_worker_timeout(self):
+    """Test that a run waiting for a busy worker fails after timeout with HTTP 503."""
+    from hapiserver import worker
+
+    script = str(TEST_SCRIPTS_DIR / "slow.py")
+    options = {"mode": "worker", "workers": 1, "timeout": 0.1}
+    try:
+      job = worker.pool(script, options).run([])
+      stream_gen, error = exec(script, stream={}, options=options)
+      assert stream_gen is None
+      assert isinstance(error["exception"], TimeoutError)
+      assert error["status_code"] == 503
+      job.kill()
+    finally:
+      worker.close()
+
+
+class TestExecFork:
+  """Tests for fork server mode (hapiserver.worker.Zygote)."""
+
+  def test_fork(self):
+    """Test that each run is a new child of the same fork server."""
+    import os
+    from hapiserver import worker
+
+    script = str(TEST_SCRIPTS_DIR / "pid.py")
+    options = {"mode": "fork"}
+    try:
+      pids = set()
+      ppids = set()
+      for i in range(3):
+        result, error = exec(script, args=f"run {i}", options=options)
+        assert error is None
+        pid, ppid, *args = result.split()
+        assert args == ["run", str(i)]
+        pids.add(pid)
+        ppids.add(ppid)
+      assert len(pids) == 3
+      assert len(ppids) == 1
+      assert ppids != {str(os.getpid())}
+
+      result, error = exec(script, args="fail", options=options)
+      assert error["exception"].returncode == 3
+    finally:
+      worker.close()
+
+  def test_fork_concurrent_and_kill(self):
+    """Test concurrent runs and killing a run."""
+    from hapiserver import worker
+
+    options = {"mode": "fork"}
+    try:
+      zygote = worker.pool(str(TEST_SCRIPTS_DIR / "slow.py"), options)
+      jobs = [zygote.run([]) for _ in range(3)]
+      jobs[0].kill()
+      assert jobs[0].returncode == -9
+      for job in jobs[1:]:
+        stdout, _ = job.communicate()
+        assert stdout.count(b"\n") == 5
+        assert job.returncode == 0
+
+      stream_gen, error = exec(str(TEST_SCRIPTS_DIR / "large.py"), stream={"bytes": True}, options=options)
+      assert b"".join(stream_gen()).count(b"\n") == 100
+    finally:
+      worker.close()
+
+
+class TestExecDirect:
+  """Tests for direct mode (program run without the Python interpreter)."""
+
+  def test_direct(self):
+    """Test executable, #!, and non-executable programs."""
+    import os
+    import shutil
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      program = pathlib.Path(tmpdir) / "program"
+      program.write_text(f"#!{shutil.which('sh')}\necho \"Args: $*\"\nexit $2\n")
+
+      for mode in [0o755, 0o644]:
+        os.chmod(program, mode)
+        options = {"mode": "direct"}
+        result, error = exec(str(program), args="a 0", options=options)
+        assert error is None
+        assert result == "Args: a 0\n"
+
+        result, error = exec(str(program), args="a 2", options=options)
+        assert error["exception"].returncode == 2
+
+        stream_gen, error = exec(str(program), args="b 0", stream={"bytes": True}, options=options)
+        assert b"".join(stream_gen()) == b"Args: b 0\n"
+
+      program.write_text("echo hello\n")
+      result, error = exec(str(program), options={"mode": "direct"})
+      assert result is None
+      assert error["message"] == "Execution script is not executable"
+
+
 class TestExecEdgeCases:
   """Tests for edge cases and special scenarios."""
 
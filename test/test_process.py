@@ -0,0 +1,164 @@
+# Usage:
+#   python test_process.py
+#
+# Functions run in worker processes must be importable by the worker, so
+# they are defined at the top level of this file.
+
+import os
+
+
+def data(dataset, parameters, start, stop, config=None):
+  if dataset == 'fail':
+    raise ValueError("no such dataset")
+  yield f"{os.getpid()}\n"
+  yield config['about']['id'] + "\n"
+  for i in range(10):
+    yield f"{i}" * 100 + "\n"
+  if dataset == 'fail_later':
+    raise ValueError("read error")
+
+
+def info(dataset):
+  return {"pid": os.getpid(), "dataset": dataset}
+
+
+async def data_async(dataset, parameters, start, stop):
+  import asyncio
+  for i in range(3):
+    await asyncio.sleep(0)
+    yield f"{i}\n"
+
+
+def _config(func, **options):
+  return {
+    "about": {"id": "Demo"},
+    "functions": {"data": func, "info": info},
+    "exec": {"data": {"mode": "process", **options}, "info": {"mode": "process"}}
+  }
+
+
+def _args(dataset):
+  return {"dataset": dataset, "parameters": "", "start": "", "stop": ""}
+
+
+def test_process_stream():
+  import hapiserver
+  from hapiserver.call import _call_function
+
+  # Chunks are larger than the buffers and outnumber them.
+  config = _config(data, buffers=2, buffer_size=64)
+  try:
+    for _ in range(2):
+      stream, error = _call_function('data', _args('demo1'), config)
+      assert error is None
+      chunks = list(stream)
+      assert all(isinstance(chunk, bytes) and len(chunk) <= 64 for chunk in chunks)
+      lines = b"".join(chunks).decode().splitlines()
+      assert int(lines[0]) != os.getpid()
+      assert lines[1] == "Demo"
+      assert lines[2:] == [f"{i}" * 100 for i in range(10)]
+
+    result, error = _call_function('info', {"dataset": "demo1"}, config)
+    assert error is None
+    assert result['dataset'] == "demo1"
+    assert result['pid'] != os.getpid()
+  finally:
+    hapiserver.process.close()
+
+
+def test_process_errors():
+  import pytest
+
+  import hapiserver
+  from hapiserver.call import _call_function
+
+  config = _config(data, buffers=2, buffer_size=64)
+  try:
+    stream, error = _call_function('data', _args('fail'), config)
+    assert stream is None
+    assert "no such dataset" in str(error['exception'])
+
+    stream, error = _call_function('data', _args('fail_later'), config)
+    assert error is None
+    with pytest.raises(RuntimeError, match="read error"):
+      list(stream)
+
+    # Stopped before the function finished, e.g., on client disconnect.
+    stream, error = _call_function('data', _args('demo1'), config)
+    pid = next(stream)
+    stream.kill()
+    assert list(stream) == []
+
+    stream, error = _call_function('data', _args('demo1'), config)
+    assert next(stream) != pid
+    stream.close()
+  finally:
+    hapiserver.process.close()
+
+
+def test_process_timeout():
+  import hapiserver
+  from hapiserver.call import _call_function
+
+  config = _config(data, workers=1, timeout=0.1)
+  try:
+    stream, error = _call_function('data', _args('demo1'), config)
+    next(stream)
+    # The only worker is busy.
+    result, error = _call_function('data', _args('demo1'), config)
+    assert result is None
+    assert isinstance(error['exception'], TimeoutError)
+    assert error['status_code'] == 503
+    stream.close()
+  finally:
+    hapiserver.process.close()
+
+
+def test_process_async_generator():
+  import hapiserver
+  from hapiserver.call import _call_function
+
+  config = _config(data_async)
+  try:
+    stream, error = _call_function('data', _args('demo1'), config)
+    assert error is None
+    assert b"".join(stream) == b"0\n1\n2\n"
+  finally:
+    hapiserver.process.close()
+
+
+def test_process_app():
+  from fastapi.testclient import TestClient
+
+  import hapiserver
+
+  def catalog():
+    return [{"id": "demo1"}]
+
+  def info(dataset):
+    return {
+      "startDate": "1970-01-01T00:00:00Z",
+      "stopDate": "1970-01-02T00:00:00Z",
+      "parameters": [{"name": "Time", "type": "isotime", "units": "UTC", "length": 20, "fill": None}]
+    }
+
+  config = _config(data_async)
+  config['functions'].update({"catalog": catalog, "info": info})
+  del config['exec']['info']
+  try:
+    with TestClient(hapiserver.app(config)) as client:
+      response = client.get("/hapi/data?dataset=demo1&start=1970-01-01Z&stop=1970-01-01T00:00:01Z")
+      assert response.status_code == 200
+      assert response.text == "0\n1\n2\n"
+    # Stopped when the server shuts down.
+    assert hapiserver.process._pools == []
+  finally:
+    hapiserver.process.close()
+
+
+if __name__ == "__main__":
+  test_process_stream()
+  test_process_errors()
+  test_process_timeout()
+  test_process_async_generator()
+  test_process_app()
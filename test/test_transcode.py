@@ -0,0 +1,213 @@
+# Usage:
+#   python test_transcode.py
+
+PARAMETERS = [
+  {"name": "Time", "type": "isotime", "units": "UTC", "length": 24},
+  {"name": "vector", "type": "double", "units": "nT", "size": [3]},
+  {"name": "count", "type": "integer", "units": None},
+  {"name": "label", "type": "string", "units": None, "length": 4}
+]
+
+
+def _records(n):
+  import numpy
+
+  records = numpy.zeros(n, [("f0", "S24"), ("f1", "<f8", (3,)), ("f2", "<i4"), ("f3", "S4")])
+  for i in range(n):
+    records[i] = (f"1970-01-01T00:00:0{i}.000Z", (i, -i, 0.5), i, f"a{i}")
+  return records
+
+
+def test_transcode_binary():
+  import numpy
+
+  from hapiserver.transcode import layout, transcode
+
+  csv = "".join(f"1970-01-01T00:00:0{i}.000Z, {i}, {-i}, 0.5, {i}, a{i}\n" for i in range(5))
+  layout_ = layout('binary', {"parameters": PARAMETERS})
+  assert layout_['dtype'].itemsize == 24 + 3 * 8 + 4 + 4
+
+  # Lines split across chunks, str and bytes chunks, no final newline.
+  chunks = [csv[:10], csv[10:50].encode(), csv[50:-1]]
+  output = b"".join(transcode(iter(chunks), 'binary', layout_))
+  assert output == _records(5).tobytes()
+  assert numpy.frombuffer(output, layout_['dtype'])['f1'][4].tolist() == [4, -4, 0.5]
+
+  # Quoted strings.
+  csv = '1970-01-01T00:00:00.000Z,0,0,0.5,0,"a,0"\n'
+  output = b"".join(transcode([csv], 'binary', layout_))
+  assert numpy.frombuffer(output, layout_['dtype'])['f3'][0] == b"a,0"
+
+
+def test_transcode_errors():
+  import asyncio
+
+  import pytest
+
+  from hapiserver.transcode import layout, transcode
+
+  with pytest.raises(ValueError, match="has no length"):
+    layout('binary', {"parameters": [{"name": "Time", "type": "isotime"}]})
+
+  # A line that cannot be converted ends the output after the lines
+  # before it.
+  layout_ = layout('binary', {"parameters": PARAMETERS})
+  chunks = ["1970-01-01T00:00:00.000Z,0,0,0.5,0,a0\n", "1970-01-01T00:00:01.000Z,0\n"]
+  assert b"".join(transcode(chunks, 'binary', layout_)) == _records(1).tobytes()
+
+  header = {"HAPI": "3.3", "status": {"code": 1200, "message": "OK"}, "parameters": PARAMETERS}
+  layout_ = layout('json', header)
+  chunks = ["1970-01-01T00:00:00.000Z,0,0,0.5,0,a0\n", "1970-01-01T00:00:01.000Z,,0,0.5,0,a1\n"]
+  output = b"".join(transcode(chunks, 'json', layout_))
+  assert output.startswith(layout_['head'])
+  assert b'"a0"' in output
+  assert not output.endswith(layout_['tail'])
+
+  async def bad_source():
+    for chunk in chunks:
+      yield chunk
+
+  async def collect(stream):
+    return b"".join([chunk async for chunk in stream])
+
+  assert asyncio.run(collect(transcode(bad_source(), 'json', layout_))) == output
+  layout_ = layout('binary', {"parameters": PARAMETERS})
+
+  async def source():
+    yield "1970-01-01T00:00:00.000Z,0,0,0.5,0,a0\n"
+    yield "1970-01-01T00:00:01.000Z,1,-1,0.5,1,a1\n"
+
+  async def run():
+    return b"".join([chunk async for chunk in transcode(source(), 'binary', layout_)])
+
+  assert asyncio.run(run()) == _records(2).tobytes()
+
+
+def test_transcode_json():
+  import json
+
+  from hapiserver.transcode import layout, transcode
+
+  header = {"HAPI": "3.3", "status": {"code": 1200, "message": "OK"}, "parameters": PARAMETERS}
+  layout_ = layout('json', header)
+
+  csv = "".join(f"1970-01-01T00:00:0{i}.000Z, {i}, {-i}, 0.5, {i}, a{i}\n" for i in range(5))
+  chunks = [csv[:10], csv[10:50].encode(), csv[50:]]
+  content = json.loads(b"".join(transcode(iter(chunks), 'json', layout_)))
+  assert content['format'] == "json"
+  assert content['parameters'] == PARAMETERS
+  assert content['data'][4] == ["1970-01-01T00:00:04.000Z", [4.0, -4.0, 0.5], 4, "a4"]
+  assert len(content['data']) == 5
+
+  content = json.loads(b"".join(transcode([], 'json', layout_)))
+  assert content['data'] == []
+
+
+def test_transcode_async_thread():
+  import asyncio
+  import json
+  import threading
+
+  import hapiserver.csv_to_json
+  import hapiserver.transcode
+  from hapiserver.transcode import layout, transcode
+
+  header = {"HAPI": "3.3", "status": {"code": 1200, "message": "OK"}, "parameters": PARAMETERS}
+  layout_ = layout('json', header)
+
+  async def source():
+    yield "1970-01-01T00:00:00.000Z,0,0,0.5,0,a0\n"
+
+  async def run():
+    return b"".join([chunk async for chunk in transcode(source(), 'json', layout_)])
+
+  # Blocks from async streams are not converted on the event loop thread.
+  threads = []
+  convert_block = hapiserver.csv_to_json.convert_block
+  def convert(*args):
+    threads.append(threading.get_ident())
+    return convert_block(*args)
+
+  hapiserver.csv_to_json.convert_block = convert
+  try:
+    content = json.loads(asyncio.run(run()))
+  finally:
+    hapiserver.csv_to_json.convert_block = convert_block
+  assert content['data'] == [["1970-01-01T00:00:00.000Z", [0.0, 0.0, 0.5], 0, "a0"]]
+  assert threads and threading.get_ident() not in threads
+
+  threads = []
+  layout_ = layout('binary', header)
+  binary_block = hapiserver.transcode._binary_block
+  def convert(*args):
+    threads.append(threading.get_ident())
+    return binary_block(*args)
+
+  async def run():
+    return b"".join([chunk async for chunk in transcode(source(), 'binary', layout_)])
+
+  hapiserver.transcode._binary_block = convert
+  try:
+    assert asyncio.run(run()) == _records(1).tobytes()
+  finally:
+    hapiserver.transcode._binary_block = binary_block
+  assert threads and threading.get_ident() not in threads
+
+
+def test_convert_lines():
+  import pytest
+
+  from hapiserver.csv_to_json import CsvToJsonError, convert_lines
+
+  lines = ['2010-001T12:01:00Z, 1, 2, 3, 4, "a,b"', '']
+  rows = convert_lines(lines, [[2, 2], None], ['double', 'string'])
+  assert rows == [["2010-001T12:01:00Z", [[1.0, 2.0], [3.0, 4.0]], "a,b"]]
+
+  rows = convert_lines(['2010-001T12:01:00Z, 1.5'], [None])
+  assert rows == [["2010-001T12:01:00Z", 1.5]]
+
+  with pytest.raises(CsvToJsonError, match="Expected 2 column"):
+    convert_lines(['2010-001T12:01:00Z, 1, 2'], [None])
+
+  with pytest.raises(CsvToJsonError, match="Invalid value"):
+    convert_lines(['2010-001T12:01:00Z, x'], [None], ['integer'])
+
+
+def test_convert_block():
+  import json
+
+  import pytest
+
+  from hapiserver.csv_to_json import CsvToJsonError, convert_block, convert_lines
+
+  block = "2010-001T12:01:00Z, 1, 2, 3, 4, 7, ab\r\n\n2010-001T12:01:01Z, 5, 6, 7.5, 8, -1, é\n"
+  sizes = [[2, 2], None, None]
+  types = ['double', 'integer', 'string']
+  rows = json.loads(f"[{convert_block(block, sizes, types)}]")
+  assert rows == [
+    ["2010-001T12:01:00Z", [[1.0, 2.0], [3.0, 4.0]], 7, "ab"],
+    ["2010-001T12:01:01Z", [[5.0, 6.0], [7.5, 8.0]], -1, "é"]
+  ]
+  assert rows == convert_lines(block.splitlines(), sizes, types)
+
+  # Quoted fields and unknown types use convert_lines().
+  block = '2010-001T12:01:00Z, 1, 2, 3, 4, 7, "a,b"\n'
+  assert json.loads(f"[{convert_block(block.encode(), sizes, types)}]")[0][3] == "a,b"
+  assert json.loads(f"[{convert_block(block, sizes, [None, None, None])}]")[0][2] == 7
+
+  assert convert_block("", sizes, types) == ""
+
+  with pytest.raises(CsvToJsonError, match="Expected 7 column"):
+    convert_block("2010-001T12:01:00Z, 1\n", sizes, types)
+
+  with pytest.raises(CsvToJsonError, match="Invalid integer value"):
+    convert_block("2010-001T12:01:00Z, 1, 2, 3, 4, 7.5, a\n", sizes, types)
+
+
+if __name__ == "__main__":
+  test_transcode_binary()
+  test_transcode_errors()
+  test_transcode_json()
+  test_transcode_async_thread()
+  test_convert_lines()
+  test_convert_block()